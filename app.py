@@ -1,39 +1,35 @@
+import time
+_startup_started = time.perf_counter()
+
 import os
-from flask import Flask, request, jsonify, send_file
-import tensorflow as tf
-import numpy as np
+import importlib
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from src import preprocessing
-from src import model
+from src import batching
+from src import cache
+from src import scoring
+from src import storage
+from src import sync
+from src import jobs
+from src import registry
+from src import metrics
+from src import inference_server
 import tempfile
-import boto3
-from PIL import Image
-import io
 import zipfile
 import sqlite3
-from tabulate import tabulate 
 import threading
-import time
+from botocore.exceptions import BotoCoreError, ClientError
 from flask_cors import CORS
+from werkzeug.http import http_date
 
 app = Flask(__name__)
 CORS(app)
 
-# Global boto3 client
-try:
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-        region_name=os.environ.get('AWS_DEFAULT_REGION'),
-    )
-except Exception as e:
-    print(f"Error initializing boto3 client: {e}")
-    s3_client = None
-
 # Database Configuration
 DATABASE_FILE = "my_base.db"
 
-from database import create_table
+import database
+from database import create_table, find_annotations_member, bulk_insert_images, iter_zip_images
 # # Create the 'images' table if it doesn't exist
 # create_table()
 
@@ -42,111 +38,396 @@ bucket_name = "theosummative"
 s3_model_file = "models/second_model.keras"
 temp_dir = tempfile.gettempdir()
 local_model_path = os.path.join(temp_dir, "model.keras")
-loaded_model = model.load_model_from_s3(bucket_name, s3_model_file, local_model_path)
-print(f"Model loaded successfully: {loaded_model is not None}")
 
-# Define label mapping
-label_map = {
-    0: "bxw",
-    1: "healthy",
-}
+# TensorFlow and the model are loaded off the import path (see start_model_loading),
+# so routes that don't need inference can answer immediately
+model = None
+model_state = {"status": "loading", "error": None, "load_seconds": None, "registry_version": None}
+import_times = {}
+
+def _timed_import(name):
+    """Imports a module and records how long it took."""
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_times[name] = round(time.perf_counter() - start, 3)
+    return module
+
+# Prediction cache, keyed on image content (or library id) plus the model version
+prediction_cache = cache.PredictionCache(
+    max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 4096)),
+)
+
+# Versioned artifacts with metrics; `production` names the version to serve
+model_registry = registry.ModelRegistry(bucket_name, s3_model_file)
+MODEL_WATCH_INTERVAL = float(os.environ.get('MODEL_WATCH_INTERVAL', 5))
+# 'tflite' serves a version's quantized export when it passed its accuracy check, 'keras' the float model
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'keras')
+# With a host-wide inference server (python -m src.inference_server), this process
+# never loads TensorFlow or the model; predictions and reloads go to the server
+inference_client = (inference_server.InferenceClient(inference_server.INFERENCE_SOCKET)
+                    if inference_server.INFERENCE_SOCKET else None)
+
+def _release_model(version):
+    """Frees a swapped-out model once its last in-flight batch has finished."""
+    model.evict_model(bucket_name, version.rsplit('@', 1)[0])
+    print(f"Released model {version}")
+
+# The serving model; swaps are atomic and in-flight batches finish on the model they started with
+serving_slot = registry.ModelSlot(on_release=_release_model)
+_activation_lock = threading.Lock()
+
+def activate_model(new_model, version):
+    """Swaps in a new serving model and invalidates predictions from the old one."""
+    serving_slot.swap(new_model, version)
+    prediction_cache.set_model_version(version)
+
+def predict_with_serving_model(images):
+    """Runs one batch on the current model, holding a reference to it until the batch is done."""
+    if inference_client is not None:
+        return inference_client.predict(images)
+    with serving_slot.acquire() as (serving_model, _):
+        return model.make_predictions(serving_model, images)
+
+def _production_artifact(entry=None, serving=True):
+    """Returns (s3_key, local_path, registry_version) of the model to serve.
+
+    With `serving=False` it is always the float .keras model (what retraining starts from).
+    Falls back to the original model while the registry is empty or unreachable.
+    """
+    if entry is None:
+        try:
+            entry = model_registry.production()
+        except Exception as e:
+            print(f"Model registry unavailable ({e}), serving {s3_model_file}")
+    tflite = ((entry or {}).get('artifacts') or {}).get('tflite')
+    if serving and INFERENCE_BACKEND == 'tflite' and tflite and tflite.get('accepted'):
+        return tflite['key'], model_registry.local_path(entry, tflite['key']), entry['version']
+    if entry is None or entry['key'] == s3_model_file:
+        return s3_model_file, local_model_path, entry['version'] if entry else None
+    return entry['key'], model_registry.local_path(entry), entry['version']
+
+def load_and_activate(entry=None):
+    """Loads, warms up and checks a registry version (production by default), then swaps it in.
+
+    Returns the registry version now served, or None if production was already being served.
+    """
+    if inference_client is not None:
+        # One load on the server serves every worker on the host
+        status = inference_client.reload(entry['version'] if entry else None)
+        _apply_server_status(status)
+        return status['registry_version']
+    with _activation_lock:
+        key, local_path, registry_version = _production_artifact(entry)
+        if entry is None and registry_version is not None and registry_version == model_state['registry_version']:
+            return None  # another caller swapped it in while we waited
+        candidate = model.load_serving_model(bucket_name, key, local_path)
+        if candidate is None or not model.check_serving_model(candidate):
+            raise RuntimeError(f"Could not load a working model from {key}")
+        activate_model(candidate, f"{key}@{storage.cached_etag(local_path)}")
+        model_state['registry_version'] = registry_version
+    return registry_version
+
+def preload_model_artifacts():
+    """Imports TensorFlow and fetches the model file without starting the TF runtime.
+
+    Safe to run in a gunicorn master before forking: workers inherit the imported
+    modules copy-on-write and find the artifact already in the local cache.
+    """
+    global model
+    if inference_client is not None:
+        return
+    if model is None:
+        model = _timed_import('src.model')
+    start = time.perf_counter()
+    key, local_path, _ = _production_artifact()
+    storage.download_artifact(bucket_name, key, local_path)
+    import_times['model_download'] = round(time.perf_counter() - start, 3)
+
+def _load_serving_model():
+    global model
+    start = time.perf_counter()
+    try:
+        if model is None:
+            model = _timed_import('src.model')
+        load_and_activate()
+        model_state.update(status="ready", load_seconds=round(time.perf_counter() - start, 3))
+        start_model_watcher()
+    except Exception as e:
+        model_state.update(status="failed", error=str(e), load_seconds=round(time.perf_counter() - start, 3))
+    print(f"Model loaded successfully: {serving_slot.version is not None}")
+
+def _watch_model_registry():
+    """Swaps in whichever version becomes production (after a retrain, promote or rollback).
 
-def get_db_connection():
-    """Establishes a database connection."""
+    Every web worker polls on its own, so a promotion reaches all of them.
+    """
+    while True:
+        time.sleep(MODEL_WATCH_INTERVAL)
+        try:
+            production = model_registry.list()['production']
+            if production is not None and production != model_state['registry_version']:
+                if load_and_activate() is not None:
+                    print(f"Serving model version {production}")
+        except Exception as e:
+            print(f"Error checking the model registry: {e}")
+
+def _apply_server_status(status):
+    model_state.update(status=status['status'], error=status['error'], load_seconds=status['load_seconds'],
+                       registry_version=status['registry_version'])
+    prediction_cache.set_model_version(status['model_version'])
+
+def _follow_inference_server():
+    """Mirrors the inference server's model status, so readiness and the cache follow its reloads."""
+    while True:
+        try:
+            _apply_server_status(inference_client.status())
+        except Exception as e:
+            model_state.update(status="unavailable", error=f"Inference server unavailable: {e}")
+        time.sleep(inference_server.INFERENCE_STATUS_INTERVAL)
+
+_model_watcher = None
+
+def start_model_watcher():
+    global _model_watcher
+    with _model_loader_lock:
+        if _model_watcher is None or not _model_watcher.is_alive():
+            _model_watcher = threading.Thread(target=_watch_model_registry, name="model-watcher", daemon=True)
+            _model_watcher.start()
+
+_model_loader = None
+_model_loader_lock = threading.Lock()
+
+def start_model_loading():
+    """Loads and warms up the model on a background thread (idempotent)."""
+    global _model_loader
+    with _model_loader_lock:
+        if _model_loader is None:
+            target = _follow_inference_server if inference_client is not None else _load_serving_model
+            _model_loader = threading.Thread(target=target, name="model-loader", daemon=True)
+            _model_loader.start()
+    return _model_loader
+
+def model_unavailable():
+    """Returns a 503 response while the model isn't ready, otherwise None."""
+    if model_state["status"] != "ready":
+        return jsonify({'error': f"Model is not ready ({model_state['status']})", 'status': model_state['status']}), 503
+    return None
+
+# Micro-batching: concurrent prediction requests share one forward pass (on the
+# inference server, across all workers, when there is one)
+batcher = inference_client or batching.MicroBatcher(
+    predict_with_serving_model,
+    max_batch_size=int(os.environ.get('BATCH_MAX_SIZE', 32)),
+    max_wait_ms=float(os.environ.get('BATCH_MAX_WAIT_MS', 5)),
+    max_queue_size=int(os.environ.get('BATCH_MAX_QUEUE', 256)),
+)
+
+# Define label mapping
+label_map = preprocessing.LABEL_MAP
+
+# Per-stage timings: parse/read/cache_lookup/db_lookup/preprocess here, queue_wait/model in the batcher
+stage_seconds = metrics.predict_stage_seconds
+request_seconds = metrics.histogram("http_request_seconds", "Time to handle a request (until the body starts streaming).",
+                                    ["endpoint", "method", "status"])
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    if metrics.PROFILING_ENABLED and request.args.get('profile'):
+        g.profiler = metrics.SamplingProfiler().start()
+
+@app.after_request
+def _record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    started = g.get('request_started')
+    if started is not None:
+        request_seconds.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method,
+                                status=response.status_code)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        # The collapsed stacks replace the body; feed them to flamegraph.pl or speedscope
+        return Response(profiler.stop(), mimetype='text/plain',
+                        headers={'X-Profile-Samples': str(profiler.samples), 'X-Profiled-Status': str(response.status_code)})
+    return response
+
+# Ingested images reach S3 as small delta segments uploaded in the background
+db_sync = sync.DeltaSync(bucket_name, DATABASE_FILE)
+
+def download_database(local_db_path):
+    """Rebuilds the database from S3 when there is no local copy yet, else fetches only the segments it lacks."""
+    if not os.path.exists(local_db_path):
+        print("Downloading database from S3...")
+        db_sync.restore(local_db_path)
+        return
     try:
-        temp_dir = tempfile.gettempdir()
-        local_db_path = os.path.join(temp_dir, "my_base.db")
-
-        # Check if the database file exists locally
-        if not os.path.exists(local_db_path):
-            # Download from S3 if it doesn't exist
-            print("Downloading database from S3...")
-            s3.download_file(bucket_name, DATABASE_FILE, local_db_path)
-            print("Database downloaded from S3.")
-
-        conn = sqlite3.connect(local_db_path)
-        return conn
-    except sqlite3.Error as e:
-        print(f"Error connecting to database: {e}")
-        return None
+        db_sync.pull(local_db_path)
+    except (BotoCoreError, ClientError, OSError, sqlite3.Error) as e:
+        print(f"Error pulling database updates from S3, serving the local copy: {e}")
+
+# The pooled data-access layer fetches the database on first use
+database.set_database_provider(download_database)
 
 def get_image_from_db(image_id):
     """Retrieves image data from the database."""
-    conn = get_db_connection()
-    if conn is None:
-        return None
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT image_data FROM images WHERE ROWID = ?;", (image_id,))
-
-        row = cur.fetchone()
-        if row:
-            image_data = row[0]
-            return image_data
-        else:
-            return None  # Return None if no matching row is found
-
-    except sqlite3.Error as e:
+        return database.get_image_data(image_id)
+    except (sqlite3.Error, TimeoutError) as e:
         print(f"Error retrieving image from database: {e}")
         return None
 
-    finally:
-        if conn:
-            conn.close()
+_database_opener = None
+_database_opener_lock = threading.Lock()
 
-def upload_database_to_s3():
-    """Uploads the database to S3."""
+def _open_database_in_background():
+    """Opens (fetching it first if need be) the default database off the request path, once."""
+    global _database_opener
+
+    def open_database():
+        try:
+            database.get_pool()
+        except Exception as e:
+            print(f"Error opening the database: {e}")
+
+    with _database_opener_lock:
+        if _database_opener is None:
+            _database_opener = threading.Thread(target=open_database, name="database-open", daemon=True)
+            _database_opener.start()
+
+def find_library_image(cache_key):
+    """Returns {'id', 'label'} of the stored image with exactly the bytes behind a content cache key, or None.
+
+    Best effort: predictions never wait on fetching the database, and a
+    failing lookup only costs the shared library cache entry.
+    """
+    if not database.pool_is_open():
+        _open_database_in_background()
+        return None
     try:
-        local_db_path = os.path.join(tempfile.gettempdir(), DATABASE_FILE)
-        s3.upload_file(local_db_path, bucket_name, DATABASE_FILE)
-        print("Database uploaded to S3.")
+        match = database.find_library_image(cache_key.split(':', 1)[1])
     except Exception as e:
-        print(f"Error uploading database to S3: {e}")
-        time.sleep(5)  # Wait for 5 seconds before retrying
-        upload_database_to_s3() #retry the upload.
+        print(f"Error looking up image in the library: {e}")
+        return None
+    return None if match is None else {'id': match[0], 'label': match[1]}
+
+def upload_database_to_s3():
+    """Schedules a background upload of the rows S3 doesn't have yet."""
+    db_sync.request_sync()
+
+# Thumbnail edge lengths /image/<id>?size=... may ask for (the originals are 640x640)
+THUMBNAIL_SIZES = tuple(int(size) for size in os.environ.get('THUMBNAIL_SIZES', '128,256').split(',') if size.strip())
+IMAGE_CHUNK_SIZE = 64 * 1024
+# BLOBs up to this size are read in one go; larger ones are streamed
+IMAGE_BUFFER_BYTES = int(os.environ.get('IMAGE_BUFFER_BYTES', 1024 * 1024))
+# Stored images never change under the same id, so clients may cache them indefinitely
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def _image_not_modified(etag, last_modified):
+    """True if the request's validators show the client already has this version."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified is not None:
+        return int(last_modified) <= request.if_modified_since.timestamp()
+    return False
 
 @app.route('/image/<image_id>', methods=['GET'])
 def get_image(image_id):
-    """Serves image data from the database."""
-    image_data = get_image_from_db(image_id)
-    if image_data is None:
-        return jsonify({'error': 'Image not found'}), 404
-
+    """Returns image data (or a thumbnail with ?size=N) straight from the database."""
     try:
-        # Create a temporary file to hold the image data
-        temp_dir = tempfile.gettempdir()
-        local_image_path = os.path.join(temp_dir, f"image_{image_id}.jpg")
+        image_id = int(image_id)
+        size = request.args.get('size', type=int)
+        if size is not None and size not in THUMBNAIL_SIZES:
+            return jsonify({'error': f"Unsupported thumbnail size, use one of {list(THUMBNAIL_SIZES)}"}), 400
+
+        if size is None:
+            info = database.get_image_info(image_id)
+            table, etag = 'images', f"{image_id}-"
+        else:
+            info = database.get_thumbnail_info(image_id, size)
+            table, etag = 'thumbnails', f"{image_id}-{size}-"
+    except ValueError:
+        return jsonify({'error': 'Image not found'}), 404
+    except (sqlite3.Error, TimeoutError) as e:
+        print(f"Error retrieving image from database: {e}")
+        return jsonify({'error': str(e)}), 500
+    if info is None:
+        return jsonify({'error': 'Image not found'}), 404
 
-        with open(local_image_path, "wb") as f:
-            f.write(image_data)
+    rowid, length, created_at = info
+    etag += str(length)
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': IMAGE_CACHE_CONTROL}
+    if created_at is not None:
+        headers['Last-Modified'] = http_date(created_at)
 
-        # Send the file as a response
-        return send_file(local_image_path, mimetype='image/jpeg')
+    # Answer revalidations before touching the BLOB
+    if _image_not_modified(etag, created_at):
+        return Response(status=304, headers=headers)
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    if length <= IMAGE_BUFFER_BYTES:
+        # Read while holding the pooled connection only briefly, not for the whole download
+        try:
+            with database.open_blob(table, rowid) as blob:
+                data = blob.read()
+        except (sqlite3.Error, TimeoutError, OSError) as e:
+            print(f"Error retrieving image from database: {e}")
+            return jsonify({'error': str(e)}), 500
+        return Response(data, mimetype='image/jpeg', headers=headers)
+
+    def generate():
+        # A connection of its own, so a slow client can't keep one from the pool,
+        # reading the BLOB in fixed-size pieces instead of materialising it.
+        with database.open_blob(table, rowid, dedicated=True) as blob:
+            while True:
+                chunk = blob.read(IMAGE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    headers['Content-Length'] = str(length)
+    return Response(generate(), mimetype='image/jpeg', headers=headers, direct_passthrough=True)
 
 @app.route('/predict_upload', methods=['POST'])
 def predict_upload():
+    unavailable = model_unavailable()
+    if unavailable:
+        return unavailable
     try:
-        if 'image' in request.files:
+        with stage_seconds.time(stage="parse"):
+            has_image = 'image' in request.files  # parses the multipart body
+        if has_image:
             # Image uploaded via file upload
             image_file = request.files['image']
             try:
-                img = Image.open(io.BytesIO(image_file.read()))
-                temp_dir = tempfile.gettempdir()
-                local_image_path = os.path.join(temp_dir, "uploaded_image.jpg")
-                img.save(local_image_path)
-
-                preprocessed_image = preprocessing.preprocess_image(local_image_path)
-                preprocessed_images = np.expand_dims(preprocessed_image, axis=0)
+                with stage_seconds.time(stage="read"):
+                    image_bytes = image_file.read()
+                with stage_seconds.time(stage="library_lookup"):
+                    cache_key = cache.PredictionCache.key_for_bytes(image_bytes)
+                    library_image = find_library_image(cache_key)
+                if library_image is not None:
+                    # Shares its cached prediction with /predict_lib
+                    cache_key = cache.PredictionCache.key_for_image_id(library_image['id'])
+                with stage_seconds.time(stage="cache_lookup"):
+                    model_version = prediction_cache.model_version
+                    predicted_label = prediction_cache.get(cache_key, model_version)
+
+                if predicted_label is None:
+                    # Decode straight from the upload buffer, no temp file round trip
+                    with stage_seconds.time(stage="preprocess"):
+                        preprocessed_image = preprocessing.preprocess_image(image_bytes)
+                    if preprocessed_image is None:
+                        return jsonify({'error': 'Error processing uploaded image'}), 500
+
+                    with stage_seconds.time(stage="inference"):
+                        predicted_label = int(batcher.submit(preprocessed_image))
+                    prediction_cache.put(cache_key, predicted_label, model_version)
 
-                predictions = model.make_predictions(loaded_model, preprocessed_images)
-                predicted_label = int(predictions[0])
                 predicted_class = label_map.get(predicted_label, "Unknown")
 
+                if library_image is not None:
+                    return jsonify({'prediction': predicted_class, 'library_image': library_image})
                 return jsonify({'prediction': predicted_class})
 
+            except batching.QueueFullError as e:
+                return jsonify({'error': str(e)}), 503
             except Exception as e:
                 return jsonify({'error': f'Error processing uploaded image: {str(e)}'}), 500
 
@@ -158,71 +439,95 @@ def predict_upload():
     
 @app.route('/predict_lib', methods=['POST'])
 def predict_lib():
+    unavailable = model_unavailable()
+    if unavailable:
+        return unavailable
     try:
         data = request.get_json()
         image_id = data['image_id']
 
-        image_data = get_image_from_db(image_id)
-        if image_data is None:
-            return jsonify({'error': 'Image not found'}), 404
+        with stage_seconds.time(stage="cache_lookup"):
+            cache_key = cache.PredictionCache.key_for_image_id(image_id)
+            model_version = prediction_cache.model_version
+            predicted_label = prediction_cache.get(cache_key, model_version)
 
-        # Convert image_data to a format that preprocessing can handle
-        temp_dir = tempfile.gettempdir()
-        local_image_path = os.path.join(temp_dir, "predicted_image.jpg")
+        if predicted_label is None:
+            with stage_seconds.time(stage="db_lookup"):
+                image_data = get_image_from_db(image_id)
+            if image_data is None:
+                return jsonify({'error': 'Image not found'}), 404
 
-        try:
-            with open(local_image_path, "wb") as f:
-                f.write(image_data)
-            print(f"Image saved to: {local_image_path}") 
-            if not os.path.exists(local_image_path): 
-                return jsonify({'error': 'Failed to save image data'}), 500
+            with stage_seconds.time(stage="preprocess"):
+                preprocessed_image = preprocessing.preprocess_image(image_data)
+            if preprocessed_image is None:
+                return jsonify({'error': 'Error processing image data'}), 500
 
-        except Exception as save_error:
-            print(f"Error saving image data: {save_error}")
-            return jsonify({'error': 'Error saving image data'}), 500
+            with stage_seconds.time(stage="inference"):
+                predicted_label = int(batcher.submit(preprocessed_image))
+            prediction_cache.put(cache_key, predicted_label, model_version)
 
-        preprocessed_image = preprocessing.preprocess_image(local_image_path)
-        preprocessed_images = np.expand_dims(preprocessed_image, axis=0)
-
-        predictions = model.make_predictions(loaded_model, preprocessed_images)
-        predicted_label = int(predictions[0])
         predicted_class = label_map.get(predicted_label, "Unknown")
 
         return jsonify({'prediction': predicted_class})
 
+    except batching.QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-retraining_status = {}  # Dictionary to store retraining status
-
-def retrain_and_monitor(retrain_id, zip_file_path):
-    """Retrains the model and updates the retraining status."""
-    retraining_status[retrain_id] = {"status": "retraining", "progress": 0, "message": "Retraining started"}
-    try:
-        # Extract images from the zip file
-        temp_dir = os.path.join(tempfile.gettempdir(), f"retrain_images_{retrain_id}")
-        os.makedirs(temp_dir, exist_ok=True)
-
-        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-
-        # Retrain the model using the extracted images
-        metrics = model.retrain_model_from_folder(temp_dir, bucket_name, s3_model_file, local_model_path) #change to your function.
-
-        global loaded_model
-        loaded_model = model.load_model_from_s3(bucket_name, "models/retrained_model.keras", os.path.join(tempfile.gettempdir(), "retrained_model.keras"))
-
-        retraining_status[retrain_id] = {"status": "completed", "progress": 100, "message": "Retraining completed", "metrics": metrics}
-
-    except Exception as e:
-        retraining_status[retrain_id] = {"status": "failed", "progress": 0, "message": f"Retraining failed: {e}"}
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """Classifies many uploads (field `images`) or library images (`{"image_ids": [...]}`).
+
+    Results are streamed as NDJSON (default) or CSV with `?format=csv`.
+    """
+    unavailable = model_unavailable()
+    if unavailable:
+        return unavailable
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+
+    if request.files:
+        uploads = request.files.getlist('images')
+        if not uploads:
+            return jsonify({'error': 'No images provided'}), 400
+        # Read now: uploaded files are closed once the view returns, before streaming starts
+        records = [(upload.filename, upload.read(), None) for upload in uploads]
+    else:
+        data = request.get_json(silent=True) or {}
+        image_ids = data.get('image_ids')
+        if not image_ids:
+            return jsonify({'error': 'No image_ids provided'}), 400
+
+        def library_records():
+            for image_id in image_ids:
+                yield image_id, get_image_from_db(image_id), None
+        records = library_records()
+
+    chunk_size = int(os.environ.get('BATCH_MAX_SIZE', 32))
+    results = scoring.score_records(records, predict_with_serving_model, chunk_size, label_map)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(scoring.format_results(results, fmt)), mimetype=mimetype)
+
+def ingest_retrain_zip(zip_file):
+    """Inserts the images of an uploaded zip (a path or file object) and returns (body, status)."""
+    create_table() #Create table before processing the upload.
+    # Stream images straight out of the archive into one bulk insert
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        if find_annotations_member(zip_ref) is None:
+            return {'error': 'Missing images folder or _annotations.csv in zip file'}, 400
+        ingest_stats = bulk_insert_images(iter_zip_images(zip_ref), 'retrain')
+
+    upload_database_to_s3()
+    return {'message': 'Data uploaded to database successfully', 'ingest': ingest_stats}, 200
 
 @app.route('/upload_retrain_data', methods=['POST'])
 def upload_retrain_data():
     """Uploads a zip file with images and _annotations.csv and saves data to the database."""
     
     try:
-        create_table() #Create table before processing the upload.
         if 'zip_file' not in request.files:
             return jsonify({'error': 'No zip file uploaded'}), 400
 
@@ -230,53 +535,157 @@ def upload_retrain_data():
         if zip_file.filename == '':
             return jsonify({'error': 'No selected file'}), 400
 
-        temp_dir = tempfile.gettempdir()
-        extracted_dir = os.path.join(temp_dir, 'retrain_data_extracted')
-        os.makedirs(extracted_dir, exist_ok=True)
-
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            zip_ref.extractall(extracted_dir)
-
-        images_dir = os.path.join(extracted_dir, 'images')
-        csv_path = os.path.join(extracted_dir, '_annotations.csv')
-
-        if os.path.exists(csv_path) and os.path.exists(images_dir):
-            model.populate_retrain_database_from_csv(csv_path, images_dir)
-            upload_database_to_s3()
-            return jsonify({'message': 'Data uploaded to database successfully'}), 200
-        else:
-            return jsonify({'error': 'Missing images folder or _annotations.csv in zip file'}), 400
+        body, status = ingest_retrain_zip(zip_file)
+        return jsonify(body), status
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/retrain_status/<retrain_id>', methods=['GET'])
 def get_retrain_status(retrain_id):
-    """Gets the status of a retraining process."""
-    if retrain_id not in retraining_status:
+    """Gets the status and training progress of a retrain job."""
+    job = jobs.get_job(retrain_id)
+    if job is None:
+        return jsonify({'error': 'Retraining process not found'}), 404
+    return jsonify(jobs.status_payload(job))
+
+@app.route('/retrain/<retrain_id>/cancel', methods=['POST'])
+def cancel_retrain(retrain_id):
+    """Cancels a queued retrain job, or stops a running one after its current batch."""
+    job = jobs.cancel(retrain_id)
+    if job is None:
         return jsonify({'error': 'Retraining process not found'}), 404
-    return jsonify(retraining_status[retrain_id])
+    return jsonify(jobs.status_payload(job))
     
-@app.route('/retrain', methods=['POST'])
-def retrain():
-    """Triggers retraining using data from the database and returns metrics."""
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 before that."""
+    body = dict(model_state, import_times=import_times)
+    return jsonify(body), 200 if model_state["status"] == "ready" else 503
+
+@app.route('/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """Reports prediction cache hit/miss counters."""
+    return jsonify(prediction_cache.stats())
+
+# Values other components already count, read when /metrics is scraped
+metrics.counter("prediction_cache_hits_total", "Prediction cache hits.").set_function(lambda: prediction_cache.stats()['hits'])
+metrics.counter("prediction_cache_misses_total", "Prediction cache misses.").set_function(lambda: prediction_cache.stats()['misses'])
+metrics.gauge("prediction_cache_entries", "Predictions currently cached.").set_function(lambda: prediction_cache.stats()['entries'])
+metrics.gauge("batch_queue_depth", "Prediction requests waiting to be batched.").set_function(batcher.queue_depth)
+metrics.gauge("model_ready", "1 once the model is loaded and warmed up.").set_function(lambda: int(model_state['status'] == 'ready'))
+metrics.gauge("model_registry_version", "Registry version this worker serves.").set_function(lambda: model_state['registry_version'])
+metrics.gauge("models_in_flight", "Batches running on the serving model, by whether it has been swapped out.",
+              ["state"]).set_function(lambda: [({"state": "current"}, serving_slot.stats()['in_flight']),
+                                               ({"state": "draining"}, sum(lease['in_flight'] for lease in serving_slot.stats()['draining']))])
+metrics.counter("db_connection_waits_total", "Pooled connections that had to wait for a free slot.").set_function(
+    lambda: sum(pool.waits for pool in database.pools()))
+metrics.gauge("retrain_jobs", "Retrain jobs by status.", ["status"]).set_function(
+    lambda: [({"status": status}, count) for status, count in sorted(jobs.stats()[0].items())])
+metrics.gauge("retrain_last_stage_seconds", "Stage timings of the most recent completed retrain.", ["stage"]).set_function(
+    lambda: [({"stage": stage}, seconds) for stage, seconds in jobs.stats()[1].items()])
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of this worker's counters and latency histograms."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def _serving_stats():
+    """What is being served: this worker's model slot, or the inference server's status."""
+    if inference_client is not None:
+        return inference_client.status()
+    return serving_slot.stats()
+
+def _registry_response(entry):
+    return {'version': entry, 'production': model_registry.list()['production'], 'serving': _serving_stats()}
+
+@app.route('/models', methods=['GET'])
+def list_models():
+    """Lists registered model versions with their metrics, plus what this worker is serving."""
     try:
-        metrics = model.retrain_model_from_db(DATABASE_FILE, bucket_name, s3_model_file, local_model_path)
-        global loaded_model
-        loaded_model = model.load_model_from_s3(bucket_name, "models/retrained_model.keras", os.path.join(tempfile.gettempdir(), "retrained_model.keras"))
-
-        report = metrics['report']
-        accuracy = metrics['accuracy']
-        loss = metrics['loss']
-
-        return jsonify({'message': 'Retraining completed', 'metrics': {
-            'accuracy': accuracy,
-            'loss': loss,
-            'report': report
-        }})
-    
+        body = model_registry.list()
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    body['serving'] = dict(_serving_stats(), registry_version=model_state['registry_version'])
+    return jsonify(body)
+
+@app.route('/models/<int:version>/promote', methods=['POST'])
+def promote_model(version):
+    """Makes a version the production model and swaps it in once it is warmed up."""
+    try:
+        entry = model_registry.promote(version)
+        load_and_activate(entry)
+    except registry.RegistryError as e:
+        return jsonify({'error': str(e)}), 404 if 'Unknown' in str(e) else 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify(_registry_response(entry))
+
+@app.route('/models/rollback', methods=['POST'])
+def rollback_model():
+    """Returns to the previous production version."""
+    try:
+        entry = model_registry.rollback()
+        load_and_activate(entry)
+    except registry.RegistryError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify(_registry_response(entry))
+
+def queue_retrain(options):
+    """Validates retrain options, queues the job and returns (body, status)."""
+    if options.get('mode', jobs.RETRAIN_MODE) not in ('incremental', 'full'):
+        return {'error': "mode must be 'incremental' or 'full'"}, 400
+    if options.get('promote', True) not in (True, False, 'force'):
+        return {'error': "promote must be true, false or 'force'"}, 400
+    epochs = options.get('epochs', 10)
+    if isinstance(epochs, bool) or not isinstance(epochs, int) or epochs < 1:
+        return {'error': "epochs must be a positive integer"}, 400
+    key, local_path, version = _production_artifact(serving=False)
+    params = {
+        'database_file': os.path.abspath(database.DATABASE_PATH),
+        'database_key': DATABASE_FILE,
+        'bucket_name': bucket_name,
+        'base_model_key': s3_model_file,
+        's3_model_file': key,
+        'local_model_path': local_path,
+        'parent_version': version,
+    }
+    params.update({name: options[name] for name in ('mode', 'freeze_backbone', 'epochs', 'promote') if name in options})
+    try:
+        job = jobs.enqueue('retrain', s3_model_file, params)
+    except jobs.JobExistsError as e:
+        return dict(jobs.status_payload(e.job), message=str(e)), 409
+    except (sqlite3.Error, TimeoutError) as e:
+        return {'error': str(e)}, 500
+
+    jobs.ensure_worker()
+    return dict(jobs.status_payload(job), message='Retraining queued'), 202
+
+@app.route('/retrain', methods=['POST'])
+def retrain():
+    """Queues a retrain job on the data in the database and returns its id for /retrain_status.
+
+    Training starts from the production version; the result is registered as a
+    new version and promoted if it scores about as well as production on the
+    held-out split. An optional JSON body can set "mode" ('incremental' or
+    'full'), "freeze_backbone", "epochs" and "promote" (true, false or 'force').
+    """
+    body, status = queue_retrain(request.get_json(silent=True) or {})
+    return jsonify(body), status
+
+# 'background' (default) loads the model on a thread right away; 'deferred' only
+# preloads imports and the artifact, leaving start_model_loading() to the caller
+# (gunicorn.conf.py calls it in each worker after fork); 'manual' touches neither
+# S3 nor the model, for callers that activate one themselves (src.benchmark).
+MODEL_LOADING = os.environ.get('MODEL_LOADING', 'background')
+if MODEL_LOADING == 'deferred':
+    preload_model_artifacts()
+elif MODEL_LOADING != 'manual':
+    start_model_loading()
+
+import_times['app'] = round(time.perf_counter() - _startup_started, 3)
 
 if __name__ == '__main__':
     app.run(debug=True, use_reloader=True, host='0.0.0.0')
\ No newline at end of file
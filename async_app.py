@@ -0,0 +1,388 @@
+"""asyncio front end for the serving routes.
+
+Runs the same model, micro-batcher, caches, database and job queue as app.py,
+but on one event loop: request bodies are read as they arrive, and decoding,
+SQLite and file work go to bounded thread pools, so a slow upload or download
+only costs a coroutine instead of a worker thread. Inference goes through the
+micro-batcher without a thread waiting on it.
+
+    python async_app.py
+    gunicorn -c gunicorn.conf.py -k aiohttp.GunicornWebWorker async_app:create_app
+"""
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from werkzeug.http import http_date, parse_date
+import app as flask_app
+import database
+from src import batching, cache, jobs, metrics, preprocessing
+
+# Threads decoding and resizing images (CPU bound; PIL releases the GIL)
+ASYNC_CPU_THREADS = int(os.environ.get('ASYNC_CPU_THREADS', os.cpu_count() or 2))
+# Threads for SQLite, zip and temp file work; more than the pool size would only wait for a connection
+ASYNC_IO_THREADS = int(os.environ.get('ASYNC_IO_THREADS', database.DB_POOL_SIZE))
+# Calls allowed to wait for a pool thread before new requests get a 503
+ASYNC_MAX_PENDING = int(os.environ.get('ASYNC_MAX_PENDING', 256))
+ASYNC_MAX_IMAGE_BYTES = int(os.environ.get('ASYNC_MAX_IMAGE_BYTES', 20 * 1024 * 1024))
+# Uploaded zips are kept in memory up to this size, then spooled to a temp file
+ASYNC_SPOOL_BYTES = int(os.environ.get('ASYNC_SPOOL_BYTES', 32 * 1024 * 1024))
+# Images up to this size are read in one go, so the DB connection is free before the client is sent anything
+ASYNC_IMAGE_BUFFER_BYTES = int(os.environ.get('ASYNC_IMAGE_BUFFER_BYTES', 1024 * 1024))
+READ_CHUNK_SIZE = 64 * 1024
+
+class ExecutorBusyError(Exception):
+    """Raised when a pool already has as much work waiting as it is allowed to."""
+
+class ImageNotFoundError(Exception):
+    pass
+
+class BoundedExecutor:
+    """A thread pool for blocking calls from coroutines, with a cap on waiting work.
+
+    Beyond `threads + max_pending` outstanding calls, `run` raises
+    ExecutorBusyError instead of queueing without limit.
+    """
+
+    def __init__(self, name, threads, max_pending=ASYNC_MAX_PENDING):
+        self.name = name
+        self.limit = threads + max_pending
+        self.outstanding = 0
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"async-{name}")
+
+    async def run(self, fn, *args):
+        # Only the event loop thread touches `outstanding`, so no lock is needed
+        if self.outstanding >= self.limit:
+            raise ExecutorBusyError(f"Too many pending {self.name} calls ({self.outstanding})")
+        self.outstanding += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            self.outstanding -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+cpu_pool = BoundedExecutor("cpu", ASYNC_CPU_THREADS)
+io_pool = BoundedExecutor("io", ASYNC_IO_THREADS)
+
+metrics.gauge("async_executor_outstanding", "Blocking calls running or waiting in the async front end's pools.",
+              ["pool"]).set_function(lambda: [({"pool": pool.name}, pool.outstanding) for pool in (cpu_pool, io_pool)])
+
+stage_seconds = metrics.predict_stage_seconds
+
+def json_error(message, status, **extra):
+    return web.json_response(dict(extra, error=message), status=status)
+
+def model_unavailable():
+    """Returns a 503 response while the model isn't ready, otherwise None."""
+    status = flask_app.model_state["status"]
+    if status != "ready":
+        return json_error(f"Model is not ready ({status})", 503, status=status)
+    return None
+
+async def predict(cache_key, load_image):
+    """Returns the class name for one image, from the cache or through the micro-batcher.
+
+    `load_image` is a coroutine function returning the image bytes, only called on a cache miss.
+    """
+    model_version = flask_app.prediction_cache.model_version
+    with stage_seconds.time(stage="cache_lookup"):
+        predicted_label = flask_app.prediction_cache.get(cache_key, model_version)
+
+    if predicted_label is None:
+        image_source = await load_image()
+        start = time.perf_counter()
+        preprocessed_image = await cpu_pool.run(preprocessing.preprocess_image, image_source)
+        stage_seconds.observe(time.perf_counter() - start, stage="preprocess")
+        if preprocessed_image is None:
+            raise ValueError("Error processing image data")
+
+        start = time.perf_counter()
+        # Off the loop: submitting may wait for queue room or an inference server slot and connect
+        future = await io_pool.run(flask_app.batcher.submit_future, preprocessed_image)
+        # Shielded so a timeout here doesn't cancel the batcher's future
+        result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), flask_app.batcher.result_timeout)
+        stage_seconds.observe(time.perf_counter() - start, stage="inference")
+        predicted_label = int(result)
+        flask_app.prediction_cache.put(cache_key, predicted_label, model_version)
+
+    return flask_app.label_map.get(predicted_label, "Unknown")
+
+async def read_field(field, limit):
+    """Reads one multipart field as it arrives, refusing it past `limit` bytes."""
+    data = bytearray()
+    while True:
+        chunk = await field.read_chunk(READ_CHUNK_SIZE)
+        if not chunk:
+            return bytes(data)
+        data.extend(chunk)
+        if len(data) > limit:
+            raise web.HTTPRequestEntityTooLarge(max_size=limit, actual_size=len(data))
+
+async def predict_upload(request):
+    unavailable = model_unavailable()
+    if unavailable:
+        return unavailable
+    if not request.content_type.startswith('multipart/'):
+        return json_error('No image provided', 400)
+
+    start = time.perf_counter()
+    image_bytes = None
+    reader = await request.multipart()
+    while True:
+        field = await reader.next()
+        if field is None:
+            break
+        if field.name == 'image' and image_bytes is None:
+            image_bytes = await read_field(field, ASYNC_MAX_IMAGE_BYTES)
+        else:
+            await field.release()
+    stage_seconds.observe(time.perf_counter() - start, stage="read")
+    if image_bytes is None:
+        return json_error('No image provided', 400)
+
+    try:
+        start = time.perf_counter()
+        cache_key = cache.PredictionCache.key_for_bytes(image_bytes)
+        try:
+            library_image = await io_pool.run(flask_app.find_library_image, cache_key)
+        except ExecutorBusyError:
+            library_image = None  # the lookup is optional; don't turn it into a 503
+        stage_seconds.observe(time.perf_counter() - start, stage="library_lookup")
+        if library_image is not None:
+            cache_key = cache.PredictionCache.key_for_image_id(library_image['id'])
+
+        async def load_image():
+            return image_bytes
+        body = {'prediction': await predict(cache_key, load_image)}
+        if library_image is not None:
+            body['library_image'] = library_image
+        return web.json_response(body)
+    except (batching.QueueFullError, ExecutorBusyError) as e:
+        return json_error(str(e), 503)
+    except Exception as e:
+        return json_error(f'Error processing uploaded image: {str(e)}', 500)
+
+async def predict_lib(request):
+    unavailable = model_unavailable()
+    if unavailable:
+        return unavailable
+    try:
+        data = await request.json()
+        image_id = data['image_id']
+
+        async def load_image():
+            start = time.perf_counter()
+            image_data = await io_pool.run(flask_app.get_image_from_db, image_id)
+            stage_seconds.observe(time.perf_counter() - start, stage="db_lookup")
+            if image_data is None:
+                raise ImageNotFoundError('Image not found')
+            return image_data
+        prediction = await predict(cache.PredictionCache.key_for_image_id(image_id), load_image)
+        return web.json_response({'prediction': prediction})
+
+    except ImageNotFoundError as e:
+        return json_error(str(e), 404)
+    except (batching.QueueFullError, ExecutorBusyError) as e:
+        return json_error(str(e), 503)
+    except Exception as e:
+        return json_error(str(e), 500)
+
+def _image_info(image_id, size):
+    if size is None:
+        return 'images', f"{image_id}-", database.get_image_info(image_id)
+    return 'thumbnails', f"{image_id}-{size}-", database.get_thumbnail_info(image_id, size)
+
+def _read_blob(table, rowid):
+    with database.open_blob(table, rowid) as blob:
+        return blob.read()
+
+def _image_not_modified(request, etag, last_modified):
+    """True if the request's validators show the client already has this version."""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return if_none_match.strip() == '*' or f'"{etag}"' in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
+    since = parse_date(request.headers.get('If-Modified-Since'))
+    if since is not None and last_modified is not None:
+        return int(last_modified) <= since.timestamp()
+    return False
+
+async def get_image(request):
+    """Streams image data (or a thumbnail with ?size=N) from the database."""
+    try:
+        image_id = int(request.match_info['image_id'])
+        size = request.query.get('size')
+        if size is not None:
+            try:
+                size = int(size)
+            except ValueError:
+                size = None  # like Flask's type=int, an unparseable size means the original
+        if size is not None and size not in flask_app.THUMBNAIL_SIZES:
+            return json_error(f"Unsupported thumbnail size, use one of {list(flask_app.THUMBNAIL_SIZES)}", 400)
+        table, etag, info = await io_pool.run(_image_info, image_id, size)
+    except ValueError:
+        return json_error('Image not found', 404)
+    except ExecutorBusyError as e:
+        return json_error(str(e), 503)
+    except (sqlite3.Error, TimeoutError) as e:
+        print(f"Error retrieving image from database: {e}")
+        return json_error(str(e), 500)
+    if info is None:
+        return json_error('Image not found', 404)
+
+    rowid, length, created_at = info
+    etag += str(length)
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': flask_app.IMAGE_CACHE_CONTROL}
+    if created_at is not None:
+        headers['Last-Modified'] = http_date(created_at)
+
+    # Answer revalidations before touching the BLOB
+    if _image_not_modified(request, etag, created_at):
+        return web.Response(status=304, headers=headers)
+
+    if length <= ASYNC_IMAGE_BUFFER_BYTES:
+        # One read, then the connection goes back to the pool however slowly the client downloads
+        return web.Response(body=await io_pool.run(_read_blob, table, rowid), content_type='image/jpeg', headers=headers)
+
+    response = web.StreamResponse(headers=headers)
+    response.content_type = 'image/jpeg'
+    response.content_length = length
+    await response.prepare(request)
+    # Larger BLOBs are read piece by piece over a connection of their own, so slow
+    # downloads can't starve the pool
+    context = database.open_blob(table, rowid, dedicated=True)
+    blob = await io_pool.run(context.__enter__)
+    try:
+        while True:
+            chunk = await io_pool.run(blob.read, flask_app.IMAGE_CHUNK_SIZE)
+            if not chunk:
+                break
+            await response.write(chunk)
+    finally:
+        # Always close the connection: not through the bounded pool (which may refuse
+        # the call), and shielded so a client disconnect can't skip it
+        release = asyncio.get_running_loop().run_in_executor(None, context.__exit__, None, None, None)
+        await asyncio.shield(release)
+    await response.write_eof()
+    return response
+
+async def upload_retrain_data(request):
+    """Uploads a zip file with images and _annotations.csv and saves data to the database."""
+    if not request.content_type.startswith('multipart/'):
+        return json_error('No zip file uploaded', 400)
+
+    # Spooled to memory or a temp file as it arrives; ingest starts once the upload is complete
+    spool = tempfile.SpooledTemporaryFile(max_size=ASYNC_SPOOL_BYTES)
+    try:
+        found = False
+        reader = await request.multipart()
+        while True:
+            field = await reader.next()
+            if field is None:
+                break
+            if field.name != 'zip_file' or found:
+                await field.release()
+                continue
+            if not field.filename:
+                return json_error('No selected file', 400)
+            found = True
+            while True:
+                chunk = await field.read_chunk(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await io_pool.run(spool.write, chunk)
+        if not found:
+            return json_error('No zip file uploaded', 400)
+
+        await io_pool.run(spool.seek, 0)
+        body, status = await io_pool.run(flask_app.ingest_retrain_zip, spool)
+        return web.json_response(body, status=status)
+
+    except ExecutorBusyError as e:
+        return json_error(str(e), 503)
+    except Exception as e:
+        return json_error(str(e), 500)
+    finally:
+        spool.close()
+
+async def get_retrain_status(request):
+    """Gets the status and training progress of a retrain job."""
+    try:
+        job = await io_pool.run(jobs.get_job, request.match_info['retrain_id'])
+    except ExecutorBusyError as e:
+        return json_error(str(e), 503)
+    if job is None:
+        return json_error('Retraining process not found', 404)
+    return web.json_response(jobs.status_payload(job))
+
+async def retrain(request):
+    """Queues a retrain job; see app.retrain for the options."""
+    try:
+        options = await request.json() if request.can_read_body else {}
+    except ValueError:
+        options = {}
+    try:
+        body, status = await io_pool.run(flask_app.queue_retrain, options or {})
+    except ExecutorBusyError as e:
+        return json_error(str(e), 503)
+    return web.json_response(body, status=status)
+
+async def get_ready(request):
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 before that."""
+    body = dict(flask_app.model_state, import_times=flask_app.import_times)
+    return web.json_response(body, status=200 if flask_app.model_state["status"] == "ready" else 503)
+
+async def get_metrics(request):
+    """Prometheus text exposition of this worker's counters and latency histograms."""
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+CORS_ALLOW_METHODS = "GET, HEAD, POST, OPTIONS"
+
+@web.middleware
+async def cors_and_timing(request, handler):
+    """Answers CORS preflights, allows any origin (like flask_cors' defaults) and times each request."""
+    start = time.perf_counter()
+    if request.method == 'OPTIONS' and 'Access-Control-Request-Method' in request.headers:
+        response = web.Response(headers={
+            'Access-Control-Allow-Methods': CORS_ALLOW_METHODS,
+            'Access-Control-Allow-Headers': request.headers.get('Access-Control-Request-Headers', ''),
+        })
+    else:
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            response = e
+    resource = request.match_info.route.resource
+    endpoint = resource.canonical if resource is not None else "unmatched"
+    flask_app.request_seconds.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method,
+                                      status=response.status)
+    if not response.prepared:
+        response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+async def _shutdown_pools(_):
+    cpu_pool.shutdown()
+    io_pool.shutdown()
+
+async def create_app():
+    """Builds the aiohttp application (also the entry point for aiohttp.GunicornWebWorker)."""
+    application = web.Application(middlewares=[cors_and_timing])
+    application.add_routes([
+        web.post('/predict_upload', predict_upload),
+        web.post('/predict_lib', predict_lib),
+        web.get('/image/{image_id}', get_image),
+        web.post('/upload_retrain_data', upload_retrain_data),
+        web.get('/retrain_status/{retrain_id}', get_retrain_status),
+        web.post('/retrain', retrain),
+        web.get('/ready', get_ready),
+        web.get('/metrics', get_metrics),
+    ])
+    application.on_cleanup.append(_shutdown_pools)
+    return application
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -1,72 +1,776 @@
 import sqlite3
+import hashlib
+import io
+import json
 import os
-import pandas as pd
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from PIL import Image
+from src import blobstore
+from src import dedup
+from src import metrics
 
 # Database connection details 
 DATABASE_FILE = "my_base.db"
+DATABASE_PATH = os.environ.get('DATABASE_PATH', os.path.join(tempfile.gettempdir(), DATABASE_FILE))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+# 'inline' keeps JPEG bytes in images.image_data; 'blob' writes them to the content-addressed
+# blob store and leaves image_data empty. Reads handle both kinds of row.
+IMAGE_STORAGE = os.environ.get('IMAGE_STORAGE', 'inline')
+
+# Applied to every pooled connection. WAL lets readers keep going while an ingest
+# writes; NORMAL sync is durable in WAL mode except on power loss.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA cache_size=-32000;",  # 32 MB page cache per connection
+    "PRAGMA mmap_size=268435456;",  # 256 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA busy_timeout=30000;",
+)
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS images (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        image_data BLOB NOT NULL,
+        label TEXT NOT NULL,
+        data_type TEXT DEFAULT 'train',
+        created_at REAL,
+        content_hash TEXT,
+        width INTEGER,
+        height INTEGER,
+        bbox TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_images_data_type ON images (data_type);
+    CREATE INDEX IF NOT EXISTS idx_images_label ON images (label);
+    CREATE TABLE IF NOT EXISTS sync_segments (
+        key TEXT PRIMARY KEY,
+        applied_at REAL
+    );
+    CREATE TABLE IF NOT EXISTS thumbnails (
+        image_id INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        image_data BLOB NOT NULL,
+        created_at REAL,
+        PRIMARY KEY (image_id, size)
+    );
+"""
+
+# Columns added after the first release, with the statement that adds them to older databases
+MIGRATIONS = (
+    ("images", "created_at", "ALTER TABLE images ADD COLUMN created_at REAL;"),
+    ("images", "content_hash", "ALTER TABLE images ADD COLUMN content_hash TEXT;"),
+    ("images", "width", "ALTER TABLE images ADD COLUMN width INTEGER;"),
+    ("images", "height", "ALTER TABLE images ADD COLUMN height INTEGER;"),
+    ("images", "bbox", "ALTER TABLE images ADD COLUMN bbox TEXT;"),
+    ("images", "phash", "ALTER TABLE images ADD COLUMN phash INTEGER;"),
+    ("images", "duplicate_of", "ALTER TABLE images ADD COLUMN duplicate_of INTEGER;"),
+    ("images", "uid", "ALTER TABLE images ADD COLUMN uid TEXT;"),
+    ("images", "synced", "ALTER TABLE images ADD COLUMN synced INTEGER;"),
+)
+# Indexes on migrated columns, created once the columns exist
+POST_MIGRATION_SCHEMA = """
+    CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images (content_hash);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_images_uid ON images (uid);
+"""
+# uid of a row stored before rows had one. Derived from the id, so copies of the same
+# snapshot agree on it; rows of different nodes with the same id differ by content.
+LEGACY_UID = "'legacy-' || {row}.id || '-' || COALESCE({row}.content_hash, '')"
+
+# Queries used on hot paths. They are constant strings so each pooled connection
+# prepares them once and reuses them from its statement cache.
+SELECT_IMAGE_DATA = "SELECT image_data, content_hash FROM images WHERE id = ?;"
+SELECT_IMAGE_INFO = "SELECT id, length(image_data), created_at, content_hash FROM images WHERE id = ?;"
+SELECT_THUMBNAIL_INFO = "SELECT rowid, length(image_data), created_at FROM thumbnails WHERE image_id = ? AND size = ?;"
+INSERT_IMAGE = ("INSERT INTO images (image_data, label, data_type, created_at, content_hash, width, height, bbox, phash, duplicate_of, uid) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);")
+# Columns a segment carries across nodes, in the order they are copied. Ids are local to
+# each node: rows are matched on `uid`, and `duplicate_of` travels as the target's uid.
+IMAGE_COLUMNS = "image_data, label, data_type, created_at, content_hash, width, height, bbox, phash"
+INSERT_THUMBNAIL = "INSERT OR IGNORE INTO thumbnails (image_id, size, image_data, created_at) VALUES (?, ?, ?, ?);"
+
+class ConnectionPool:
+    """Thread-safe pool of SQLite connections to one database file."""
+
+    def __init__(self, path, max_size=DB_POOL_SIZE, timeout=30.0):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrows a connection; any open transaction is rolled back when it's returned."""
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"Timed out waiting for a connection to {self.path}")
+        waited = time.perf_counter() - start
+        metrics.db_connection_wait_seconds.observe(waited)
+        if waited > 0.001:
+            self.waits += 1
+            self.wait_seconds += waited
 
-def create_table():
-    """Creates the 'images' table if it doesn't exist."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    if conn:
         try:
-            cur = conn.cursor()
-            print("Creating table 'images'...")
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS images (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    image_data BLOB NOT NULL,
-                    label TEXT NOT NULL,
-                    data_type TEXT DEFAULT 'train'
-                );
-            """)
-            conn.commit()
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+            self._slots.release()
+
+    @contextmanager
+    def dedicated(self):
+        """Opens a connection outside the pool, closed on exit, for holders that may take long (e.g. a slow download)."""
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
             conn.close()
-            print("Table 'images' created or already exists.")
-        except sqlite3.Error as e:
-            print(f"Error creating table: {e}")
-    else:
-        print("Could not connect to database")
+
+    def close(self):
+        """Closes idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        return {"path": self.path, "max_size": self.max_size, "idle": self._idle.qsize(),
+                "waits": self.waits, "wait_seconds": round(self.wait_seconds, 6)}
+
+_pools = {}
+_pools_lock = threading.Lock()
+_database_provider = None
+
+def set_database_provider(provider):
+    """Registers a function called with DATABASE_PATH before its pool is opened.
+
+    It fetches the database (e.g. from S3) if it doesn't exist locally, or catches up an existing copy.
+    """
+    global _database_provider
+    _database_provider = provider
+
+def apply_schema(conn):
+    """Creates missing tables and indexes and adds columns missing from older databases."""
+    conn.executescript(SCHEMA)
+    for table, column, statement in MIGRATIONS:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table});")}
+        if column not in columns:
+            conn.execute(statement)
+    conn.executescript(POST_MIGRATION_SCHEMA)
+    conn.execute(f"UPDATE images SET uid = {LEGACY_UID.format(row='images')} WHERE uid IS NULL;")
+    conn.commit()
+
+def get_pool(database_file=None):
+    """Returns the shared pool for a database file (DATABASE_PATH by default), creating it on first use."""
+    path = os.path.abspath(database_file or DATABASE_PATH)
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            if path == os.path.abspath(DATABASE_PATH) and _database_provider is not None:
+                _database_provider(path)
+            pool = ConnectionPool(path)
+            with pool.connection() as conn:
+                apply_schema(conn)
+            _pools[path] = pool
+        return pool
+
+def pool_is_open(database_file=None):
+    """True once the pool for a database file exists, i.e. using it won't fetch the database first."""
+    with _pools_lock:
+        return os.path.abspath(database_file or DATABASE_PATH) in _pools
+
+def pools():
+    """Returns the pools opened so far, e.g. to report their wait counters."""
+    with _pools_lock:
+        return list(_pools.values())
+
+def connection(database_file=None):
+    """Context manager yielding a pooled connection to `database_file` (DATABASE_PATH by default)."""
+    return get_pool(database_file).connection()
+
+def checkpoint(database_file=None):
+    """Folds the WAL back into the main database file, e.g. before copying or uploading it."""
+    with connection(database_file) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+def max_image_id(database_file=None):
+    """Returns the highest image id stored, or 0 for an empty table."""
+    with connection(database_file) as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM images;").fetchone()[0]
+
+def snapshot(dest_path, database_file=None):
+    """Writes a consistent, self-contained copy of the whole database to `dest_path` using the online backup API.
+
+    Returns the highest image id in the copy.
+    """
+    with connection(database_file) as conn:
+        dest = sqlite3.connect(dest_path)
+        try:
+            conn.backup(dest)
+            dest.execute("PRAGMA journal_mode=DELETE;")
+            inline_blob_rows(dest)
+            return dest.execute("SELECT COALESCE(MAX(id), 0) FROM images;").fetchone()[0]
+        finally:
+            dest.close()
+
+def export_unsynced_images(dest_path, up_to_id, database_file=None):
+    """Copies the rows with id <= up_to_id that S3 doesn't have yet into a standalone segment database.
+
+    Rows kept in the blob store get their bytes copied in, so segments are self-contained.
+
+    Returns the number of rows written.
+    """
+    with connection(database_file) as conn:
+        conn.execute("ATTACH DATABASE ? AS segment;", (dest_path,))
+        try:
+            conn.execute(
+                "CREATE TABLE segment.images (id INTEGER PRIMARY KEY, image_data BLOB NOT NULL, label TEXT NOT NULL, "
+                "data_type TEXT, created_at REAL, content_hash TEXT, width INTEGER, height INTEGER, bbox TEXT, "
+                "phash INTEGER, uid TEXT NOT NULL, duplicate_of_uid TEXT);"
+            )
+            cur = conn.execute(
+                f"INSERT INTO segment.images SELECT id, {IMAGE_COLUMNS}, uid, "
+                "(SELECT target.uid FROM main.images target WHERE target.id = images.duplicate_of) "
+                "FROM main.images WHERE synced IS NULL AND id <= ?;",
+                (up_to_id,),
+            )
+            rows = cur.rowcount
+            inline_blob_rows(conn, 'segment')
+            conn.commit()
+            return rows
+        finally:
+            conn.execute("DETACH DATABASE segment;")
+
+def mark_synced(up_to_id, database_file=None):
+    """Records that S3 now has every row with id <= up_to_id."""
+    with connection(database_file) as conn:
+        with conn:
+            conn.execute("UPDATE images SET synced = 1 WHERE synced IS NULL AND id <= ?;", (up_to_id,))
+
+def applied_segments(conn):
+    """Returns the keys of the snapshots and segments merged into (or uploaded from) a database."""
+    return {row[0] for row in conn.execute("SELECT key FROM sync_segments;")}
+
+def record_segments(conn, keys):
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO sync_segments (key, applied_at) VALUES (?, ?);",
+                         [(key, time.time()) for key in keys])
+
+def merge_segment(conn, segment_path):
+    """Merges the rows of a segment (or snapshot) on `conn`, skipping rows whose uid is already present.
+
+    Rows get new local ids; links to duplicates are re-pointed through the
+    target's uid. Takes a plain connection so it can also build a database
+    before it is pooled. Returns the number of rows added.
+    """
+    conn.execute("ATTACH DATABASE ? AS segment;", (segment_path,))
+    try:
+        # Segments written before a column was added simply leave it NULL
+        present = {row[1] for row in conn.execute("PRAGMA segment.table_info(images);")}
+        columns = ", ".join(column for column in IMAGE_COLUMNS.split(", ") if column in present)
+        if 'uid' in present:
+            source_uid = "source.uid"
+            conn.execute("CREATE INDEX IF NOT EXISTS segment.idx_segment_uid ON images (uid);")
+        else:
+            source_uid = LEGACY_UID.format(row='source')
+        link = 'duplicate_of_uid' if 'duplicate_of_uid' in present else 'duplicate_of'
+        if link == 'duplicate_of_uid':
+            target_uid = "source.duplicate_of_uid"
+        else:
+            # Snapshots carry the whole table, so the target row is in the same file
+            target_uid = f"(SELECT {LEGACY_UID.format(row='target') if 'uid' not in present else 'target.uid'} " \
+                         "FROM segment.images target WHERE target.id = source.duplicate_of)"
+        first_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM main.images;").fetchone()[0] + 1
+        with conn:
+            cur = conn.execute(
+                f"INSERT OR IGNORE INTO main.images ({columns}, uid, synced) "
+                f"SELECT {', '.join('source.' + column for column in columns.split(', '))}, {source_uid}, 1 "
+                "FROM segment.images source ORDER BY source.id;"
+            )
+            added = cur.rowcount
+            # Second pass, so links to rows earlier in the same segment resolve too
+            conn.execute(
+                f"UPDATE main.images SET duplicate_of = (SELECT target.id FROM main.images target WHERE target.uid = "
+                f"(SELECT {target_uid} FROM segment.images source WHERE {source_uid} = main.images.uid)) "
+                f"WHERE id >= ? AND uid IN (SELECT {source_uid} FROM segment.images source WHERE source.{link} IS NOT NULL);",
+                (first_id,),
+            )
+    finally:
+        conn.execute("DETACH DATABASE segment;")
+    if IMAGE_STORAGE == 'blob':
+        move_rows_to_blob_store(conn)
+    return added
+
+def create_table(database_file=None):
+    """Creates the 'images' table and its indexes if they don't exist."""
+    try:
+        print("Creating table 'images'...")
+        with connection(database_file) as conn:
+            apply_schema(conn)
+        print("Table 'images' created or already exists.")
+    except sqlite3.Error as e:
+        print(f"Error creating table: {e}")
 #create_table()
 
-def insert_image_data(image_path, label):
+def resolve_image_data(image_data, content_hash):
+    """Returns an image's bytes, reading them from the blob store when the row only holds the hash."""
+    if image_data or not content_hash:
+        return image_data
+    return blobstore.get_blob_store().get(content_hash)
+
+def image_values(image_data, label, data_type, created_at, meta=None):
+    """Builds the INSERT_IMAGE parameters for one image, writing its bytes to the blob store in blob mode.
+
+    `meta` may carry width/height/bbox from the annotations and, when the caller
+    already computed them, content_hash, phash and duplicate_of. Each row gets
+    a random uid that identifies it on every node it is synced to.
+    """
+    meta = meta or {}
+    content_hash = meta.get('content_hash') or hashlib.sha256(image_data).hexdigest()
+    phash = meta['phash'] if 'phash' in meta else dedup.dhash(image_data)
+    if IMAGE_STORAGE == 'blob':
+        blobstore.get_blob_store().put(image_data, content_hash)
+        image_data = b''
+    return (sqlite3.Binary(image_data), label, data_type, created_at, content_hash,
+            meta.get('width'), meta.get('height'), meta.get('bbox'), dedup.to_sqlite(phash), meta.get('duplicate_of'),
+            uuid.uuid4().hex)
+
+def inline_blob_rows(conn, schema='main'):
+    """Copies blob-store bytes back into rows of `schema`.images that only hold a hash."""
+    store = blobstore.get_blob_store()
+    rows = conn.execute(f"SELECT id, content_hash FROM {schema}.images WHERE length(image_data) = 0 AND content_hash IS NOT NULL;").fetchall()
+    for image_id, content_hash in rows:
+        conn.execute(f"UPDATE {schema}.images SET image_data = ? WHERE id = ?;", (sqlite3.Binary(store.get(content_hash)), image_id))
+    conn.commit()
+    return len(rows)
+
+def move_rows_to_blob_store(conn, chunk_size=200):
+    """Moves inline image bytes into the blob store, keeping hash and dimensions in the row.
+
+    Works on a plain connection; returns counts of rows moved, bytes freed and duplicates.
+    """
+    store = blobstore.get_blob_store()
+    moved = freed = duplicates = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, image_data, content_hash, width, height FROM images WHERE length(image_data) > 0 LIMIT ?;",
+            (chunk_size,),
+        ).fetchall()
+        if not rows:
+            break
+        updates = []
+        for image_id, image_data, content_hash, width, height in rows:
+            content_hash = content_hash or store.hash(image_data)
+            if content_hash in store:
+                duplicates += 1
+            store.put(image_data, content_hash)
+            if width is None or height is None:
+                try:
+                    width, height = Image.open(io.BytesIO(image_data)).size
+                except Exception as e:
+                    print(f"Could not read dimensions of image {image_id}: {e}")
+            updates.append((content_hash, width, height, image_id))
+            freed += len(image_data)
+        with conn:
+            conn.executemany("UPDATE images SET image_data = X'', content_hash = ?, width = ?, height = ? WHERE id = ?;", updates)
+        moved += len(updates)
+    return {"rows": moved, "bytes": freed, "duplicates": duplicates}
+
+def move_images_to_blob_store(database_file=None, chunk_size=200, vacuum=True):
+    """Migrates an existing database to blob storage, then VACUUMs so the file actually shrinks."""
+    start = time.perf_counter()
+    with connection(database_file) as conn:
+        stats = move_rows_to_blob_store(conn, chunk_size)
+        if vacuum:
+            conn.execute("VACUUM;")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    print(f"Moved {stats['rows']} images ({stats['bytes']} bytes, {stats['duplicates']} duplicates) to the blob store")
+    return stats
+
+def get_image_data(image_id, database_file=None):
+    """Returns the raw bytes of one image, or None if there is no such row."""
+    with connection(database_file) as conn:
+        row = conn.execute(SELECT_IMAGE_DATA, (image_id,)).fetchone()
+    return resolve_image_data(*row) if row else None
+
+def get_image_info(image_id, database_file=None):
+    """Returns (rowid, size_in_bytes, created_at) for an image without reading its data, or None."""
+    with connection(database_file) as conn:
+        row = conn.execute(SELECT_IMAGE_INFO, (image_id,)).fetchone()
+    if row is None:
+        return None
+    rowid, length, created_at, content_hash = row
+    if length == 0 and content_hash:
+        try:
+            length = blobstore.get_blob_store().size(content_hash)
+        except OSError as e:
+            print(f"Error reading blob {content_hash} for image {image_id}: {e}")
+            return None
+    return rowid, length, created_at
+
+@contextmanager
+def open_blob(table, rowid, database_file=None, dedicated=False):
+    """Opens the image_data BLOB of one row for incremental, read-only access.
+
+    Yields a file-like object with `read(n)`; the connection (a pooled one, or
+    with `dedicated=True` one of its own) is held until the context exits.
+    Images kept in the blob store are read from their file.
+    """
+    if table == 'images':
+        with connection(database_file) as conn:
+            row = conn.execute("SELECT length(image_data), content_hash FROM images WHERE rowid = ?;", (rowid,)).fetchone()
+        if row and row[0] == 0 and row[1]:
+            with blobstore.get_blob_store().open(row[1]) as f:
+                yield f
+            return
+
+    pool = get_pool(database_file)
+    with pool.dedicated() if dedicated else pool.connection() as conn:
+        if hasattr(conn, 'blobopen'):  # Python 3.11+
+            with conn.blobopen(table, 'image_data', rowid, readonly=True) as blob:
+                yield blob
+        else:
+            row = conn.execute(f"SELECT image_data FROM {table} WHERE rowid = ?;", (rowid,)).fetchone()
+            yield io.BytesIO(row[0])
+
+def make_thumbnail(image_data, size, quality=85):
+    """Returns JPEG bytes of the image scaled to fit within size x size."""
+    img = Image.open(io.BytesIO(image_data))
+    img.draft('RGB', (size, size))
+    img = img.convert('RGB')
+    img.thumbnail((size, size))
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+def get_thumbnail_info(image_id, size, database_file=None):
+    """Returns (rowid, size_in_bytes, created_at) of a stored thumbnail, generating it on first request.
+
+    Returns None if the image doesn't exist.
+    """
+    with connection(database_file) as conn:
+        row = conn.execute(SELECT_THUMBNAIL_INFO, (image_id, size)).fetchone()
+        if row:
+            return row
+        image_row = conn.execute(SELECT_IMAGE_DATA, (image_id,)).fetchone()
+    if image_row is None:
+        return None
+
+    thumbnail = make_thumbnail(resolve_image_data(*image_row), size)
+    with connection(database_file) as conn:
+        with conn:
+            conn.execute(INSERT_THUMBNAIL, (int(image_id), size, sqlite3.Binary(thumbnail), time.time()))
+        return conn.execute(SELECT_THUMBNAIL_INFO, (image_id, size)).fetchone()
+
+def generate_thumbnails(size, database_file=None, chunk_size=200):
+    """Pre-generates thumbnails of one size for every image that doesn't have one yet."""
+    start = time.perf_counter()
+    total = 0
+    while True:
+        with connection(database_file) as conn:
+            rows = conn.execute(
+                "SELECT i.id, i.image_data, i.content_hash FROM images i LEFT JOIN thumbnails t ON t.image_id = i.id AND t.size = ? "
+                "WHERE t.image_id IS NULL LIMIT ?;",
+                (size, chunk_size),
+            ).fetchall()
+        if not rows:
+            break
+        thumbnails = [(image_id, size, sqlite3.Binary(make_thumbnail(resolve_image_data(image_data, content_hash), size)), time.time())
+                      for image_id, image_data, content_hash in rows]
+        with connection(database_file) as conn:
+            with conn:
+                conn.executemany(INSERT_THUMBNAIL, thumbnails)
+        total += len(thumbnails)
+    print(f"Generated {total} thumbnails of {size}px in {time.perf_counter() - start:.2f}s")
+    return total
+
+def insert_image_data(image_path, label, data_type='train', database_file=None):
     """Inserts image data and label into the database."""
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cur = conn.cursor()
-
         # Read image data as bytes
         with open(image_path, 'rb') as image_file:
             image_data = image_file.read()
 
         # Insert data into the 'images' table
-        cur.execute("INSERT INTO images (image_data, label) VALUES (?, ?);", (sqlite3.Binary(image_data), label))
-
-        conn.commit()
-        cur.close()
-        conn.close()
+        with connection(database_file) as conn:
+            with conn:
+                conn.execute(INSERT_IMAGE, image_values(image_data, label, data_type, time.time()))
         print(f"Image '{image_path}' inserted successfully.")
 
     except sqlite3.Error as e:
         print(f"Error inserting image: {e}")
 
-def populate_database_from_csv(csv_path, images_dir):
-    """Populates the database using a CSV and images directory."""
-    try:
-        df = pd.read_csv(csv_path)
+ANNOTATION_COLUMNS = ('filename', 'width', 'height', 'class', 'xmin', 'ymin', 'xmax', 'ymax')
+
+def _read_annotations(csv_file):
+    import pandas as pd  # imported lazily to keep app startup fast
+    return pd.read_csv(csv_file, usecols=lambda column: column in ANNOTATION_COLUMNS).to_dict('records')
 
-        for index, row in df.iterrows():
-            image_filename = row['filename']
-            label = row['class']
-            image_path = os.path.join(images_dir, image_filename)
+def annotation_meta(row):
+    """Returns the width/height and bounding box of one annotations row, where the CSV has them."""
+    meta = {}
+    if 'width' in row and 'height' in row:
+        meta['width'], meta['height'] = int(row['width']), int(row['height'])
+    if all(key in row for key in ('xmin', 'ymin', 'xmax', 'ymax')):
+        meta['bbox'] = json.dumps([int(row[key]) for key in ('xmin', 'ymin', 'xmax', 'ymax')])
+    return meta
+
+def iter_csv_images(csv_path, images_dir):
+    """Yields (image_bytes, label, meta) for each row of an annotations CSV."""
+    for row in _read_annotations(csv_path):
+        image_path = os.path.join(images_dir, row['filename'])
+        if not os.path.exists(image_path):
+            print(f"Warning: Image '{image_path}' not found.")
+            continue
+        with open(image_path, 'rb') as image_file:
+            yield image_file.read(), row['class'], annotation_meta(row)
 
-            if os.path.exists(image_path):
-                insert_image_data(image_path, label)
-            else:
-                print(f"Warning: Image '{image_path}' not found.")
+def find_annotations_member(zip_ref):
+    """Returns the shallowest _annotations.csv member in a zip archive, or None."""
+    candidates = [name for name in zip_ref.namelist() if os.path.basename(name) == '_annotations.csv']
+    if not candidates:
+        return None
+    return min(candidates, key=lambda name: name.count('/'))
 
+def iter_zip_images(zip_ref):
+    """Yields (image_bytes, label, meta) straight from a zip with images/ and _annotations.csv, without extracting."""
+    csv_member = find_annotations_member(zip_ref)
+    if csv_member is None:
+        raise ValueError("Missing _annotations.csv in zip file")
+
+    prefix = os.path.dirname(csv_member)
+    members = set(zip_ref.namelist())
+    with zip_ref.open(csv_member) as csv_file:
+        rows = _read_annotations(csv_file)
+
+    for row in rows:
+        member = '/'.join(part for part in (prefix, 'images', row['filename']) if part)
+        if member not in members:
+            print(f"Warning: Image '{member}' not found in zip file.")
+            continue
+        yield zip_ref.read(member), row['class'], annotation_meta(row)
+
+_duplicate_indexes = {}
+_duplicate_indexes_lock = threading.Lock()
+# Seconds a lookup-only caller (e.g. /predict_upload) may use the index before picking up new rows
+DEDUP_REFRESH_SECONDS = float(os.environ.get('DEDUP_REFRESH_SECONDS', 5))
+
+def backfill_perceptual_hashes(conn, chunk_size=200):
+    """Computes the dHash of rows stored before the phash column existed.
+
+    Returns a list of (image_id, phash) for the rows it filled in.
+    """
+    filled = []
+    while True:
+        rows = conn.execute("SELECT id, image_data, content_hash FROM images WHERE phash IS NULL AND id > ? ORDER BY id LIMIT ?;",
+                            (filled[-1][0] if filled else 0, chunk_size)).fetchall()
+        if not rows:
+            return filled
+        hashes = [(image_id, dedup.dhash(resolve_image_data(image_data, content_hash))) for image_id, image_data, content_hash in rows]
+        with conn:
+            conn.executemany("UPDATE images SET phash = ? WHERE id = ?;",
+                             [(dedup.to_sqlite(phash), image_id) for image_id, phash in hashes if phash is not None])
+        filled.extend(hashes)
+
+def _refresh_duplicate_index(conn, index, backfill, data_type=None):
+    with index.lock:
+        if backfill:
+            for image_id, phash in backfill_perceptual_hashes(conn):
+                index.set_phash(image_id, phash)
+        # Images are only ever inserted, so rows past the last id seen are all that's new.
+        # Rows linked to another image are found through that one.
+        query = "SELECT id, content_hash, phash, label FROM images WHERE id > ? AND duplicate_of IS NULL"
+        params = (index.last_id,)
+        if data_type is not None:
+            query, params = query + " AND data_type = ?", params + (data_type,)
+        rows = conn.execute(query + " ORDER BY id;", params).fetchall()
+        for image_id, content_hash, phash, label in rows:
+            index.add(image_id, content_hash, dedup.from_sqlite(phash), label)
+        index.last_id = max(index.last_id, conn.execute("SELECT COALESCE(MAX(id), 0) FROM images;").fetchone()[0])
+        index.refreshed_at = time.monotonic()
+
+def duplicate_index(conn, database_file=None, backfill=False, max_age=0.0, data_type=None):
+    """Returns this process's DuplicateIndex for a database, updated with rows added since it was last read.
+
+    With `backfill`, rows without a perceptual hash get one first (ingest does
+    this; plain lookups only need the exact hashes every row already has).
+    With `data_type`, only rows of that type are indexed.
+    """
+    key = (os.path.abspath(database_file or DATABASE_PATH), data_type)
+    with _duplicate_indexes_lock:
+        index = _duplicate_indexes.get(key)
+        if index is None:
+            index = _duplicate_indexes[key] = dedup.DuplicateIndex()
+    if backfill or time.monotonic() - index.refreshed_at >= max_age:
+        _refresh_duplicate_index(conn, index, backfill, data_type)
+    return index
+
+def find_library_image(content_hash, database_file=None):
+    """Returns (image_id, label) of a stored image with exactly this sha256, or None."""
+    with connection(database_file) as conn:
+        index = duplicate_index(conn, database_file, max_age=DEDUP_REFRESH_SECONDS)
+    return index.exact(content_hash)
+
+def duplicate_report(database_file=None, max_distance=dedup.DEDUP_MAX_DISTANCE):
+    """Counts the stored images that duplicate an earlier one, exactly or within `max_distance` bits."""
+    with connection(database_file) as conn:
+        backfill_perceptual_hashes(conn)
+        rows = conn.execute("SELECT id, content_hash, phash, label FROM images WHERE duplicate_of IS NULL ORDER BY id;").fetchall()
+        linked = conn.execute("SELECT COUNT(*) FROM images WHERE duplicate_of IS NOT NULL;").fetchone()[0]
+    index = dedup.DuplicateIndex(max_distance)
+    counts = {"exact": 0, "near": 0, "label_conflicts": 0}
+    for image_id, content_hash, phash, label in rows:
+        match = index.match(content_hash, dedup.from_sqlite(phash))
+        if match is not None:
+            counts[match[0]] += 1
+            counts["label_conflicts"] += match[2] != label
+        index.add(image_id, content_hash, dedup.from_sqlite(phash), label)
+    total = len(rows) + linked
+    duplicates = counts["exact"] + counts["near"] + linked
+    return dict(counts, images=total, linked=linked, dedup_ratio=round(duplicates / total, 4) if total else 0.0)
+
+def bulk_insert_images(records, data_type='train', database_file=None, chunk_size=500, dedup_mode=None):
+    """Inserts (image_bytes, label[, meta]) records with executemany, one transaction per chunk.
+
+    Each image is first checked against the stored images of the same
+    data_type and the rest of the upload: exact (sha256) and near (dHash)
+    duplicates with the same label are linked or skipped according to
+    `dedup_mode` (DEDUP_MODE by default). Duplicates with a different label are
+    inserted and counted as conflicts.
+
+    Returns a dict with the number of rows inserted, elapsed seconds, rows/sec and duplicate counts.
+    """
+    dedup_mode = dedup_mode or dedup.DEDUP_MODE
+    if dedup_mode not in ('skip', 'link', 'off'):
+        raise ValueError(f"Unknown dedup mode {dedup_mode!r}")
+    start = time.perf_counter()
+    total = seen = 0
+    duplicates = {"exact": 0, "near": 0, "label_conflicts": 0}
+    created_at = time.time()
+    stage = metrics.ingest_stage_seconds
+    duplicates_total = metrics.counter("ingest_duplicates_total", "Ingested images found to duplicate a library image.",
+                                       ["kind", "action"])
+    # Reading covers unpacking and annotation lookup; prepare covers hashing (and blob writes)
+    read_seconds = prepare_seconds = dedup_seconds = 0.0
+    with connection(database_file) as conn:
+        # Scoped to the data_type: a retrain upload must not lose rows that also exist as 'train'
+        index = duplicate_index(conn, database_file, backfill=True, data_type=data_type) if dedup_mode != 'off' else None
+        chunk = []
+        # Images of the current chunk have no id yet; they are indexed by position until it is inserted
+        pending = dedup.DuplicateIndex(index.max_distance) if index is not None else None
+        links = []
+        records = iter(records)
+
+        def insert_chunk():
+            with stage.time(stage="insert"), conn:  # commits the chunk, rolls back on error
+                conn.executemany(INSERT_IMAGE, chunk)
+                # AUTOINCREMENT ids of one transaction are consecutive
+                first_id = conn.execute("SELECT MAX(id) FROM images;").fetchone()[0] - len(chunk) + 1
+                if links:
+                    conn.executemany("UPDATE images SET duplicate_of = ? WHERE id = ?;",
+                                     [(first_id + target, first_id + position) for position, target in links])
+            if index is not None:
+                linked = {position for position, _ in links}
+                for position, values in enumerate(chunk):
+                    if values[9] is None and position not in linked:
+                        index.add(first_id + position, values[4], dedup.from_sqlite(values[8]), values[1])
+
+        while True:
+            mark = time.perf_counter()
+            record = next(records, None)
+            read_seconds += time.perf_counter() - mark
+            if record is None:
+                break
+            image_data, label, *meta = record
+            meta = dict(meta[0]) if meta and meta[0] else {}
+            seen += 1
+
+            if index is not None:
+                mark = time.perf_counter()
+                meta['content_hash'] = hashlib.sha256(image_data).hexdigest()
+                meta['phash'] = dedup.dhash(image_data)
+                match = index.match(meta['content_hash'], meta['phash'])
+                in_chunk = pending.match(meta['content_hash'], meta['phash'])
+                if in_chunk is not None and (match is None or in_chunk[3] < match[3]):
+                    match = in_chunk
+                dedup_seconds += time.perf_counter() - mark
+                if match is not None:
+                    kind, matched_id, matched_label, _ = match
+                    if matched_label != label:
+                        duplicates["label_conflicts"] += 1
+                        match = None
+                    else:
+                        duplicates[kind] += 1
+                        duplicates_total.inc(kind=kind, action=dedup_mode)
+                        if dedup_mode == 'skip':
+                            continue
+                        if match is in_chunk:
+                            links.append((len(chunk), matched_id))
+                        else:
+                            meta['duplicate_of'] = matched_id
+                if match is None:
+                    pending.add(len(chunk), meta['content_hash'], meta['phash'], label)
+
+            mark = time.perf_counter()
+            chunk.append(image_values(image_data, label, data_type, created_at, meta))
+            prepare_seconds += time.perf_counter() - mark
+            if len(chunk) >= chunk_size:
+                insert_chunk()
+                total += len(chunk)
+                chunk, links = [], []
+                if pending is not None:
+                    pending = dedup.DuplicateIndex(index.max_distance)
+                stage.observe(read_seconds, stage="read")
+                stage.observe(prepare_seconds, stage="prepare")
+                stage.observe(dedup_seconds, stage="dedup")
+                read_seconds = prepare_seconds = dedup_seconds = 0.0
+        if chunk:
+            insert_chunk()
+            total += len(chunk)
+            stage.observe(read_seconds, stage="read")
+            stage.observe(prepare_seconds, stage="prepare")
+            stage.observe(dedup_seconds, stage="dedup")
+    metrics.counter("ingested_images_total", "Images inserted into the database.", ["data_type"]).inc(total, data_type=data_type)
+
+    elapsed = time.perf_counter() - start
+    rows_per_sec = total / elapsed if elapsed > 0 else 0.0
+    found = duplicates["exact"] + duplicates["near"]
+    print(f"Inserted {total} '{data_type}' images in {elapsed:.2f}s ({rows_per_sec:.0f} rows/sec); "
+          f"{found} of {seen} were duplicates ({duplicates['exact']} exact, {duplicates['near']} near), {dedup_mode}")
+    return {"rows": total, "seconds": elapsed, "rows_per_sec": rows_per_sec,
+            "dedup": dict(duplicates, mode=dedup_mode, images=seen, ratio=round(found / seen, 4) if seen else 0.0)}
+
+def populate_database_from_csv(csv_path, images_dir, data_type='train'):
+    """Populates the database using a CSV and images directory."""
+    try:
+        return bulk_insert_images(iter_csv_images(csv_path, images_dir), data_type)
     except Exception as e:
         print(f"Error populating database from CSV: {e}")
+        return None
 
 # # Example usage 
 # train_csv_path = "dataset/train/_annotations.csv"
@@ -79,6 +783,8 @@ def populate_database_from_csv(csv_path, images_dir):
 # valid_images_dir = "dataset/valid/images"
 
 # populate_database_from_csv(train_csv_path, train_images_dir)
-# populate_database_from_csv(test_csv_path, test_images_dir)
-# populate_database_from_csv(valid_csv_path, valid_images_dir)
+# populate_database_from_csv(test_csv_path, test_images_dir, 'test')
+# populate_database_from_csv(valid_csv_path, valid_images_dir, 'valid')
 
+# # Pre-generate gallery thumbnails
+# generate_thumbnails(256)
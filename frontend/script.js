@@ -33,7 +33,7 @@ document.addEventListener('DOMContentLoaded', () => {
         selectedImage = imageNumber.value;
         imageUpload.value = "";
         if (selectedImage) {
-            fetch(`http://127.0.0.1:5000/image/${selectedImage}`) // Updated fetch
+            fetch(`http://127.0.0.1:5000/image/${selectedImage}?size=256`) // Updated fetch
                 .then(response => response.blob())
                 .then(blob => {
                     previewImage.src = URL.createObjectURL(blob);
@@ -164,7 +164,7 @@ document.addEventListener('DOMContentLoaded', () => {
             })
                 .then(response => response.json())
                 .then(data => {
-                    if (data.status === 'completed' || data.status === 'failed') {
+                    if (data.status === 'completed' || data.status === 'failed' || data.status === 'cancelled') {
                         clearInterval(intervalId);
                         alert(data.message);
                         if (data.metrics && data.metrics.metrics_table) {
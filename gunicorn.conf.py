@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+# Import the app, TensorFlow and the model file once in the master so workers
+# share those pages copy-on-write. The TF runtime itself isn't fork-safe, so each
+# worker deserializes and warms up the model after fork (MODEL_LOADING=deferred).
+os.environ.setdefault('MODEL_LOADING', 'deferred')
+preload_app = True
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+# Threaded workers so concurrent requests can share micro-batches
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 120
+
+def post_fork(server, worker):
+    from src import storage
+    import app
+
+    storage.reset_s3_client()
+    app.start_model_loading()
+
+# With INFERENCE_SOCKET set, workers send predictions to one inference server
+# process that holds the only copy of the model. gunicorn starts it unless
+# INFERENCE_SERVER=external (e.g. it runs as its own service).
+_inference_process = None
+
+def on_starting(server):
+    global _inference_process
+    if os.environ.get('INFERENCE_SOCKET') and os.environ.get('INFERENCE_SERVER', 'spawn') == 'spawn':
+        _inference_process = subprocess.Popen([sys.executable, '-m', 'src.inference_server'])
+
+def on_exit(server):
+    if _inference_process is not None:
+        _inference_process.terminate()
+        _inference_process.wait(timeout=30)
@@ -0,0 +1,144 @@
+import queue
+import threading
+from concurrent.futures import Future
+import time
+import numpy as np
+from . import metrics
+
+batch_size_histogram = metrics.histogram("batch_size", "Images per forward pass run by the micro-batcher.",
+                                         buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+class QueueFullError(Exception):
+    """Raised when the batcher cannot accept more requests."""
+
+class _PendingRequest:
+    """A single image waiting for its slot in a batch."""
+
+    __slots__ = ("image", "done", "result", "error", "queued_at", "future")
+
+    def __init__(self, image, future=None):
+        self.image = image
+        self.queued_at = time.perf_counter()
+        self.future = future
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher:
+    """Collects concurrent single-image requests and runs them as one forward pass."""
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5.0, max_queue_size=256,
+                 enqueue_timeout=0.5, result_timeout=30.0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.enqueue_timeout = enqueue_timeout
+        self.result_timeout = result_timeout
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def _ensure_started(self):
+        """Starts the worker thread on first use (and again in a forked child, where it doesn't survive)."""
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    def _enqueue(self, pending, timeout):
+        if self._stopped.is_set():
+            raise RuntimeError("Batcher is stopped")
+        self._ensure_started()
+        try:
+            # Bounded queue: when inference can't keep up, callers are turned away
+            # instead of piling up requests the model will never get to in time.
+            self._queue.put(pending, timeout=timeout)
+        except queue.Full:
+            raise QueueFullError(f"Prediction queue is full ({self._queue.maxsize} pending)")
+
+    def submit(self, image):
+        """Queues one preprocessed image and blocks until its prediction is ready."""
+        pending = _PendingRequest(image)
+        self._enqueue(pending, self.enqueue_timeout)
+
+        if not pending.done.wait(self.result_timeout):
+            raise TimeoutError("Timed out waiting for prediction")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def submit_future(self, image):
+        """Queues one preprocessed image without blocking and returns a Future for its prediction.
+
+        For event loops (wrap it with `asyncio.wrap_future`): nothing waits on a
+        thread, and a full queue raises QueueFullError right away.
+        """
+        pending = _PendingRequest(image, Future())
+        self._enqueue(pending, 0)
+        return pending.future
+
+    def queue_depth(self):
+        """Returns the number of requests waiting to be batched."""
+        return self._queue.qsize()
+
+    def stop(self):
+        """Stops the worker thread once the current batch finishes."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.max_wait + 1.0)
+
+    def _collect_batch(self):
+        """Blocks for the first request, then gathers more until full or the wait expires."""
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    # Still take whatever is already queued, just don't wait for more.
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # Futures cancelled while queued (e.g. an awaiting request timed out) are
+            # dropped; the rest can no longer be cancelled once marked running.
+            batch = [pending for pending in self._collect_batch()
+                     if pending.future is None or pending.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            for pending in batch:
+                metrics.predict_stage_seconds.observe(started - pending.queued_at, stage="queue_wait")
+            batch_size_histogram.observe(len(batch))
+            try:
+                images = np.stack([pending.image for pending in batch])
+                with metrics.predict_stage_seconds.time(stage="model"):
+                    results = self.predict_fn(images)
+                if results is None or len(results) != len(batch):
+                    raise RuntimeError("Batch prediction failed")
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception as e:
+                print(f"Error running prediction batch of {len(batch)}: {e}")
+                for pending in batch:
+                    pending.error = e
+            finally:
+                for pending in batch:
+                    pending.done.set()
+                    if pending.future is not None:
+                        if pending.error is not None:
+                            pending.future.set_exception(pending.error)
+                        else:
+                            pending.future.set_result(pending.result)
@@ -0,0 +1,351 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import urllib.request
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS
+    resource = None
+
+DATASET_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset")
+
+def rss_mb():
+    """Current resident memory of this process in MB (Linux), or None."""
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return round(peak / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+
+def build_standin_model(path, num_classes=2, input_shape=(128, 128, 3)):
+    """Saves an untrained model with the production architecture (see the notebook) to `path`.
+
+    Its predictions are meaningless, but its cost per image matches the real model,
+    so benchmarks run without S3 or a trained artifact.
+    """
+    import tensorflow as tf
+    keras_model = tf.keras.Sequential([
+        tf.keras.layers.Input(shape=input_shape),
+        tf.keras.layers.Conv2D(32, (3, 3), activation='relu'),
+        tf.keras.layers.MaxPooling2D((2, 2)),
+        tf.keras.layers.Conv2D(64, (3, 3), activation='relu'),
+        tf.keras.layers.MaxPooling2D((2, 2)),
+        tf.keras.layers.Conv2D(128, (3, 3), activation='relu'),
+        tf.keras.layers.MaxPooling2D((2, 2)),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(256, activation='relu'),
+        tf.keras.layers.Dropout(0.5),
+        tf.keras.layers.Dense(num_classes, activation='softmax'),
+    ])
+    keras_model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    keras_model.save(path)
+    return path
+
+def dataset_images(split="valid", limit=64):
+    """Returns up to `limit` image paths from a bundled dataset split."""
+    images_dir = os.path.join(DATASET_DIR, split, "images")
+    names = sorted(name for name in os.listdir(images_dir) if name.lower().endswith((".jpg", ".jpeg", ".png")))
+    return [os.path.join(images_dir, name) for name in names[:limit]]
+
+def run_case(name, call, requests=200, concurrency=1, items_per_call=1, warmup=5):
+    """Calls `call(i)` `requests` times from `concurrency` threads and returns throughput and latency stats.
+
+    A call that raises or returns False counts as an error.
+    """
+    for i in range(warmup):
+        call(i)
+    latencies = []
+    errors = []
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                error = None if call(i) is not False else "failed"
+            except Exception as e:
+                error = str(e)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if error:
+                    errors.append(error)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies = np.asarray(latencies)
+    result = {
+        "name": name,
+        "concurrency": concurrency,
+        "calls": len(latencies),
+        "items": len(latencies) * items_per_call,
+        "errors": len(errors),
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) * items_per_call / seconds, 2) if seconds > 0 else 0.0,
+        "latency_ms": {
+            "p50": round(float(np.percentile(latencies, 50)), 2),
+            "p95": round(float(np.percentile(latencies, 95)), 2),
+            "p99": round(float(np.percentile(latencies, 99)), 2),
+            "mean": round(float(latencies.mean()), 2),
+            "max": round(float(latencies.max()), 2),
+        },
+        "rss_mb": rss_mb(),
+    }
+    if errors:
+        result["first_error"] = errors[0]
+    print(f"{name:<40} {result['throughput']:>9.1f}/s  p50 {result['latency_ms']['p50']:>8.2f} ms  "
+          f"p95 {result['latency_ms']['p95']:>8.2f} ms  p99 {result['latency_ms']['p99']:>8.2f} ms  errors {len(errors)}")
+    return result
+
+def bench_preprocessing(images, batch_sizes, args):
+    from . import preprocessing
+    blobs = []
+    for path in images:
+        with open(path, "rb") as f:
+            blobs.append(f.read())
+    results = [run_case("preprocess_image", lambda i: preprocessing.preprocess_image(blobs[i % len(blobs)]) is not None,
+                        args.requests, 1)]
+    for size in batch_sizes:
+        batches = [[blobs[(start + j) % len(blobs)] for j in range(size)] for start in range(0, len(blobs), size)]
+        results.append(run_case(f"preprocess_batch[b={size}]", lambda i: len(preprocessing.preprocess_batch(batches[i % len(batches)])) == size,
+                                max(10, args.requests // size), 1, items_per_call=size))
+    return results
+
+def bench_predictions(serving_model, images, batch_sizes, args):
+    from . import model, preprocessing
+    pixels = preprocessing.preprocess_batch(images)
+    results = []
+    for size in batch_sizes:
+        batch = np.resize(pixels, (size,) + pixels.shape[1:])
+        results.append(run_case(f"make_predictions[b={size}]", lambda i: model.make_predictions(serving_model, batch) is not None,
+                                max(10, args.requests // size), 1, items_per_call=size))
+    return results
+
+def _multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+class _RemoteClient:
+    """Drives a running server over HTTP (same calls as _LocalClient)."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def _request(self, path, data=None, headers=None, method="GET"):
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers or {}, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def predict_upload(self, filename, data):
+        body, content_type = _multipart("image", filename, data)
+        return self._request("/predict_upload", body, {"Content-Type": content_type}, "POST")
+
+    def predict_lib(self, image_id):
+        return self._request("/predict_lib", json.dumps({"image_id": image_id}).encode(), {"Content-Type": "application/json"}, "POST")
+
+    def image(self, image_id, size=None):
+        return self._request(f"/image/{image_id}" + (f"?size={size}" if size else ""))
+
+class _LocalClient:
+    """Drives the Flask app in-process, one test client per thread."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.flask_app.test_client()
+        return self._local.client
+
+    def predict_upload(self, filename, data):
+        import io
+        return self._client().post("/predict_upload", data={"image": (io.BytesIO(data), filename)}).status_code
+
+    def predict_lib(self, image_id):
+        return self._client().post("/predict_lib", json={"image_id": image_id}).status_code
+
+    def image(self, image_id, size=None):
+        response = self._client().get(f"/image/{image_id}" + (f"?size={size}" if size else ""))
+        response.get_data()
+        return response.status_code
+
+def bench_endpoints(client, images, image_ids, concurrency_levels, args):
+    uploads = []
+    for path in images:
+        with open(path, "rb") as f:
+            uploads.append((os.path.basename(path), f.read()))
+    results = []
+    for concurrency in concurrency_levels:
+        results.append(run_case(f"POST /predict_upload[c={concurrency}]",
+                                lambda i: client.predict_upload(*uploads[i % len(uploads)]) == 200, args.requests, concurrency))
+        results.append(run_case(f"POST /predict_lib[c={concurrency}]",
+                                lambda i: client.predict_lib(image_ids[i % len(image_ids)]) == 200, args.requests, concurrency))
+        results.append(run_case(f"GET /image/<id>[c={concurrency}]",
+                                lambda i: client.image(image_ids[i % len(image_ids)]) == 200, args.requests, concurrency))
+        results.append(run_case(f"GET /image/<id>?size=128[c={concurrency}]",
+                                lambda i: client.image(image_ids[i % len(image_ids)], 128) == 200, args.requests, concurrency))
+    return results
+
+def _local_app(model_path, backend, work_dir):
+    """Imports the app against a scratch database seeded from dataset/valid and activates the stand-in model.
+
+    DATABASE_PATH must already point at the scratch file (see main).
+    """
+    os.environ['MODEL_LOADING'] = 'manual'
+    import app
+    import database
+    from . import model
+    database.set_database_provider(None)  # never fall back to S3
+    if database.max_image_id() == 0:
+        database.populate_database_from_csv(os.path.join(DATASET_DIR, "valid", "_annotations.csv"),
+                                            os.path.join(DATASET_DIR, "valid", "images"), 'valid')
+    app.model = model
+    app.activate_model(_serving_model(model_path, backend, work_dir), f"benchmark-{backend}")
+    app.model_state.update(status="ready")
+    with database.connection() as conn:
+        image_ids = [row[0] for row in conn.execute("SELECT id FROM images ORDER BY id LIMIT 256;")]
+    return app, image_ids
+
+def _serving_model(model_path, backend, work_dir):
+    import tensorflow as tf
+    from . import export, model
+    keras_model = tf.keras.models.load_model(model_path)
+    if backend == "tflite":
+        tflite_path = os.path.join(work_dir, "benchmark.tflite")
+        export.export_tflite(keras_model, tflite_path, "dynamic")
+        serving_model = model.TFLiteModel(tflite_path)
+        serving_model.warmup()
+        return serving_model
+    return model.prepare_for_serving(keras_model)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(DATASET_DIR)).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare(results, baseline, max_regression):
+    """Returns the cases whose throughput fell or whose p95 latency rose by more than `max_regression`."""
+    previous = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        before = previous.get(case["name"])
+        if before is None:
+            continue
+        if before["throughput"] and case["throughput"] < before["throughput"] * (1 - max_regression):
+            regressions.append(f"{case['name']}: throughput {before['throughput']} -> {case['throughput']}/s")
+        if before["latency_ms"]["p95"] and case["latency_ms"]["p95"] > before["latency_ms"]["p95"] * (1 + max_regression):
+            regressions.append(f"{case['name']}: p95 {before['latency_ms']['p95']} -> {case['latency_ms']['p95']} ms")
+    return regressions
+
+def _int_list(value):
+    return [int(part) for part in value.split(",") if part.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark preprocessing, inference and the API with the bundled dataset images.")
+    parser.add_argument("--suites", default="preprocess,predict,endpoints",
+                        help="Comma-separated: preprocess, predict, endpoints")
+    parser.add_argument("--batch-sizes", type=_int_list, default=[1, 8, 32])
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=200, help="Calls per case (batched cases make fewer)")
+    parser.add_argument("--images", type=int, default=64, help="How many dataset/valid images to cycle through")
+    parser.add_argument("--model-path", help="Local .keras model (default: an untrained stand-in with the production architecture)")
+    parser.add_argument("--backend", choices=["keras", "tflite"], default="keras")
+    parser.add_argument("--url", help="Benchmark a running server's endpoints instead of the app in-process")
+    parser.add_argument("--cache", action="store_true", help="Keep the prediction cache on (off by default so every call runs the model)")
+    parser.add_argument("--output", help="Write the JSON results here")
+    parser.add_argument("--compare", help="Earlier results file; exit 1 if a case regressed")
+    parser.add_argument("--max-regression", type=float, default=0.15, help="Allowed fractional throughput drop / p95 rise")
+    args = parser.parse_args(argv)
+
+    suites = {suite.strip() for suite in args.suites.split(",") if suite.strip()}
+    if not args.cache:
+        os.environ['PREDICTION_CACHE_SIZE'] = '0'
+    images = dataset_images("valid", args.images)
+
+    with tempfile.TemporaryDirectory() as work, contextlib.redirect_stdout(sys.stderr):
+        if "endpoints" in suites and not args.url:
+            # Before anything imports database, so the real database is never touched
+            os.environ['DATABASE_PATH'] = os.path.join(work, "benchmark.db")
+        model_path = args.model_path
+        needs_model = "predict" in suites or ("endpoints" in suites and not args.url)
+        if needs_model and not model_path:
+            model_path = build_standin_model(os.path.join(work, "standin.keras"))
+
+        cases = []
+        if "preprocess" in suites:
+            cases += bench_preprocessing(images, args.batch_sizes, args)
+        if "predict" in suites:
+            cases += bench_predictions(_serving_model(model_path, args.backend, work), images, args.batch_sizes, args)
+        if "endpoints" in suites:
+            if args.url:
+                client, image_ids = _RemoteClient(args.url), list(range(1, 65))
+            else:
+                flask_app, image_ids = _local_app(model_path, args.backend, work)
+                client = _LocalClient(flask_app.app)
+            cases += bench_endpoints(client, images, image_ids, args.concurrency, args)
+
+    import tensorflow as tf
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "environment": {"python": platform.python_version(), "tensorflow": tf.__version__,
+                        "cpus": os.cpu_count(), "platform": platform.platform()},
+        "config": {"backend": args.backend, "model": "standin" if not args.model_path else args.model_path,
+                   "url": args.url, "prediction_cache": args.cache, "requests": args.requests},
+        "peak_rss_mb": peak_rss_mb(),
+        "cases": cases,
+    }
+    text = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+
+BLOB_STORE_DIR = os.environ.get('BLOB_STORE_DIR', os.path.join(tempfile.gettempdir(), "blobs"))
+
+class BlobStore:
+    """Content-addressed directory of image files keyed by their sha256.
+
+    Files live at `<root>/<h[:2]>/<h[2:4]>/<h>`, so no directory grows past a
+    few hundred entries. Identical images are stored once.
+    """
+
+    def __init__(self, root=BLOB_STORE_DIR):
+        self.root = root
+        self.writes = 0
+        self.dedup_hits = 0
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def path(self, content_hash):
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], content_hash)
+
+    def __contains__(self, content_hash):
+        return os.path.exists(self.path(content_hash))
+
+    def put(self, data, content_hash=None):
+        """Stores `data` unless an identical blob is already there and returns its hash."""
+        content_hash = content_hash or self.hash(data)
+        path = self.path(content_hash)
+        if os.path.exists(path):
+            self.dedup_hits += 1
+            return content_hash
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write under a unique name and rename, so readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.writes += 1
+        return content_hash
+
+    def get(self, content_hash):
+        with open(self.path(content_hash), "rb") as f:
+            return f.read()
+
+    def open(self, content_hash):
+        return open(self.path(content_hash), "rb")
+
+    def size(self, content_hash):
+        return os.path.getsize(self.path(content_hash))
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+def get_blob_store():
+    """Returns the process-wide store rooted at BLOB_STORE_DIR."""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = BlobStore(BLOB_STORE_DIR)
+        return _default_store
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move image BLOBs out of the SQLite database into the blob store.")
+    parser.add_argument("--db", help="Path to the SQLite database (default: DATABASE_PATH)")
+    parser.add_argument("--chunk-size", type=int, default=200)
+    parser.add_argument("--no-vacuum", action="store_true", help="Skip the VACUUM that returns the freed space to the filesystem")
+    args = parser.parse_args(argv)
+
+    import database
+    stats = database.move_images_to_blob_store(args.db, chunk_size=args.chunk_size, vacuum=not args.no_vacuum)
+    print(stats)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
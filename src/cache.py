@@ -0,0 +1,74 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+class PredictionCache:
+    """Size-bounded LRU cache of predictions keyed on image content and model version."""
+
+    def __init__(self, max_entries=4096, model_version=None):
+        self.max_entries = max_entries
+        self.model_version = model_version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for_bytes(image_data):
+        """Content-addressed key for raw encoded image bytes."""
+        return "sha256:" + hashlib.sha256(image_data).hexdigest()
+
+    @staticmethod
+    def key_for_image_id(image_id):
+        """Key for an image already stored in the database."""
+        return f"image:{image_id}"
+
+    def get(self, key, model_version=None):
+        """Returns the cached prediction for `key`, or None on a miss."""
+        with self._lock:
+            version = self.model_version if model_version is None else model_version
+            entry = self._entries.get((version, key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((version, key))
+            self.hits += 1
+            return entry
+
+    def put(self, key, prediction, model_version=None):
+        """Stores a prediction; ignored if it was made by a model that has since been replaced."""
+        with self._lock:
+            version = self.model_version if model_version is None else model_version
+            if version != self.model_version:
+                return
+            self._entries[(version, key)] = prediction
+            self._entries.move_to_end((version, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_model_version(self, model_version):
+        """Switches to a new model version and drops every entry from the old one."""
+        with self._lock:
+            if model_version != self.model_version:
+                self._entries.clear()
+            self.model_version = model_version
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "model_version": self.model_version,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,127 @@
+import argparse
+import io
+import os
+import sys
+import threading
+import numpy as np
+from PIL import Image
+
+# 'link' stores duplicates of a library image with `duplicate_of` set (retraining ignores
+# them), 'skip' leaves them out of an ingest, 'off' inserts everything
+DEDUP_MODE = os.environ.get('DEDUP_MODE', 'link')
+# Largest Hamming distance between 64-bit dHashes that still counts as the same photo
+DEDUP_MAX_DISTANCE = int(os.environ.get('DEDUP_MAX_DISTANCE', 3))
+HASH_BITS = 64
+
+def dhash(source, hash_size=8):
+    """Returns the 64-bit difference hash of an image (bytes, path or file object), or None if it can't be read.
+
+    Each bit says whether a pixel of the 9x8 grayscale thumbnail is brighter
+    than its left neighbour, so re-encoding, resizing and small exposure
+    changes leave most bits alone.
+    """
+    try:
+        image = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+        image.draft('L', (hash_size * 8, hash_size * 8))  # decode JPEGs at reduced size
+        pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    except Exception as e:
+        print(f"Error hashing image: {e}")
+        return None
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def to_sqlite(value):
+    """Maps an unsigned 64-bit hash onto SQLite's signed INTEGER range."""
+    return None if value is None else value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+def from_sqlite(value):
+    return None if value is None else value + (1 << HASH_BITS) if value < 0 else value
+
+def _bands(max_distance):
+    """Splits the hash bits into max_distance + 1 contiguous (shift, mask) bands."""
+    count = max_distance + 1
+    edges = [round(index * HASH_BITS / count) for index in range(count + 1)]
+    return [(start, (1 << (end - start)) - 1) for start, end in zip(edges, edges[1:])]
+
+class DuplicateIndex:
+    """Exact (sha256) and near (dHash within `max_distance` bits) duplicate lookups over a set of images.
+
+    Near lookups use multi-index hashing: the hash is cut into max_distance + 1
+    bands, and any hash within max_distance bits agrees with the query on at
+    least one whole band, so only images sharing a band value are compared.
+    """
+
+    def __init__(self, max_distance=DEDUP_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.last_id = 0
+        self.refreshed_at = 0.0
+        self._bands = _bands(max_distance)
+        self._tables = [{} for _ in self._bands]
+        self._exact = {}
+        self._hashes = {}
+        self._labels = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._labels)
+
+    def add(self, image_id, content_hash, phash, label):
+        with self.lock:
+            self._labels[image_id] = label
+            self.last_id = max(self.last_id, image_id)
+            if content_hash:
+                self._exact.setdefault(content_hash, image_id)
+            self.set_phash(image_id, phash)
+
+    def set_phash(self, image_id, phash):
+        """Adds the perceptual hash of an image indexed without one."""
+        with self.lock:
+            if phash is None or image_id in self._hashes or image_id not in self._labels:
+                return
+            self._hashes[image_id] = phash
+            for table, (shift, mask) in zip(self._tables, self._bands):
+                table.setdefault((phash >> shift) & mask, []).append(image_id)
+
+    def exact(self, content_hash):
+        """Returns (image_id, label) of the first image with this sha256, or None."""
+        with self.lock:
+            image_id = self._exact.get(content_hash)
+            return None if image_id is None else (image_id, self._labels[image_id])
+
+    def nearest(self, phash):
+        """Returns (image_id, label, distance) of the closest image within max_distance bits, or None."""
+        if phash is None:
+            return None
+        best = None
+        with self.lock:
+            seen = set()
+            for table, (shift, mask) in zip(self._tables, self._bands):
+                for image_id in table.get((phash >> shift) & mask, ()):
+                    if image_id in seen:
+                        continue
+                    seen.add(image_id)
+                    distance = (self._hashes[image_id] ^ phash).bit_count()
+                    if distance <= self.max_distance and (best is None or (distance, image_id) < best):
+                        best = (distance, image_id)
+            return None if best is None else (best[1], self._labels[best[1]], best[0])
+
+    def match(self, content_hash, phash):
+        """Returns ('exact' | 'near', image_id, label, distance) for the best match, or None."""
+        found = self.exact(content_hash)
+        if found is not None:
+            return ('exact', found[0], found[1], 0)
+        found = self.nearest(phash)
+        return None if found is None else ('near',) + found
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hash the images in a database and report how many are duplicates.")
+    parser.add_argument("--db", help="Path to the SQLite database (default: DATABASE_PATH)")
+    parser.add_argument("--max-distance", type=int, default=DEDUP_MAX_DISTANCE)
+    args = parser.parse_args(argv)
+
+    import database
+    print(database.duplicate_report(args.db, args.max_distance))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
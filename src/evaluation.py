@@ -0,0 +1,200 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import time
+import numpy as np
+from . import feature_store, preprocessing
+import database
+
+DATASET_DIR = os.environ.get('DATASET_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset"))
+# Held-out split retrained models are judged on: a dataset/ folder name, a CSV path, or db:<data_type>
+EVAL_SPLIT = os.environ.get('EVAL_SPLIT', 'valid')
+EVAL_BATCH_SIZE = int(os.environ.get('EVAL_BATCH_SIZE', 256))
+
+class EvaluationSplit:
+    """A fixed, labelled set of images with their preprocessed tensors in a FeatureStore.
+
+    `ids` index into `store`; `fingerprint` changes whenever the split's
+    contents do, so cached results for an older version of it are ignored.
+    """
+
+    def __init__(self, name, ids, labels, store, fingerprint):
+        self.name = name
+        self.ids = ids
+        self.labels = labels
+        self.store = store
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.ids)
+
+def _csv_split(name, csv_path, images_dir=None):
+    import pandas as pd
+    images_dir = images_dir or os.path.join(os.path.dirname(csv_path), 'images')
+    df = pd.read_csv(csv_path, usecols=['filename', 'class'])
+    with open(csv_path, 'rb') as f:
+        fingerprint = hashlib.sha256(f.read()).hexdigest()[:16]
+
+    # Rows are keyed by their position in the CSV, in a store of their own per CSV version
+    store = feature_store.FeatureStore(name=f"split_{name}_{fingerprint}_128x128")
+    ids = list(range(len(df)))
+    missing = store.missing(ids)
+    if missing:
+        added = store.add((row, os.path.join(images_dir, df['filename'][row])) for row in missing)
+        print(f"Feature store: preprocessed {added} images of split {name}")
+    kept = [row for row in ids if row in store]
+    return EvaluationSplit(name, kept, [df['class'][row] for row in kept], store, fingerprint)
+
+def _db_split(data_type, database_file=None):
+    with database.connection(database_file) as conn:
+        rows = conn.execute("SELECT id, label FROM images WHERE data_type = ? ORDER BY id;", (data_type,)).fetchall()
+    store = feature_store.FeatureStore()
+    store.update_from_db(database_file, [row[0] for row in rows])
+    kept = [(image_id, label) for image_id, label in rows if image_id in store]
+    # Images are only ever inserted, so the ids identify the partition's contents
+    fingerprint = hashlib.sha256(",".join(str(image_id) for image_id, _ in kept).encode()).hexdigest()[:16]
+    return EvaluationSplit(f"db:{data_type}", [row[0] for row in kept], [row[1] for row in kept], store, fingerprint)
+
+def load_split(split=EVAL_SPLIT, database_file=None):
+    """Returns the EvaluationSplit for `split`, preprocessing only images not cached yet."""
+    if split.startswith("db:"):
+        return _db_split(split[3:], database_file)
+    if split.endswith(".csv"):
+        return _csv_split(os.path.basename(os.path.dirname(os.path.abspath(split))), split)
+    return _csv_split(split, os.path.join(DATASET_DIR, split, "_annotations.csv"))
+
+def _predict_fn(keras_model):
+    """Traces one inference function so large batches don't go through `model.predict`.
+
+    Serving wrappers (e.g. model.TFLiteModel) are used through their own `predict`.
+    """
+    import tensorflow as tf
+    if not isinstance(keras_model, tf.keras.Model):
+        return keras_model.predict
+    infer = tf.function(lambda images: keras_model(images, training=False), reduce_retracing=True)
+    return lambda images: infer(tf.convert_to_tensor(images)).numpy()
+
+def evaluate(keras_model, split, batch_size=EVAL_BATCH_SIZE, label_map=preprocessing.LABEL_MAP):
+    """Scores a split in large batches and returns accuracy, loss, a confusion matrix and timing.
+
+    Classes are ordered as in `label_map`; labels outside it count as errors.
+    """
+    predict = _predict_fn(keras_model)
+    class_names = [label_map[index] for index in sorted(label_map)]
+    class_ids = {name: index for index, name in enumerate(class_names)}
+    truth = np.array([class_ids.get(label, -1) for label in split.labels], dtype=np.int64)
+    positions = split.store.positions(split.ids)
+    pixels = split.store.array()
+
+    probabilities = []
+    batch_ms = []
+    start = time.perf_counter()
+    for offset in range(0, len(positions), batch_size):
+        images = pixels[positions[offset:offset + batch_size]].astype(np.float32) / 255.0
+        batch_start = time.perf_counter()
+        probabilities.append(predict(images))
+        batch_ms.append((time.perf_counter() - batch_start) * 1000)
+    elapsed = time.perf_counter() - start
+    # The first batch includes tracing; keep it out of the latency percentiles when there are others
+    steady_ms = batch_ms[1:] or batch_ms
+    probabilities = np.concatenate(probabilities) if probabilities else np.empty((0, len(class_names)))
+    predicted = np.argmax(probabilities, axis=1)
+
+    known = truth >= 0
+    confusion = np.zeros((len(class_names), len(class_names)), dtype=np.int64)
+    np.add.at(confusion, (truth[known], predicted[known]), 1)
+    picked = probabilities[np.flatnonzero(known), truth[known]] if known.any() else np.empty(0)
+
+    per_class = {}
+    for index, name in enumerate(class_names):
+        support = int(confusion[index].sum())
+        predicted_count = int(confusion[:, index].sum())
+        precision = confusion[index, index] / predicted_count if predicted_count else 0.0
+        recall = confusion[index, index] / support if support else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        per_class[name] = {"precision": round(float(precision), 4), "recall": round(float(recall), 4),
+                           "f1": round(float(f1), 4), "support": support}
+
+    return {
+        "split": split.name,
+        "fingerprint": split.fingerprint,
+        "images": len(split),
+        "accuracy": round(float(np.trace(confusion) / len(split)), 4) if len(split) else 0.0,
+        "loss": round(float(-np.mean(np.log(np.clip(picked, 1e-7, 1.0)))), 4) if len(picked) else None,
+        "classes": class_names,
+        "confusion_matrix": confusion.tolist(),
+        "per_class": per_class,
+        "batch_size": batch_size,
+        "batch_latency_ms": {"p50": round(float(np.percentile(steady_ms, 50)), 2) if steady_ms else None,
+                             "p95": round(float(np.percentile(steady_ms, 95)), 2) if steady_ms else None},
+        "images_per_sec": round(len(split) / elapsed, 1) if elapsed > 0 else 0.0,
+        "evaluated_at": time.time(),
+    }
+
+def format_report(result):
+    """Renders an evaluation as a plain-text table, like sklearn's classification_report."""
+    width = max(len(name) for name in result["classes"] + ["accuracy"])
+    lines = [f"Held-out split: {result['split']} ({result['images']} images)", "",
+             f"{'':>{width}}  precision    recall  f1-score   support", ""]
+    for name in result["classes"]:
+        stats = result["per_class"][name]
+        lines.append(f"{name:>{width}}  {stats['precision']:>9.2f} {stats['recall']:>9.2f} {stats['f1']:>9.2f} {stats['support']:>9}")
+    lines += ["", f"{'accuracy':>{width}}  {'':>9} {'':>9} {result['accuracy']:>9.2f} {result['images']:>9}", "",
+              "Confusion matrix (rows: true, columns: predicted):"]
+    lines += [f"{name:>{width}}  " + " ".join(f"{count:>6}" for count in row)
+              for name, row in zip(result["classes"], result["confusion_matrix"])]
+    return "\n".join(lines) + "\n"
+
+def evaluate_version(models, entry, split, keras_model=None, local_path=None, force=False):
+    """Returns a registry version's evaluation on `split`, computing and recording it if needed.
+
+    A stored result is reused while the split's contents are unchanged.
+    """
+    cached = (entry.get('evaluations') or {}).get(split.name)
+    if cached and cached.get('fingerprint') == split.fingerprint and not force:
+        return cached
+    if keras_model is None:
+        from . import model
+        keras_model = model.load_model_from_s3(models.bucket_name, entry['key'], local_path or models.local_path(entry),
+                                               use_memory_cache=False)
+        if keras_model is None:
+            raise RuntimeError(f"Could not load model version {entry['version']}")
+    result = evaluate(keras_model, split)
+    models.record_evaluation(entry['version'], result)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate a model on a held-out split and record the result per version.")
+    parser.add_argument("--split", default=EVAL_SPLIT, help="dataset/ folder name (valid, test), a CSV path, or db:<data_type>")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--version", type=int, help="Registry version to evaluate (default: production)")
+    target.add_argument("--model-path", help="Local .keras file; the result is printed, not recorded")
+    parser.add_argument("--db", help="Path to the SQLite database (for db: splits)")
+    parser.add_argument("--bucket", default="theosummative")
+    parser.add_argument("--s3-model-file", default="models/second_model.keras")
+    parser.add_argument("--force", action="store_true", help="Re-evaluate even if a result for this split is recorded")
+    parser.add_argument("--report", action="store_true", help="Print the text report instead of JSON")
+    args = parser.parse_args(argv)
+
+    import tensorflow as tf
+    from . import registry
+
+    with contextlib.redirect_stdout(sys.stderr):
+        split = load_split(args.split, args.db)
+        if args.model_path:
+            result = evaluate(tf.keras.models.load_model(args.model_path), split)
+        else:
+            models = registry.ModelRegistry(args.bucket, args.s3_model_file)
+            entry = models.get(args.version) if args.version else models.production()
+            if entry is None:
+                print("No model versions registered")
+                return 1
+            result = evaluate_version(models, entry, split, force=args.force)
+    print(format_report(result) if args.report else json.dumps(result, indent=1))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
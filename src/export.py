@@ -0,0 +1,120 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+
+# 'dynamic' (int8 weights, float activations), 'int8' (calibrated, integer kernels), 'float16' or 'off'
+TFLITE_EXPORT = os.environ.get('TFLITE_EXPORT', 'dynamic')
+# An export more than this far below the float model's held-out accuracy is not served
+TFLITE_MAX_ACCURACY_DROP = float(os.environ.get('TFLITE_MAX_ACCURACY_DROP', 0.01))
+CALIBRATION_SPLIT = os.environ.get('TFLITE_CALIBRATION_SPLIT', 'valid')
+CALIBRATION_SAMPLES = int(os.environ.get('TFLITE_CALIBRATION_SAMPLES', 200))
+
+def _representative_dataset(split, samples):
+    """Yields single calibration images from a split's cached tensors, in a fixed random order."""
+    positions = split.store.positions(split.ids)
+    pixels = split.store.array()
+    order = np.random.default_rng(0).permutation(len(positions))[:samples]
+    for position in positions[order]:
+        yield [pixels[position:position + 1].astype(np.float32) / 255.0]
+
+def export_tflite(keras_model, output_path, quantization=TFLITE_EXPORT, calibration_split=None,
+                  calibration_samples=CALIBRATION_SAMPLES):
+    """Converts a Keras model to a TFLite file and returns its size in bytes.
+
+    'int8' needs `calibration_split` (an evaluation.EvaluationSplit) to pick
+    activation ranges; inputs and outputs stay float32 either way, so the
+    artifact is a drop-in replacement behind model.TFLiteModel.
+    """
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if quantization in ('dynamic', 'int8', 'float16'):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if calibration_split is None or not len(calibration_split):
+            raise ValueError("int8 quantization needs a calibration split")
+        converter.representative_dataset = lambda: _representative_dataset(calibration_split, calibration_samples)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization not in ('dynamic', 'none'):
+        raise ValueError(f"Unknown quantization {quantization!r}")
+
+    with open(output_path, "wb") as f:
+        f.write(converter.convert())
+    return os.path.getsize(output_path)
+
+def check_export(keras_model, tflite_path, split, max_accuracy_drop=TFLITE_MAX_ACCURACY_DROP):
+    """Scores the float model and the export on the same split and compares them.
+
+    Returns accuracy of both, the delta, batch latency of both and whether the
+    export is within `max_accuracy_drop` of the float model.
+    """
+    from . import evaluation, model
+    float_result = evaluation.evaluate(keras_model, split)
+    tflite_result = evaluation.evaluate(model.TFLiteModel(tflite_path), split)
+    delta = round(tflite_result["accuracy"] - float_result["accuracy"], 4)
+    return {
+        "split": split.name,
+        "float_accuracy": float_result["accuracy"],
+        "accuracy": tflite_result["accuracy"],
+        "accuracy_delta": delta,
+        "float_batch_latency_ms": float_result["batch_latency_ms"],
+        "batch_latency_ms": tflite_result["batch_latency_ms"],
+        "accepted": delta >= -max_accuracy_drop,
+    }
+
+def export_version(models, entry, keras_model=None, quantization=TFLITE_EXPORT, split=None,
+                   max_accuracy_drop=TFLITE_MAX_ACCURACY_DROP):
+    """Exports a registry version to TFLite, checks it against the float model and records it as `artifacts.tflite`.
+
+    The file is only uploaded if it passes the check. Returns the recorded info.
+    """
+    from . import evaluation, model
+    if keras_model is None:
+        keras_model = model.load_model_from_s3(models.bucket_name, entry['key'], models.local_path(entry),
+                                               use_memory_cache=False)
+        if keras_model is None:
+            raise RuntimeError(f"Could not load model version {entry['version']}")
+    split = split or evaluation.load_split(CALIBRATION_SPLIT)
+
+    with tempfile.TemporaryDirectory() as work:
+        tflite_path = os.path.join(work, "model.tflite")
+        size = export_tflite(keras_model, tflite_path, quantization, calibration_split=split)
+        info = dict(check_export(keras_model, tflite_path, split, max_accuracy_drop),
+                    quantization=quantization, bytes=size)
+        print(f"TFLite export of version {entry['version']} ({quantization}, {size} bytes): "
+              f"accuracy {info['float_accuracy']:.4f} -> {info['accuracy']:.4f}, "
+              f"{'accepted' if info['accepted'] else 'rejected'}")
+        models.attach_artifact(entry['version'], "tflite", tflite_path if info['accepted'] else None, info)
+    return info
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a model version to a quantized TFLite artifact.")
+    parser.add_argument("--version", type=int, help="Registry version to export (default: production)")
+    parser.add_argument("--quantization", choices=["dynamic", "int8", "float16", "none"],
+                        default='dynamic' if TFLITE_EXPORT == 'off' else TFLITE_EXPORT)
+    parser.add_argument("--split", default=CALIBRATION_SPLIT, help="Calibration and check split (see src.evaluation)")
+    parser.add_argument("--max-accuracy-drop", type=float, default=TFLITE_MAX_ACCURACY_DROP)
+    parser.add_argument("--bucket", default="theosummative")
+    parser.add_argument("--s3-model-file", default="models/second_model.keras")
+    args = parser.parse_args(argv)
+
+    from . import evaluation, registry
+
+    with contextlib.redirect_stdout(sys.stderr):
+        models = registry.ModelRegistry(args.bucket, args.s3_model_file)
+        if not models.list()['versions'] and args.version in (None, 1):
+            entry = {"version": 1, "key": args.s3_model_file}  # nothing registered yet: the base model is version 1
+        else:
+            entry = models.get(args.version) if args.version else models.production()
+        info = export_version(models, entry, quantization=args.quantization, split=evaluation.load_split(args.split),
+                              max_accuracy_drop=args.max_accuracy_drop)
+    print(json.dumps(info, indent=1))
+    return 0 if info['accepted'] else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import os
+import tempfile
+import threading
+import numpy as np
+from . import preprocessing
+import database
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+FEATURE_STORE_DIR = os.environ.get('FEATURE_STORE_DIR', os.path.join(tempfile.gettempdir(), "feature_store"))
+
+class FeatureStore:
+    """Append-only on-disk store of preprocessed uint8 image tensors keyed by image id.
+
+    Tensors live in one flat memory-mapped file (`<name>.u8`) with a parallel
+    array of image ids (`<name>.ids.npy`), so reads are slices of the page cache
+    instead of JPEG decodes. Values are the resized RGB pixels; divide by 255
+    to get what `preprocessing.load_image` returns.
+    """
+
+    def __init__(self, directory=FEATURE_STORE_DIR, target_size=(128, 128), name=None):
+        self.directory = directory
+        self.target_size = tuple(target_size)
+        self.item_shape = (self.target_size[1], self.target_size[0], 3)
+        self.item_bytes = int(np.prod(self.item_shape))
+        name = name or f"images_{self.target_size[0]}x{self.target_size[1]}"
+        self.data_path = os.path.join(directory, f"{name}.u8")
+        self.index_path = os.path.join(directory, f"{name}.ids.npy")
+        self.lock_path = os.path.join(directory, f"{name}.lock")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Reads the id index, discarding tensor bytes not covered by it (e.g. after a crash)."""
+        ids = np.load(self.index_path) if os.path.exists(self.index_path) else np.empty(0, dtype=np.int64)
+        rows_on_disk = os.path.getsize(self.data_path) // self.item_bytes if os.path.exists(self.data_path) else 0
+        ids = ids[:rows_on_disk]
+        if os.path.exists(self.data_path) and os.path.getsize(self.data_path) != len(ids) * self.item_bytes:
+            with open(self.data_path, "r+b") as f:
+                f.truncate(len(ids) * self.item_bytes)
+        self._ids = ids
+        self._positions = {int(image_id): position for position, image_id in enumerate(ids)}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, image_id):
+        return int(image_id) in self._positions
+
+    def missing(self, image_ids):
+        """Returns the ids that have not been preprocessed yet."""
+        return [int(image_id) for image_id in image_ids if int(image_id) not in self._positions]
+
+    def positions(self, image_ids):
+        """Returns the row of each id in `array()`."""
+        return np.fromiter((self._positions[int(image_id)] for image_id in image_ids), dtype=np.int64, count=len(image_ids))
+
+    def array(self):
+        """Returns a read-only memory map over every stored tensor, shape (n, h, w, 3)."""
+        if not len(self._ids):
+            return np.empty((0,) + self.item_shape, dtype=np.uint8)
+        return np.memmap(self.data_path, dtype=np.uint8, mode="r", shape=(len(self._ids),) + self.item_shape)
+
+    def get(self, image_ids):
+        """Returns the stored uint8 tensors for `image_ids` in the given order."""
+        return self.array()[self.positions(image_ids)]
+
+    def add(self, items):
+        """Preprocesses and appends (image_id, image_source) pairs that aren't stored yet.
+
+        Returns the number of new tensors written.
+        """
+        with self._lock:
+            lock_file = open(self.lock_path, "a")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Another process may have appended since we last looked
+                self._load_index()
+
+                new_ids = []
+                with open(self.data_path, "ab") as data_file:
+                    for image_id, source in items:
+                        image_id = int(image_id)
+                        if image_id in self._positions or image_id in new_ids:
+                            continue
+                        try:
+                            pixels = preprocessing.load_image_uint8(source, self.target_size)
+                        except Exception as e:
+                            print(f"Error preprocessing image {image_id} for feature store: {e}")
+                            continue
+                        data_file.write(np.ascontiguousarray(pixels).tobytes())
+                        new_ids.append(image_id)
+
+                if new_ids:
+                    ids = np.concatenate([self._ids, np.asarray(new_ids, dtype=np.int64)])
+                    temp_index_path = self.index_path + ".tmp.npy"
+                    np.save(temp_index_path, ids)
+                    os.replace(temp_index_path, self.index_path)
+                self._load_index()
+                return len(new_ids)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def update_from_db(self, database_file, image_ids, chunk_size=256):
+        """Decodes only the given database rows that aren't in the store yet."""
+        missing = self.missing(image_ids)
+        if not missing:
+            return 0
+
+        def rows():
+            with database.connection(database_file) as conn:
+                for offset in range(0, len(missing), chunk_size):
+                    chunk = missing[offset:offset + chunk_size]
+                    placeholders = ",".join("?" * len(chunk))
+                    cur = conn.execute(f"SELECT id, image_data, content_hash FROM images WHERE id IN ({placeholders});", chunk)
+                    for image_id, image_data, content_hash in cur:
+                        yield image_id, bytes(database.resolve_image_data(image_data, content_hash))
+
+        added = self.add(rows())
+        print(f"Feature store: preprocessed {added} new images ({len(self)} total)")
+        return added
@@ -0,0 +1,327 @@
+import argparse
+import atexit
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+from concurrent.futures import Future, InvalidStateError
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from .batching import QueueFullError
+
+# Unix socket of the host's inference server; when set, web workers send predictions there
+INFERENCE_SOCKET = os.environ.get('INFERENCE_SOCKET')
+# Shared-memory slots per web worker process, i.e. its predictions in flight at once
+INFERENCE_SLOTS = int(os.environ.get('INFERENCE_SLOTS', 64))
+# One 128x128x3 float32 tensor per slot
+SLOT_BYTES = 128 * 128 * 3 * 4
+INFERENCE_STATUS_INTERVAL = float(os.environ.get('INFERENCE_STATUS_INTERVAL', 1))
+# Seconds to wait for the server to download, load and warm up a model on reload
+INFERENCE_RELOAD_TIMEOUT = float(os.environ.get('INFERENCE_RELOAD_TIMEOUT', 600))
+
+class InferenceServerError(Exception):
+    """Raised on a client when the server rejects or fails a request."""
+
+def _send(conn, lock, message):
+    with lock:
+        conn.send_bytes(json.dumps(message).encode())
+
+def _attach(name):
+    """Maps a client's shared memory block without taking ownership of it.
+
+    Before Python 3.13 attaching registers the block with this process's
+    resource tracker, which would unlink it when the server exits.
+    """
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        block = SharedMemory(name=name)
+        resource_tracker.unregister(block._name, "shared_memory")
+        return block
+
+class InferenceServer:
+    """Serves one process's model to every web worker on the host over a Unix socket.
+
+    Workers write preprocessed images into their own shared memory block and
+    send only the slot number; the images go straight into the server's
+    micro-batcher, so requests from all workers share forward passes. Results
+    are a class index each and come back over the socket.
+    """
+
+    def __init__(self, path, serving_app):
+        self.path = path
+        self.app = serving_app
+        self.connections = 0
+        if os.path.exists(path):
+            os.unlink(path)  # left behind by a server that didn't shut down cleanly
+        self._listener = Listener(path, family='AF_UNIX')
+
+    def serve_forever(self):
+        print(f"Inference server listening on {self.path}")
+        try:
+            while True:
+                conn = self._listener.accept()
+                threading.Thread(target=self._serve, args=(conn,), name="inference-connection", daemon=True).start()
+        finally:
+            self.close()
+
+    def close(self):
+        self._listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def status(self):
+        state = self.app.model_state
+        return {"status": state["status"], "error": state["error"], "load_seconds": state["load_seconds"],
+                "registry_version": state["registry_version"], "model_version": self.app.prediction_cache.model_version,
+                "queue_depth": self.app.batcher.queue_depth(), "connections": self.connections}
+
+    def _predict(self, conn, lock, block, message):
+        if block is None:
+            _send(conn, lock, {"id": message["id"], "error": "predict sent before hello: no shared memory attached"})
+            return
+        start = message["slot"] * SLOT_BYTES
+        image = np.ndarray(message["shape"], dtype=np.float32, buffer=block.buf, offset=start)
+        try:
+            future = self.app.batcher.submit_future(image)
+        except Exception as e:
+            _send(conn, lock, {"id": message["id"], "error": str(e), "busy": isinstance(e, QueueFullError)})
+            return
+
+        def reply(done):
+            try:
+                payload = {"id": message["id"], "label": int(done.result())}
+            except Exception as e:
+                payload = {"id": message["id"], "error": str(e)}
+            try:
+                _send(conn, lock, payload)
+            except OSError:
+                pass  # the worker went away; its slots go with it
+        future.add_done_callback(reply)
+
+    def _reload(self, conn, lock, message):
+        try:
+            entry = self.app.model_registry.get(message["version"]) if message.get("version") else None
+            self.app.load_and_activate(entry)
+            _send(conn, lock, {"id": message["id"], "status": self.status()})
+        except Exception as e:
+            _send(conn, lock, {"id": message["id"], "error": str(e)})
+
+    def _serve(self, conn):
+        lock = threading.Lock()
+        block = None
+        self.connections += 1
+        try:
+            while True:
+                message = json.loads(conn.recv_bytes())
+                op = message["op"]
+                if op == "hello":
+                    block = _attach(message["shm"])
+                elif op == "predict":
+                    self._predict(conn, lock, block, message)
+                elif op == "status":
+                    _send(conn, lock, {"id": message["id"], "status": self.status()})
+                elif op == "reload":
+                    # Loading takes a while; keep answering this worker's predictions meanwhile
+                    threading.Thread(target=self._reload, args=(conn, lock, message), daemon=True).start()
+                else:
+                    _send(conn, lock, {"id": message.get("id"), "error": f"Unknown op {op!r}"})
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.connections -= 1
+            conn.close()
+            if block is not None:
+                try:
+                    block.close()
+                except BufferError:
+                    pass  # a batch still holds a view of it; unmapped when the process exits
+
+class InferenceClient:
+    """A web worker's connection to the inference server, usable in place of batching.MicroBatcher.
+
+    Connects on first use in each process (so it survives gunicorn's fork) and
+    reconnects after the server restarts.
+    """
+
+    def __init__(self, path, slots=INFERENCE_SLOTS, result_timeout=30.0, enqueue_timeout=0.5,
+                 reload_timeout=INFERENCE_RELOAD_TIMEOUT):
+        self.path = path
+        self.slots = slots
+        self.result_timeout = result_timeout
+        self.reload_timeout = reload_timeout
+        self.enqueue_timeout = enqueue_timeout
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._block = None
+        self._free = None
+        self._pending = {}  # request id -> (future, slot or None), shared with the reader thread
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count()
+
+    def _connect(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                return self._conn
+            if self._pid != os.getpid():
+                # Inherited from the parent: leave its block and socket to it
+                self._block, self._conn, self._pending = None, None, {}
+                self._pending_lock = threading.Lock()
+            if self._block is None:
+                self._block = SharedMemory(create=True, size=self.slots * SLOT_BYTES)
+                self._free = threading.BoundedSemaphore(self.slots)
+                self._slot_ids = list(range(self.slots))
+                self._pid = os.getpid()
+                atexit.register(self.stop)
+            conn = Client(self.path, family='AF_UNIX')
+            conn.send_bytes(json.dumps({"op": "hello", "shm": self._block.name}).encode())
+            self._conn = conn
+            threading.Thread(target=self._read, args=(conn,), name="inference-client", daemon=True).start()
+            return conn
+
+    def _read(self, conn):
+        error = ConnectionError("Lost connection to the inference server: closed")
+        try:
+            while True:
+                message = json.loads(conn.recv_bytes())
+                with self._pending_lock:
+                    future, slot = self._pending.pop(message.get("id"), (None, None))
+                if future is None:
+                    continue
+                # The server is done with the slot only once it has replied, even if the caller gave up
+                if slot is not None:
+                    self._release(slot)
+                if "error" in message:
+                    _settle(future, exception=_error(message))
+                elif "label" in message or "status" in message:
+                    _settle(future, result=message["label"] if "label" in message else message["status"])
+                else:
+                    _settle(future, exception=InferenceServerError(f"Malformed reply from the inference server: {message!r}"))
+        except Exception as e:
+            # Anything unexpected (a malformed reply included) ends this connection, never silently
+            error = ConnectionError(f"Lost connection to the inference server: {e or 'closed'}")
+        finally:
+            with self._lock:
+                if self._conn is conn:
+                    self._conn = None
+            conn.close()
+            with self._pending_lock:
+                pending = list(self._pending.values())
+                self._pending = {}
+            for future, slot in pending:
+                if slot is not None:
+                    self._release(slot)
+                _settle(future, exception=error)
+
+    def _request(self, message, future=None, slot=None):
+        try:
+            conn = self._connect()
+        except Exception:
+            if slot is not None:
+                self._release(slot)
+            raise
+        future = future or Future()
+        message["id"] = next(self._ids)
+        with self._pending_lock:
+            self._pending[message["id"]] = (future, slot)
+        try:
+            _send(conn, self._send_lock, message)
+        except OSError as e:
+            with self._pending_lock:
+                entry = self._pending.pop(message["id"], None)
+            if entry is not None and slot is not None:
+                self._release(slot)  # otherwise the reader already gave it back
+            raise ConnectionError(f"Inference server unavailable: {e}")
+        return future
+
+    def submit_future(self, image):
+        """Sends one preprocessed image through shared memory and returns a Future for its class index."""
+        self._connect()
+        if not self._free.acquire(timeout=self.enqueue_timeout):
+            raise QueueFullError(f"All {self.slots} inference slots are in use")
+        slot = self._slot_ids.pop()
+        image = np.asarray(image, dtype=np.float32)
+        try:
+            np.ndarray(image.shape, dtype=np.float32, buffer=self._block.buf, offset=slot * SLOT_BYTES)[...] = image
+        except Exception:
+            self._release(slot)
+            raise
+        return self._request({"op": "predict", "slot": slot, "shape": list(image.shape)}, slot=slot)
+
+    def _release(self, slot):
+        self._slot_ids.append(slot)
+        self._free.release()
+
+    def submit(self, image):
+        """Like MicroBatcher.submit: blocks until the server has classified one image."""
+        return self.submit_future(image).result(self.result_timeout)
+
+    def predict(self, images):
+        """Classifies a batch; the server may batch it with other workers' requests."""
+        futures = [self.submit_future(image) for image in images]
+        return np.array([future.result(self.result_timeout) for future in futures])
+
+    def status(self):
+        """Returns the server's model status (see InferenceServer.status)."""
+        return self._request({"op": "status"}).result(self.result_timeout)
+
+    def reload(self, version=None):
+        """Has the server load a registry version (production by default) for every worker on the host.
+
+        Returns the server's status once the new model is serving.
+        """
+        return self._request({"op": "reload", "version": version}).result(self.reload_timeout)
+
+    def queue_depth(self):
+        """Predictions sent and not yet answered (status and reload requests aren't counted)."""
+        with self._pending_lock:
+            return sum(slot is not None for _, slot in self._pending.values())
+
+    def stop(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            if self._block is not None and self._pid == os.getpid():
+                self._block.close()
+                self._block.unlink()
+            self._conn = self._block = None
+
+def _settle(future, result=None, exception=None):
+    """Completes a future unless its caller has already cancelled it."""
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+def _error(message):
+    return QueueFullError(message["error"]) if message.get("busy") else InferenceServerError(message["error"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the model to all web workers on this host over a Unix socket.")
+    parser.add_argument("--socket", default=INFERENCE_SOCKET or "/tmp/bxw-inference.sock")
+    args = parser.parse_args(argv)
+
+    # This process owns the model: load it here (and follow the registry), never forward to another server
+    os.environ.pop('INFERENCE_SOCKET', None)
+    os.environ['MODEL_LOADING'] = 'background'
+    import app
+
+    server = InferenceServer(args.socket, app)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # remove the socket on the way out
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,501 @@
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import database
+
+try:
+    import fcntl
+except ImportError:  # Windows: no worker slot locking
+    fcntl = None
+
+# Job state lives in its own SQLite file so it survives restarts and is shared by
+# every web worker and training process on the host, but isn't synced with the images
+JOBS_DATABASE_PATH = os.environ.get('JOBS_DATABASE_PATH', os.path.join(tempfile.gettempdir(), "jobs.db"))
+# 'auto' spawns a training process on demand; 'external' expects `python -m src.jobs worker` to be running
+RETRAIN_WORKER = os.environ.get('RETRAIN_WORKER', 'auto')
+# Training processes allowed at once on this host
+RETRAIN_WORKERS = int(os.environ.get('RETRAIN_WORKERS', 1))
+# TensorFlow threads per training process, leaving the remaining cores to inference
+RETRAIN_THREADS = int(os.environ.get('RETRAIN_THREADS', max(1, (os.cpu_count() or 2) // 2)))
+# A running job whose worker hasn't checked in for this long is marked failed
+JOB_STALE_SECONDS = float(os.environ.get('JOB_STALE_SECONDS', 120))
+# 'incremental' fine-tunes the parent version on rows it hasn't seen; 'full' refits on every row
+RETRAIN_MODE = os.environ.get('RETRAIN_MODE', 'incremental')
+# Old rows replayed per new row during a fine-tune, so earlier data isn't forgotten
+RETRAIN_REPLAY_RATIO = float(os.environ.get('RETRAIN_REPLAY_RATIO', 1.0))
+RETRAIN_FREEZE_BACKBONE = os.environ.get('RETRAIN_FREEZE_BACKBONE', '1') not in ('0', 'false', 'no')
+# A retrained version is promoted only if its held-out accuracy is at most this far below production's
+PROMOTE_TOLERANCE = float(os.environ.get('EVAL_PROMOTE_TOLERANCE', 0.01))
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        model_key TEXT NOT NULL,
+        status TEXT NOT NULL,
+        params TEXT,
+        progress REAL DEFAULT 0,
+        detail TEXT,
+        result TEXT,
+        message TEXT,
+        cancel_requested INTEGER DEFAULT 0,
+        worker TEXT,
+        created_at REAL,
+        started_at REAL,
+        heartbeat_at REAL,
+        finished_at REAL
+    );
+    -- At most one queued or running job per model
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_model ON jobs (model_key) WHERE status IN ('queued', 'running');
+    CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+"""
+
+class JobExistsError(Exception):
+    """Raised when a model already has a queued or running job."""
+
+    def __init__(self, job):
+        super().__init__(f"Job {job['id']} is already {job['status']} for {job['model_key']}")
+        self.job = job
+
+class JobCancelled(Exception):
+    """Raised inside a worker when the running job was cancelled."""
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def connection():
+    """Borrows a pooled connection to the jobs database, creating the schema on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != os.path.abspath(JOBS_DATABASE_PATH):
+            _pool = database.ConnectionPool(os.path.abspath(JOBS_DATABASE_PATH), max_size=4)
+            with _pool.connection() as conn:
+                conn.executescript(SCHEMA)
+    return _pool.connection()
+
+def _row_to_job(row, columns):
+    job = dict(zip(columns, row))
+    for key in ('params', 'detail', 'result'):
+        job[key] = json.loads(job[key]) if job[key] else None
+    job['cancel_requested'] = bool(job['cancel_requested'])
+    return job
+
+def _query(conn, where, params=()):
+    cur = conn.execute(f"SELECT * FROM jobs WHERE {where};", params)
+    columns = [column[0] for column in cur.description]
+    return [_row_to_job(row, columns) for row in cur.fetchall()]
+
+def get_job(job_id):
+    """Returns a job as a dict, or None."""
+    with connection() as conn:
+        jobs = _query(conn, "id = ?", (job_id,))
+    return jobs[0] if jobs else None
+
+def active_job(model_key):
+    """Returns the queued or running job for a model, or None."""
+    with connection() as conn:
+        jobs = _query(conn, "model_key = ? AND status IN ('queued', 'running')", (model_key,))
+    return jobs[0] if jobs else None
+
+def enqueue(kind, model_key, params):
+    """Queues a job and returns it; raises JobExistsError if the model already has an active job."""
+    recover_stale_jobs()
+    job_id = uuid.uuid4().hex
+    try:
+        with connection() as conn:
+            with conn:
+                conn.execute(
+                    "INSERT INTO jobs (id, kind, model_key, status, params, message, created_at) VALUES (?, ?, ?, 'queued', ?, ?, ?);",
+                    (job_id, kind, model_key, json.dumps(params), "Waiting for a worker", time.time()),
+                )
+    except sqlite3.IntegrityError:
+        existing = active_job(model_key)
+        if existing is None:  # finished in the meantime
+            return enqueue(kind, model_key, params)
+        raise JobExistsError(existing)
+    return get_job(job_id)
+
+def cancel(job_id):
+    """Cancels a queued job right away, or asks the worker running it to stop. Returns the job."""
+    with connection() as conn:
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', message = 'Cancelled before it started', finished_at = ? "
+                "WHERE id = ? AND status = 'queued';",
+                (time.time(), job_id),
+            )
+            conn.execute("UPDATE jobs SET cancel_requested = 1, message = 'Cancelling' WHERE id = ? AND status = 'running';", (job_id,))
+    return get_job(job_id)
+
+def recover_stale_jobs():
+    """Fails running jobs whose worker stopped sending heartbeats (e.g. it was killed)."""
+    with connection() as conn:
+        with conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'failed', message = 'Worker stopped responding', finished_at = ? "
+                "WHERE status = 'running' AND heartbeat_at < ?;",
+                (time.time(), time.time() - JOB_STALE_SECONDS),
+            )
+    return cur.rowcount
+
+def claim_next(worker_name):
+    """Atomically moves the oldest queued job to running and returns it, or None."""
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            jobs = _query(conn, "status = 'queued' ORDER BY created_at LIMIT 1")
+            if not jobs:
+                conn.rollback()
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, heartbeat_at = ?, message = 'Starting' WHERE id = ?;",
+                (worker_name, now, now, jobs[0]['id']),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return get_job(jobs[0]['id'])
+
+def update_progress(job_id, progress=None, detail=None, message=None):
+    """Records progress from a worker; doubles as its heartbeat. Returns True if cancellation was requested."""
+    with connection() as conn:
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET progress = COALESCE(?, progress), detail = COALESCE(?, detail), "
+                "message = COALESCE(?, message), heartbeat_at = ? WHERE id = ?;",
+                (progress, json.dumps(detail) if detail is not None else None, message, time.time(), job_id),
+            )
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?;", (job_id,)).fetchone()
+    return bool(row and row[0])
+
+def finish(job_id, status, message, result=None):
+    with connection() as conn:
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, message = ?, result = ?, finished_at = ?, "
+                "progress = CASE WHEN ? = 'completed' THEN 100 ELSE progress END WHERE id = ?;",
+                (status, message, json.dumps(result) if result is not None else None, time.time(), status, job_id),
+            )
+
+def stats():
+    """Returns (job counts by status, stage timings of the latest completed job), e.g. for /metrics."""
+    with connection() as conn:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status;").fetchall())
+        row = conn.execute("SELECT result FROM jobs WHERE status = 'completed' AND result IS NOT NULL "
+                           "ORDER BY finished_at DESC LIMIT 1;").fetchone()
+    return counts, (json.loads(row[0]).get('timings') or {}) if row else {}
+
+def status_payload(job):
+    """Shapes a job for /retrain_status (the frontend reads status, progress, message and metrics)."""
+    payload = {
+        "retrain_id": job['id'],
+        "status": job['status'],
+        "progress": round(job['progress'] or 0, 1),
+        "message": job['message'],
+        "model": job['model_key'],
+        "created_at": job['created_at'],
+        "started_at": job['started_at'],
+        "finished_at": job['finished_at'],
+    }
+    if job['detail']:
+        payload.update(job['detail'])
+    if job['result']:
+        payload["metrics"] = job['result']
+    return payload
+
+# Web side: starting a worker on demand
+
+_worker_process = None
+_worker_process_lock = threading.Lock()
+
+def ensure_worker():
+    """Spawns a training process unless one started from here is still alive (RETRAIN_WORKER=auto).
+
+    The process exits on its own if every worker slot on the host is already taken,
+    or after five idle minutes.
+    """
+    global _worker_process
+    if RETRAIN_WORKER != 'auto':
+        return
+    with _worker_process_lock:
+        if _worker_process is None or _worker_process.poll() is not None:
+            repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            _worker_process = subprocess.Popen(
+                [sys.executable, '-m', 'src.jobs', 'worker', '--idle-timeout', '300'],
+                cwd=repo_root,
+            )
+
+# Worker side
+
+def make_progress_callback(job_id, epochs, batch_size=32, update_interval=1.0):
+    """Returns a Keras callback that streams epoch/batch progress into the job row and stops on cancel."""
+    import tensorflow as tf
+
+    class JobProgress(tf.keras.callbacks.Callback):
+        def __init__(self):
+            super().__init__()
+            self.cancelled = False
+            self._last_update = 0.0
+
+        def on_train_begin(self, logs=None):
+            self.train_start = time.perf_counter()
+            self.samples = 0
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.epoch = epoch
+            self.epoch_start = time.perf_counter()
+
+        def on_train_batch_end(self, batch, logs=None):
+            steps = self.params.get('steps') or 0
+            self.samples += batch_size
+            now = time.perf_counter()
+            if now - self._last_update < update_interval and batch + 1 != steps:
+                return
+            self._last_update = now
+            done = self.epoch + ((batch + 1) / steps if steps else 0)
+            detail = {
+                "epoch": self.epoch + 1,
+                "epochs": epochs,
+                "batch": batch + 1,
+                "steps": steps,
+                "loss": float(logs['loss']) if logs and 'loss' in logs else None,
+                "accuracy": float(logs['accuracy']) if logs and 'accuracy' in logs else None,
+                "images_per_sec": round(self.samples / (now - self.train_start), 1),
+            }
+            if update_progress(job_id, progress=min(99.0, 100.0 * done / epochs), detail=detail,
+                               message=f"Training epoch {self.epoch + 1}/{epochs}"):
+                self.cancelled = True
+                self.model.stop_training = True
+
+    return JobProgress()
+
+def _heartbeat(job_id, stop, interval=5.0):
+    """Keeps a running job alive while no callbacks fire (loading, evaluating, saving)."""
+    while not stop.wait(interval):
+        update_progress(job_id)
+
+def run_retrain(job, callback):
+    """Runs one retrain job with the progress callback attached and registers the result.
+
+    In incremental mode the parent version is fine-tuned on the rows newer than
+    the ones it was trained on; the new version records its own watermark.
+    The new version is scored on the held-out split (evaluation.EVAL_SPLIT) and
+    promoted if it does about as well as production there; `promote: false`
+    never promotes and `promote: "force"` skips the comparison. Returns its metrics.
+
+    Cancellation is honoured up to registration (JobCancelled); a cancel that
+    arrives after the version is registered only keeps it from being promoted.
+    """
+    from . import model, registry
+    params = job['params']
+    database_file = params['database_file']
+    # Seconds per stage, reported with the result (and on /metrics)
+    timings, mark = {}, [time.perf_counter()]
+
+    def cancel_requested():
+        return callback.cancelled or update_progress(job['id'])
+
+    def lap(stage):
+        now = time.perf_counter()
+        timings[stage] = round(now - mark[0], 3)
+        mark[0] = now
+
+    if not os.path.exists(database_file) and params.get('bucket_name'):
+        from . import sync
+        sync.DeltaSync(params['bucket_name'], params['database_key'], database_file=database_file).restore(database_file)
+    lap("restore")
+
+    models = registry.ModelRegistry(params['bucket_name'], params['base_model_key'])
+    parent = models.get(params['parent_version']) if params.get('parent_version') else None
+    mode = params.get('mode', RETRAIN_MODE)
+    if mode == 'incremental':
+        trained_through_id = ((parent or {}).get('training') or {}).get('trained_through_id', 0)
+        if not any(image_id > trained_through_id for image_id in model.get_retrain_index(database_file)[0]):
+            # Not a failure: the production version has already seen every row
+            return {"promoted": False, "skipped": "nothing new to train on", "trained_through_id": trained_through_id}
+        metrics = model.fine_tune_model_from_db(
+            database_file, params['bucket_name'], params['s3_model_file'], params['local_model_path'],
+            trained_through_id=trained_through_id, replay_ratio=params.get('replay_ratio', RETRAIN_REPLAY_RATIO),
+            freeze=params.get('freeze_backbone', RETRAIN_FREEZE_BACKBONE),
+            callbacks=[callback], epochs=params.get('epochs', 10), save_to_s3=False,
+        )
+    else:
+        metrics = model.retrain_model_from_db(
+            database_file, params['bucket_name'], params['s3_model_file'], params['local_model_path'],
+            callbacks=[callback], epochs=params.get('epochs', 10), save_to_s3=False,
+        )
+    if callback.cancelled:
+        raise JobCancelled()
+    if metrics is None:
+        raise RuntimeError("Retraining produced no model (see the worker log)")
+    lap("train")
+    model_path, label_encoder_path = metrics.pop("model_path"), metrics.pop("label_encoder_path")
+    metrics = {key: float(value) if key in ('loss', 'accuracy') else value for key, value in metrics.items()}
+    # What fit() saw is not a fair score; report it as training metrics
+    metrics["train_loss"], metrics["train_accuracy"] = metrics.pop("loss"), metrics.pop("accuracy")
+    metrics["metrics_table"] = metrics.pop("report")
+
+    held_out = None
+    try:
+        import tensorflow as tf
+        from . import evaluation
+        update_progress(job['id'], progress=99.0, message="Evaluating on held-out data")
+        split = evaluation.load_split(evaluation.EVAL_SPLIT, database_file)
+        held_out = evaluation.evaluate(tf.keras.models.load_model(model_path), split)
+        metrics.update(loss=held_out["loss"], accuracy=held_out["accuracy"], evaluation=held_out,
+                       metrics_table=evaluation.format_report(held_out))
+    except Exception as e:
+        print(f"Held-out evaluation failed, promoting on training metrics: {e}")
+    lap("evaluate")
+
+    if cancel_requested():
+        raise JobCancelled()
+    training = dict(metrics["training"], parent_version=parent['version'] if parent else None)
+    entry = models.register(model_path, metrics={"loss": metrics.get("loss", metrics["train_loss"]),
+                                                 "accuracy": metrics.get("accuracy", metrics["train_accuracy"])},
+                            source=f"retrain:{job['id']}", label_encoder_path=label_encoder_path, training=training)
+    if held_out is not None:
+        models.record_evaluation(entry['version'], held_out)
+    lap("register")
+
+    # The quantized artifact is in place before the version can be promoted and picked up
+    from . import export
+    if export.TFLITE_EXPORT != 'off':
+        try:
+            import tensorflow as tf
+            update_progress(job['id'], message="Exporting TFLite model")
+            calibration = split if held_out is not None and split.name == export.CALIBRATION_SPLIT else None
+            metrics["tflite"] = export.export_version(models, entry, tf.keras.models.load_model(model_path),
+                                                      split=calibration)
+        except Exception as e:
+            print(f"TFLite export failed: {e}")
+    lap("export")
+
+    promote, reason = params.get('promote', True), None
+    if promote and promote != 'force' and held_out is not None:
+        production = models.production()
+        if production is not None and production['version'] != entry['version']:
+            baseline = evaluation.evaluate_version(models, production, split, local_path=params['local_model_path']
+                                                   if production['key'] == params['s3_model_file'] else None)
+            metrics["production_accuracy"] = baseline["accuracy"]
+            if held_out["accuracy"] < baseline["accuracy"] - PROMOTE_TOLERANCE:
+                promote = False
+                reason = (f"held-out accuracy {held_out['accuracy']:.4f} is below production "
+                          f"v{production['version']}'s {baseline['accuracy']:.4f}")
+    if promote and cancel_requested():
+        # Too late to undo the registration; just don't put it in front of traffic
+        promote, reason = False, "cancelled before promotion"
+    if promote:
+        models.promote(entry['version'])
+    lap("promote")
+    metrics["promoted"] = bool(promote)
+    if reason:
+        metrics["not_promoted_reason"] = reason
+        print(f"Not promoting version {entry['version']}: {reason}")
+    metrics["version"] = entry['version']
+    metrics["artifact"] = entry['key']
+    metrics["timings"] = timings
+    return metrics
+
+JOB_RUNNERS = {"retrain": run_retrain}
+
+def run_job(job):
+    epochs = job['params'].get('epochs', 10)
+    callback = make_progress_callback(job['id'], epochs)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(job['id'], stop), daemon=True)
+    heartbeat.start()
+    start = time.perf_counter()
+    try:
+        # The runner stops at the last point it safely can; past that the job completes
+        result = JOB_RUNNERS[job['kind']](job, callback)
+        result["seconds"] = round(time.perf_counter() - start, 1)
+        if result.get("skipped"):
+            message = f"Retraining completed; {result['skipped']}"
+        elif result.get("promoted", True):
+            message = "Retraining completed"
+        else:
+            message = f"Retraining completed; version {result.get('version')} not promoted ({result.get('not_promoted_reason', 'promote: false')})"
+        finish(job['id'], 'completed', message, result)
+    except JobCancelled:
+        finish(job['id'], 'cancelled', "Retraining cancelled")
+    except Exception as e:
+        print(f"Job {job['id']} failed: {e}")
+        finish(job['id'], 'failed', f"Retraining failed: {e}")
+    finally:
+        stop.set()
+        heartbeat.join()
+
+def _acquire_worker_slot():
+    """Locks one of RETRAIN_WORKERS slot files; returns the open file, or None if all are taken."""
+    if fcntl is None:
+        return open(os.devnull)
+    for slot in range(RETRAIN_WORKERS):
+        lock_file = open(f"{os.path.abspath(JOBS_DATABASE_PATH)}.worker{slot}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except OSError:
+            lock_file.close()
+    return None
+
+def run_worker(poll_interval=1.0, idle_timeout=0.0):
+    """Claims and runs queued jobs until idle for `idle_timeout` seconds (0 runs forever)."""
+    slot = _acquire_worker_slot()
+    if slot is None:
+        print(f"All {RETRAIN_WORKERS} worker slots are busy, exiting")
+        return 0
+
+    # Training yields the CPU to the web workers serving predictions
+    if hasattr(os, 'nice'):
+        os.nice(10)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(RETRAIN_THREADS)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    worker_name = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"Job worker {worker_name} started ({RETRAIN_THREADS} TF threads)")
+    idle_since = time.monotonic()
+    while True:
+        recover_stale_jobs()
+        job = claim_next(worker_name)
+        if job is None:
+            if idle_timeout and time.monotonic() - idle_since > idle_timeout:
+                print(f"Job worker {worker_name} idle, exiting")
+                return 0
+            time.sleep(poll_interval)
+            continue
+        print(f"Running {job['kind']} job {job['id']} for {job['model_key']}")
+        run_job(job)
+        idle_since = time.monotonic()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Background job worker (retraining).")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    worker = subcommands.add_parser("worker", help="Run queued jobs")
+    worker.add_argument("--poll-interval", type=float, default=1.0)
+    worker.add_argument("--idle-timeout", type=float, default=0.0, help="Exit after this many idle seconds (0: never)")
+    cancel_parser = subcommands.add_parser("cancel", help="Cancel a job")
+    cancel_parser.add_argument("job_id")
+    show = subcommands.add_parser("status", help="Show a job")
+    show.add_argument("job_id")
+    args = parser.parse_args(argv)
+
+    if args.command == "worker":
+        return run_worker(args.poll_interval, args.idle_timeout)
+    job = cancel(args.job_id) if args.command == "cancel" else get_job(args.job_id)
+    print(json.dumps(status_payload(job) if job else {"error": "Job not found"}, indent=2))
+    return 0 if job else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,151 +1,329 @@
 import tensorflow as tf
-import boto3
-import pandas as pd
 from . import preprocessing  
+from . import feature_store
+from . import storage
 import os
 import pickle
 import tempfile
-import sqlite3
+import threading
+import time
+import numpy as np
 from sklearn.metrics import classification_report
+import database
+
+# Deserialized models by (bucket, key) -> (etag, model), so an unchanged artifact is loaded once
+_model_cache = {}
+_model_cache_lock = threading.Lock()
 
-# Create the S3 client
 try:
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-        region_name=os.environ.get('AWS_DEFAULT_REGION'),
-    )
-except Exception as e:
-    print(f"Error initializing boto3 client: {e}")
-    s3_client = None
+    from ai_edge_litert.interpreter import Interpreter as TFLiteInterpreter
+except ImportError:  # older TensorFlow ships the interpreter itself
+    TFLiteInterpreter = tf.lite.Interpreter
+
+# CPU threads per TFLite interpreter (one interpreter per serving model)
+TFLITE_THREADS = int(os.environ.get('TFLITE_THREADS', 1))
+
+# Class index -> label, matching the LabelEncoder ordering used in training
+LABEL_MAP = preprocessing.LABEL_MAP
 
-# Database Configuration
-DATABASE_FILE = "my_base.db"
+def load_model_from_s3(bucket_name, s3_file_path, local_file_path, use_memory_cache=True):
+    """Loads a TensorFlow Keras model from Amazon S3.
 
-def load_model_from_s3(bucket_name, s3_file_path, local_file_path):
-    """Loads a TensorFlow Keras model from Amazon S3."""
+    The file is only downloaded when its ETag differs from the copy cached at
+    `local_file_path`, and an unchanged version is returned from memory. Pass
+    `use_memory_cache=False` to get a private copy that is safe to train.
+    """
     try:
-        s3.download_file(bucket_name, s3_file_path, local_file_path)
-        print(f"Model downloaded to: {local_file_path}") 
-        if os.path.exists(local_file_path): 
-            model = tf.keras.models.load_model(local_file_path)
+        etag = storage.download_artifact(bucket_name, s3_file_path, local_file_path)
+        cache_key = (bucket_name, s3_file_path)
+        if use_memory_cache:
+            with _model_cache_lock:
+                cached = _model_cache.get(cache_key)
+            if cached is not None and cached[0] == etag:
+                return cached[1]
+
+        model = tf.keras.models.load_model(local_file_path)
+        if use_memory_cache:
+            with _model_cache_lock:
+                _model_cache[cache_key] = (etag, model)
         return model
     except Exception as e:
         print(f"Error loading model from S3: {e}")
         return None
 
+def evict_model(bucket_name, s3_file_path):
+    """Drops a deserialized model from the in-memory cache, e.g. once it stops being served."""
+    with _model_cache_lock:
+        _model_cache.pop((bucket_name, s3_file_path), None)
+
 def save_model_to_s3(bucket_name, s3_file_path, local_file_path):
     """Saves a TensorFlow Keras model to Amazon S3."""
     try:
-        s3.upload_file(local_file_path, bucket_name, s3_file_path)
+        storage.upload_artifact(local_file_path, bucket_name, s3_file_path)
         print(f"Model saved to S3: {s3_file_path}")
     except Exception as e:
         print(f"Error saving model to S3: {e}")
 
-def insert_retrain_image_data(image_path, label, data_type='retrain'):
-    """Inserts retrain image data and label into the database."""
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cur = conn.cursor()
+def get_retrain_data_from_db(database_file):
+    """Retrieves all retraining data from the database."""
+    with database.connection(database_file) as conn:
+        rows = conn.execute("SELECT image_data, content_hash, label FROM images WHERE data_type = 'retrain' AND duplicate_of IS NULL;").fetchall()
+    return [(database.resolve_image_data(image_data, content_hash), label) for image_data, content_hash, label in rows]
 
-        with open(image_path, 'rb') as image_file:
-            image_data = image_file.read()
+def iter_retrain_rows(database_file, chunk_size=256):
+    """Yields (image_bytes, label) retrain rows, fetching from SQLite in cursor chunks."""
+    with database.connection(database_file) as conn:
+        cur = conn.execute("SELECT image_data, content_hash, label FROM images WHERE data_type = 'retrain' AND duplicate_of IS NULL;")
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for image_data, content_hash, label in rows:
+                yield bytes(database.resolve_image_data(image_data, content_hash)), label
 
-        cur.execute("INSERT INTO images (image_data, label, data_type) VALUES (?, ?, ?);", (sqlite3.Binary(image_data), label, data_type))
+def get_retrain_labels(database_file):
+    """Returns the distinct labels present in the retrain data."""
+    with database.connection(database_file) as conn:
+        return [row[0] for row in conn.execute("SELECT DISTINCT label FROM images WHERE data_type = 'retrain' AND duplicate_of IS NULL;")]
 
-        conn.commit()
-        conn.close()
-        print(f"Retrain image '{image_path}' inserted successfully.")
+def get_retrain_index(database_file):
+    """Returns the ids and labels of the retrain rows, without loading image data."""
+    with database.connection(database_file) as conn:
+        rows = conn.execute("SELECT id, label FROM images WHERE data_type = 'retrain' AND duplicate_of IS NULL ORDER BY id;").fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
 
-    except sqlite3.Error as e:
-        print(f"Error inserting retrain image: {e}")
+def decode_image_tensor(image_bytes, target_size=(128, 128)):
+    """Decodes, resizes and normalizes an encoded image inside a tf.data pipeline."""
+    image = tf.io.decode_image(image_bytes, channels=3, expand_animations=False)
+    image = tf.image.resize(image, target_size, method="bicubic", antialias=True)
+    return tf.clip_by_value(image / 255.0, 0.0, 1.0)
 
-def populate_retrain_database_from_csv(csv_path, images_dir):
-    """Populates the database with retrain data using a CSV and images directory."""
-    try:
-        df = pd.read_csv(csv_path)
+def build_retrain_dataset(database_file, label_encoder, batch_size=32, shuffle=True,
+                          shuffle_buffer=512, chunk_size=256, target_size=(128, 128)):
+    """Builds a batched, prefetching tf.data pipeline that streams retrain images from SQLite.
 
-        for index, row in df.iterrows():
-            image_filename = row['filename']
-            label = row['class']
-            image_path = os.path.join(images_dir, image_filename)
+    Only `shuffle_buffer` encoded images plus a few decoded batches are held in
+    memory at once, so the footprint stays flat as the retrain set grows.
+    """
+    class_ids = {label: index for index, label in enumerate(label_encoder.classes_)}
 
-            if os.path.exists(image_path):
-                insert_retrain_image_data(image_path, label)
-            else:
-                print(f"Warning: Retrain image '{image_path}' not found.")
+    def generator():
+        for image_data, label in iter_retrain_rows(database_file, chunk_size):
+            yield image_data, class_ids[label]
 
-    except Exception as e:
-        print(f"Error populating retrain database from CSV: {e}")
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        output_signature=(tf.TensorSpec(shape=(), dtype=tf.string), tf.TensorSpec(shape=(), dtype=tf.int64)),
+    )
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    dataset = dataset.map(
+        lambda image_data, label: (decode_image_tensor(image_data, target_size), label),
+        num_parallel_calls=tf.data.AUTOTUNE,
+    )
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
 
-def get_retrain_data_from_db(database_file):
-    """Retrieves all retraining data from the database."""
-    conn = sqlite3.connect(database_file)
-    cur = conn.cursor()
-    cur.execute("SELECT image_data, label FROM images WHERE data_type = 'retrain';")
-    retrain_data = cur.fetchall()
-    conn.close()
-    return retrain_data
-
-def retrain_model_from_db(database_file, bucket_name, s3_model_file, local_model_path):
-    """Retrains the model using data from the database and returns metrics."""
-    try:
-        loaded_model = load_model_from_s3(bucket_name, s3_model_file, local_model_path)
+def build_feature_dataset(store, image_ids, encoded_labels, batch_size=32, shuffle=True):
+    """Builds a batched tf.data pipeline that slices preprocessed tensors out of a FeatureStore."""
+    positions = store.positions(image_ids)
+    pixels = store.array()
+    batch_shape = (None,) + store.item_shape
+
+    def gather(batch_positions):
+        return pixels[batch_positions]
 
-        retrain_data = get_retrain_data_from_db(database_file)
+    dataset = tf.data.Dataset.from_tensor_slices((positions, np.asarray(encoded_labels, dtype=np.int64)))
+    if shuffle:
+        # Only positions are shuffled, so a full-size buffer is cheap
+        dataset = dataset.shuffle(len(positions), reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(
+        lambda batch_positions, labels: (
+            tf.cast(tf.ensure_shape(tf.numpy_function(gather, [batch_positions], tf.uint8), batch_shape), tf.float32) / 255.0,
+            labels,
+        ),
+        num_parallel_calls=tf.data.AUTOTUNE,
+    )
+    return dataset.prefetch(tf.data.AUTOTUNE)
 
-        # Process retrain_data
-        local_test_images = os.path.join(tempfile.gettempdir(), "retrain_images")
-        os.makedirs(local_test_images, exist_ok=True)
+def retrain_model_from_db(database_file, bucket_name, s3_model_file, local_model_path, use_feature_store=True,
+                          callbacks=None, epochs=10, save_to_s3=True):
+    """Retrains the model using data from the database and returns metrics.
 
-        csv_data = []
-        for index, row in enumerate(retrain_data):
-            image_filename = f"image_{index}.jpg"
-            image_path = os.path.join(local_test_images, image_filename)
-            with open(image_path, "wb") as f:
-                f.write(row[0]) #image data
-            csv_data.append({"filename": image_filename, "class": row[1]}) #label
+    `callbacks` are passed to `fit`, e.g. to report progress or stop early. The
+    metrics include the local paths of the saved model and label encoder; with
+    `save_to_s3=False` they are left for the caller to publish (e.g. to the registry).
+    """
+    try:
+        # Private copy: fit() must not mutate a model that may be serving traffic
+        loaded_model = load_model_from_s3(bucket_name, s3_model_file, local_model_path, use_memory_cache=False)
 
-        local_test_csv = os.path.join(tempfile.gettempdir(), "retrain_data.csv")
-        pd.DataFrame(csv_data).to_csv(local_test_csv, index=False)
+        # Watermark taken before training: rows inserted while fit() runs are left for the next job
+        image_ids, labels = get_retrain_index(database_file)
+        trained_through_id = max(image_ids) if image_ids else 0
+        if use_feature_store:
+            # Decode only rows that were never preprocessed before, then train from the mmap
+            store = feature_store.FeatureStore()
+            store.update_from_db(database_file, image_ids)
+            kept = [(image_id, label) for image_id, label in zip(image_ids, labels) if image_id in store]
+            if not kept:
+                print("No retrain data found in the database.")
+                return None
+            image_ids, labels = zip(*kept)
+            label_encoder, encoded_labels = preprocessing.encode_labels(list(labels))
 
-        preprocessed_images, encoded_labels, label_encoder = preprocessing.preprocess_and_encode(local_test_csv, local_test_images)
+            train_dataset = build_feature_dataset(store, image_ids, encoded_labels, shuffle=True)
+            eval_dataset = build_feature_dataset(store, image_ids, encoded_labels, shuffle=False)
+        else:
+            labels = get_retrain_labels(database_file)
+            if not labels:
+                print("No retrain data found in the database.")
+                return None
+            label_encoder, _ = preprocessing.encode_labels(labels)
+
+            # Stream images from SQLite instead of materializing the whole set in memory
+            train_dataset = build_retrain_dataset(database_file, label_encoder, shuffle=True)
+            eval_dataset = build_retrain_dataset(database_file, label_encoder, shuffle=False)
 
         # Retrain the model
-        retrained_model = loaded_model.fit(preprocessed_images, encoded_labels, epochs=10, batch_size=32)
+        history = loaded_model.fit(train_dataset, epochs=epochs, callbacks=callbacks)
+        metrics = _evaluate_and_save(loaded_model, label_encoder, eval_dataset, bucket_name, save_to_s3)
+        metrics["training"] = {"mode": "full", "trained_through_id": trained_through_id,
+                               "rows": len(image_ids), "epochs_run": len(history.history.get('loss', []))}
+        return metrics
+
+    except Exception as e:
+        print(f"Error retraining model: {e}")
+        return None
 
-        # Evaluate the model
-        evaluation_metrics = loaded_model.evaluate(preprocessed_images, encoded_labels) 
+def _evaluate_and_save(trained_model, label_encoder, eval_dataset, bucket_name, save_to_s3):
+    """Evaluates a trained model, saves it and its label encoder, and returns metrics with a classification report.
 
-        # Save the retrained model to S3
-        retrained_model_local_path = os.path.join(tempfile.gettempdir(), "retrained_model.keras")
-        retrained_model.model.save(retrained_model_local_path)
+    Loss, accuracy and the report come from one prediction pass over `eval_dataset`.
+    """
+    # Save the retrained model to S3
+    retrained_model_local_path = os.path.join(tempfile.gettempdir(), "retrained_model.keras")
+    trained_model.save(retrained_model_local_path)
+    if save_to_s3:
         save_model_to_s3(bucket_name, "models/retrained_model.keras", retrained_model_local_path)
 
-        # save label encoder to s3.
-        label_encoder_local_path = os.path.join(tempfile.gettempdir(), "label_encoder.pkl")
-        with open(label_encoder_local_path, 'wb') as f:
-            pickle.dump(label_encoder, f)
+    # save label encoder to s3.
+    label_encoder_local_path = os.path.join(tempfile.gettempdir(), "label_encoder.pkl")
+    with open(label_encoder_local_path, 'wb') as f:
+        pickle.dump(label_encoder, f)
+    if save_to_s3:
         save_model_to_s3(bucket_name, "models/label_encoder.pkl", label_encoder_local_path)
 
-        # Generate classification report
-        predicted_labels = loaded_model.predict(preprocessed_images)
-        predicted_labels = tf.argmax(predicted_labels, axis=1).numpy()
-        decoded_labels = label_encoder.inverse_transform(encoded_labels)
-        decoded_predicted_labels = label_encoder.inverse_transform(predicted_labels)
-        report = classification_report(decoded_labels, decoded_predicted_labels)
+    # Generate classification report
+    encoded_labels = []
+    predicted_labels = []
+    losses = []
+    for images, batch_labels in eval_dataset:
+        predictions = trained_model(images, training=False)
+        losses.extend(tf.keras.losses.sparse_categorical_crossentropy(batch_labels, predictions).numpy())
+        predicted_labels.extend(np.argmax(predictions, axis=1))
+        encoded_labels.extend(batch_labels.numpy())
+    accuracy = float(np.mean(np.asarray(predicted_labels) == np.asarray(encoded_labels))) if encoded_labels else 0.0
+    decoded_labels = label_encoder.inverse_transform(encoded_labels)
+    decoded_predicted_labels = label_encoder.inverse_transform(predicted_labels)
+    report = classification_report(decoded_labels, decoded_predicted_labels, zero_division=0)
+
+    return {"loss": float(np.mean(losses)) if losses else 0.0, "accuracy": accuracy, "report": report,
+            "model_path": retrained_model_local_path, "label_encoder_path": label_encoder_local_path}
+
+def select_incremental_rows(image_ids, labels, trained_through_id, replay_ratio=1.0, seed=None):
+    """Splits retrain rows into the ones a model hasn't seen (id > trained_through_id) and a replay sample of the rest.
+
+    The replay sample has `replay_ratio` old rows per new row, so each
+    fine-tune touches a number of rows proportional to what was added.
+    Returns (ids, labels, new_count, replay_count).
+    """
+    rows = list(zip(image_ids, labels))
+    new_rows = [row for row in rows if row[0] > trained_through_id]
+    old_rows = [row for row in rows if row[0] <= trained_through_id]
+    replay_count = min(len(old_rows), int(round(replay_ratio * len(new_rows))))
+    rng = np.random.default_rng(seed)
+    replay_rows = [old_rows[i] for i in rng.choice(len(old_rows), replay_count, replace=False)] if replay_count else []
+    selected = new_rows + replay_rows
+    return [row[0] for row in selected], [row[1] for row in selected], len(new_rows), len(replay_rows)
+
+def freeze_backbone(keras_model):
+    """Freezes the convolutional feature extractor (every layer before the first Dense). Returns the frozen count."""
+    frozen = 0
+    for layer in keras_model.layers:
+        if isinstance(layer, tf.keras.layers.Dense):
+            break
+        if layer.weights:
+            layer.trainable = False
+            frozen += 1
+    return frozen
+
+def fine_tune_model_from_db(database_file, bucket_name, s3_model_file, local_model_path, trained_through_id=0,
+                            replay_ratio=1.0, freeze=True, epochs=10, patience=2, learning_rate=1e-4,
+                            validation_split=0.2, callbacks=None, save_to_s3=True):
+    """Fine-tunes a model on retrain rows newer than `trained_through_id` plus a replay sample of older ones.
 
-        return {"loss": evaluation_metrics[0], "accuracy": evaluation_metrics[1], "report": report}
+    Stops early once validation loss stops improving, so cost follows the
+    number of new rows rather than the size of the table. Returns metrics like
+    `retrain_model_from_db`, or None if there is nothing new to train on.
+    """
+    try:
+        image_ids, labels = get_retrain_index(database_file)
+        if not image_ids:
+            print("No retrain data found in the database.")
+            return None
+        # Fit on every label so class indices match the full retrain set
+        label_encoder, _ = preprocessing.encode_labels(labels)
+        selected_ids, selected_labels, new_count, replay_count = select_incremental_rows(
+            image_ids, labels, trained_through_id, replay_ratio)
+        if not new_count:
+            print(f"No retrain rows newer than id {trained_through_id}.")
+            return None
+
+        # Only the selected rows are decoded (and only the first time they are used)
+        store = feature_store.FeatureStore()
+        store.update_from_db(database_file, selected_ids)
+        kept = [(image_id, label) for image_id, label in zip(selected_ids, selected_labels) if image_id in store]
+        rng = np.random.default_rng()
+        kept = [kept[i] for i in rng.permutation(len(kept))]
+        selected_ids = [image_id for image_id, _ in kept]
+        encoded_labels = label_encoder.transform([label for _, label in kept])
+
+        # Hold out part of the selection for early stopping and the report
+        holdout = int(len(selected_ids) * validation_split) if len(selected_ids) >= 10 else 0
+        train_dataset = build_feature_dataset(store, selected_ids[holdout:], encoded_labels[holdout:], shuffle=True)
+        if holdout:
+            eval_dataset = build_feature_dataset(store, selected_ids[:holdout], encoded_labels[:holdout], shuffle=False)
+        else:
+            eval_dataset = build_feature_dataset(store, selected_ids, encoded_labels, shuffle=False)
+
+        # Private copy: fit() must not mutate a model that may be serving traffic
+        loaded_model = load_model_from_s3(bucket_name, s3_model_file, local_model_path, use_memory_cache=False)
+        frozen = freeze_backbone(loaded_model) if freeze else 0
+        loaded_model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+                             loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+        early_stopping = tf.keras.callbacks.EarlyStopping(
+            monitor='val_loss' if holdout else 'loss', patience=patience, restore_best_weights=True)
+        history = loaded_model.fit(train_dataset, validation_data=eval_dataset if holdout else None,
+                                   epochs=epochs, callbacks=[early_stopping] + list(callbacks or []))
+
+        # Saved models come back fully trainable, so a later full retrain isn't frozen
+        for layer in loaded_model.layers:
+            layer.trainable = True
+        metrics = _evaluate_and_save(loaded_model, label_encoder, eval_dataset, bucket_name, save_to_s3)
+        metrics["training"] = {"mode": "incremental", "trained_through_id": max(image_ids), "new_rows": new_count,
+                               "replay_rows": replay_count, "frozen_layers": frozen,
+                               "epochs_run": len(history.history.get('loss', []))}
+        return metrics
 
     except Exception as e:
-        print(f"Error retraining model: {e}")
+        print(f"Error fine-tuning model: {e}")
         return None
 
 def load_label_encoder_from_s3(bucket_name, s3_file_path, local_file_path):
     """Loads a LabelEncoder from Amazon S3."""
     try:
-        s3.download_file(bucket_name, s3_file_path, local_file_path)
+        storage.download_artifact(bucket_name, s3_file_path, local_file_path)
         with open(local_file_path, 'rb') as f:
             le = pickle.load(f)
         return le
@@ -153,12 +331,157 @@ def load_label_encoder_from_s3(bucket_name, s3_file_path, local_file_path):
         print(f"Error loading LabelEncoder from S3: {e}")
         return None
 
+class ServingModel:
+    """Wraps a Keras model in a traced inference function with fixed batch-size signatures.
+
+    Batches are zero-padded up to the nearest traced size so every call hits an
+    already-compiled graph instead of going through `model.predict`.
+    """
+
+    def __init__(self, keras_model, batch_sizes=(1, 4, 8, 16, 32)):
+        self.model = keras_model
+        self.batch_sizes = tuple(sorted(batch_sizes))
+        self.input_shape = tuple(keras_model.input_shape[1:])
+        self.calls = 0
+        self.total_latency_ms = 0.0
+        self.last_latency_ms = 0.0
+
+        infer = tf.function(lambda images: keras_model(images, training=False))
+        self._functions = {
+            size: infer.get_concrete_function(tf.TensorSpec((size,) + self.input_shape, tf.float32))
+            for size in self.batch_sizes
+        }
+
+    def warmup(self, rounds=2):
+        """Runs each traced signature so the first real request doesn't pay for it."""
+        for size, fn in self._functions.items():
+            dummy = tf.zeros((size,) + self.input_shape, tf.float32)
+            for _ in range(rounds):
+                fn(dummy)
+        print(f"Serving model warmed up for batch sizes {self.batch_sizes}")
+
+    def predict(self, preprocessed_images):
+        """Returns class probabilities for a batch of preprocessed images."""
+        start = time.perf_counter()
+        images = np.asarray(preprocessed_images, dtype=np.float32)
+        largest = self.batch_sizes[-1]
+        outputs = []
+        for offset in range(0, len(images), largest):
+            chunk = images[offset:offset + largest]
+            size = next(s for s in self.batch_sizes if s >= len(chunk))
+            if size != len(chunk):
+                padding = np.zeros((size - len(chunk),) + chunk.shape[1:], dtype=np.float32)
+                chunk = np.concatenate([chunk, padding])
+            result = self._functions[size](tf.constant(chunk))
+            outputs.append(np.asarray(result)[:len(images) - offset])
+        predictions = np.concatenate(outputs)
+
+        self.last_latency_ms = (time.perf_counter() - start) * 1000.0
+        self.calls += 1
+        self.total_latency_ms += self.last_latency_ms
+        return predictions
+
+    def stats(self):
+        """Returns call count and latency figures for the serving function."""
+        average = self.total_latency_ms / self.calls if self.calls else 0.0
+        return {"calls": self.calls, "last_latency_ms": self.last_latency_ms, "avg_latency_ms": average}
+
+class TFLiteModel:
+    """Runs a TFLite artifact (e.g. a quantized export) with the same interface as ServingModel.
+
+    Batches are zero-padded to the nearest of `batch_sizes`, and the interpreter
+    is only resized when that size changes. The interpreter isn't thread-safe,
+    so calls are serialized.
+    """
+
+    def __init__(self, model_path, batch_sizes=(1, 4, 8, 16, 32), num_threads=TFLITE_THREADS):
+        self.model_path = model_path
+        self.batch_sizes = tuple(sorted(batch_sizes))
+        self.calls = 0
+        self.total_latency_ms = 0.0
+        self.last_latency_ms = 0.0
+        self._interpreter = TFLiteInterpreter(model_path=model_path, num_threads=num_threads)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self.input_shape = tuple(int(dim) for dim in self._input['shape'][1:])
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def _run(self, chunk):
+        if len(chunk) != self._batch_size:
+            self._interpreter.resize_tensor_input(self._input['index'], (len(chunk),) + self.input_shape)
+            self._interpreter.allocate_tensors()
+            self._batch_size = len(chunk)
+        self._interpreter.set_tensor(self._input['index'], chunk)
+        self._interpreter.invoke()
+        return self._interpreter.get_tensor(self._output['index'])
+
+    def warmup(self):
+        with self._lock:
+            self._run(np.zeros((self.batch_sizes[0],) + self.input_shape, dtype=np.float32))
+        print(f"TFLite model warmed up ({os.path.basename(self.model_path)})")
+
+    def predict(self, preprocessed_images):
+        """Returns class probabilities for a batch of preprocessed images."""
+        start = time.perf_counter()
+        images = np.asarray(preprocessed_images, dtype=np.float32)
+        largest = self.batch_sizes[-1]
+        outputs = []
+        with self._lock:
+            for offset in range(0, len(images), largest):
+                chunk = images[offset:offset + largest]
+                size = next(s for s in self.batch_sizes if s >= len(chunk))
+                if size != len(chunk):
+                    padding = np.zeros((size - len(chunk),) + chunk.shape[1:], dtype=np.float32)
+                    chunk = np.concatenate([chunk, padding])
+                outputs.append(self._run(chunk)[:len(images) - offset].copy())
+        predictions = np.concatenate(outputs)
+
+        self.last_latency_ms = (time.perf_counter() - start) * 1000.0
+        self.calls += 1
+        self.total_latency_ms += self.last_latency_ms
+        return predictions
+
+    def stats(self):
+        average = self.total_latency_ms / self.calls if self.calls else 0.0
+        return {"calls": self.calls, "last_latency_ms": self.last_latency_ms, "avg_latency_ms": average}
+
+def load_serving_model(bucket_name, s3_file_path, local_file_path):
+    """Downloads an artifact and returns it ready to serve: a TFLiteModel for .tflite files, else a ServingModel."""
+    if s3_file_path.endswith(".tflite"):
+        try:
+            storage.download_artifact(bucket_name, s3_file_path, local_file_path)
+            serving_model = TFLiteModel(local_file_path)
+            serving_model.warmup()
+            return serving_model
+        except Exception as e:
+            print(f"Error loading TFLite model: {e}")
+            return None
+    return prepare_for_serving(load_model_from_s3(bucket_name, s3_file_path, local_file_path))
+
+def prepare_for_serving(keras_model, batch_sizes=(1, 4, 8, 16, 32)):
+    """Wraps a loaded Keras model in a warmed-up ServingModel."""
+    if keras_model is None:
+        return None
+    try:
+        serving_model = ServingModel(keras_model, batch_sizes)
+        serving_model.warmup()
+        return serving_model
+    except Exception as e:
+        print(f"Error preparing serving model, falling back to model.predict: {e}")
+        return keras_model
+
+def check_serving_model(serving_model, target_size=(128, 128)):
+    """Runs a blank image through a model before it takes traffic; True if it returns a known class."""
+    labels = make_predictions(serving_model, np.zeros((1, target_size[1], target_size[0], 3), dtype=np.float32))
+    return labels is not None and len(labels) == 1 and int(labels[0]) in LABEL_MAP
+
 def make_predictions(model, preprocessed_images):
     """Makes predictions using the loaded model."""
     try:
         predictions = model.predict(preprocessed_images)
-        predicted_labels = tf.argmax(predictions, axis=1).numpy() #converts tensor to numpy array
+        predicted_labels = np.argmax(predictions, axis=1)
         return predicted_labels
     except Exception as e:
         print(f"Error making predictions: {e}")
-        return None
\ No newline at end of file
+        return None
@@ -1,37 +1,117 @@
-import tensorflow as tf
+import io
 import os
-import pandas as pd
-from sklearn.preprocessing import LabelEncoder
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PIL import Image
 
-def load_image(image_path, target_size=(128, 128)):
-    """Loads and resizes an image."""
-    try:
-        img = Image.open(image_path).convert('RGB')
+# Class index -> label, matching the LabelEncoder ordering used in training
+LABEL_MAP = {
+    0: "bxw",
+    1: "healthy",
+}
+
+def open_image(source):
+    """Opens a path, file-like object, raw bytes, or decoded array as a PIL image.
+
+    Float arrays with values in [0, 1] (e.g. already normalized) are scaled
+    back to 0-255; other float and integer arrays are clipped to 0-255.
+    """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(source))
+    if isinstance(source, np.ndarray):
+        if np.issubdtype(source.dtype, np.floating):
+            if source.size and source.max() <= 1.0:
+                source = source * 255.0
+            source = np.clip(np.rint(source), 0, 255).astype(np.uint8)
+        elif np.issubdtype(source.dtype, np.integer) and source.dtype != np.uint8:
+            source = np.clip(source, 0, 255).astype(np.uint8)
+        elif source.dtype != np.uint8:
+            raise ValueError(f"Unsupported image array dtype {source.dtype}")
+        return Image.fromarray(source)
+    return Image.open(source)
+
+def load_image_uint8(source, target_size=(128, 128), draft=False):
+    """Decodes and resizes an image to an RGB uint8 array without normalizing.
+
+    With `draft=True`, JPEGs are decoded at a reduced scale (1/2, 1/4 or 1/8)
+    that is still at least `target_size`, which is much cheaper for large images.
+    """
+    img = open_image(source)
+    if draft and img.format == 'JPEG':
+        img.draft('RGB', tuple(target_size))
+    img = img.convert('RGB')
+    if img.size != tuple(target_size):
         img = img.resize(target_size)
-        img_array = tf.keras.preprocessing.image.img_to_array(img)
-        img_array = img_array / 255.0  # Normalize pixel values
+    return np.asarray(img, dtype=np.uint8)
+
+def load_image(source, target_size=(128, 128)):
+    """Decodes, resizes and normalizes an image in one pass.
+
+    `source` can be a file path, a file-like object, raw encoded bytes, a PIL
+    image or an already-decoded uint8 array. Returns a float32 array in [0, 1].
+    """
+    try:
+        img_array = load_image_uint8(source, target_size).astype(np.float32) / 255.0  # Normalize pixel values
         return img_array
     except Exception as e:
         print(f"Error loading image: {e}")
         return None
 
-def preprocess_image(image_path, target_size=(128, 128)):
-    """Preprocesses a single image."""
-    return load_image(image_path, target_size)
+def preprocess_image(source, target_size=(128, 128)):
+    """Preprocesses a single image from a path, bytes, buffer or array."""
+    return load_image(source, target_size)
+
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+def _get_batch_executor():
+    """Returns the shared thread pool used for batch preprocessing."""
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            workers = int(os.environ.get('PREPROCESS_WORKERS', min(32, (os.cpu_count() or 1) + 4)))
+            _batch_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+        return _batch_executor
+
+def preprocess_batch(image_paths, target_size=(128, 128), draft=False, return_mask=False):
+    """Preprocesses a batch of images (paths, bytes, buffers or arrays) in parallel.
+
+    Decode and resize run on a thread pool (PIL releases the GIL for both) and
+    each result is written straight into one preallocated float32 array.
+    Images that fail to load are dropped, as before; pass `return_mask=True`
+    to also get a boolean array marking which inputs were kept.
+    """
+    sources = list(image_paths)
+    if not sources:
+        return (np.array([]), np.zeros(0, dtype=bool)) if return_mask else np.array([])
+
+    width, height = target_size
+    output = np.empty((len(sources), height, width, 3), dtype=np.float32)
+    loaded = np.zeros(len(sources), dtype=bool)
+
+    def load_into(index):
+        try:
+            pixels = load_image_uint8(sources[index], target_size, draft)
+        except Exception as e:
+            print(f"Error loading image: {e}")
+            return
+        np.divide(pixels, np.float32(255.0), out=output[index])  # Normalize pixel values
+        loaded[index] = True
+
+    list(_get_batch_executor().map(load_into, range(len(sources))))
 
-def preprocess_batch(image_paths, target_size=(128, 128)):
-    """Preprocesses a batch of images."""
-    images = []
-    for path in image_paths:
-        img_array = load_image(path, target_size)
-        if img_array is not None:
-            images.append(img_array)
-    return np.array(images)
+    if not loaded.all():
+        output = output[loaded]
+    if return_mask:
+        return output, loaded
+    return output
 
 def load_data(csv_path, image_folder):
     """Loads data from a CSV file and returns image paths and labels."""
+    import pandas as pd  # imported lazily to keep app startup fast
     try:
         df = pd.read_csv(csv_path)
         image_paths = [os.path.join(image_folder, filename) for filename in df['filename']]
@@ -43,6 +123,7 @@ def load_data(csv_path, image_folder):
 
 def encode_labels(labels):
     """Encodes labels using LabelEncoder."""
+    from sklearn.preprocessing import LabelEncoder  # imported lazily to keep app startup fast
     try:
         le = LabelEncoder()
         encoded_labels = le.fit_transform(labels)
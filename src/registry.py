@@ -0,0 +1,235 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from botocore.exceptions import ClientError
+from . import storage
+
+REGISTRY_KEY = os.environ.get('MODEL_REGISTRY_KEY', "models/registry.json")
+MODEL_CACHE_DIR = os.path.join(tempfile.gettempdir(), "models")
+
+class RegistryError(Exception):
+    """Raised for an unknown version or a rollback with no history."""
+
+class ModelRegistry:
+    """Versioned model artifacts in S3, described by one JSON document.
+
+    Each version keeps its artifact key, metrics and where it came from;
+    `production` names the version that should be served and `history` the
+    ones it replaced, most recent last, for rollback. Updates use conditional
+    writes, so concurrent promotes and registrations never lose each other.
+    """
+
+    def __init__(self, bucket_name, base_model_key, registry_key=REGISTRY_KEY):
+        self.bucket_name = bucket_name
+        self.base_model_key = base_model_key
+        self.registry_key = registry_key
+        self.prefix = os.path.dirname(registry_key) or "models"
+
+    def _read(self):
+        """Returns (registry, etag); an empty registry if none exists yet."""
+        try:
+            response = storage.get_s3_client().get_object(Bucket=self.bucket_name, Key=self.registry_key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return {"versions": [], "production": None, "history": []}, None
+            raise
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def _update(self, mutate, attempts=5):
+        """Applies `mutate(registry)` and writes it back only if nobody else wrote in between."""
+        for _ in range(attempts):
+            registry, etag = self._read()
+            result = mutate(registry)
+            registry['updated_at'] = time.time()
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                storage.get_s3_client().put_object(Bucket=self.bucket_name, Key=self.registry_key,
+                                                   Body=json.dumps(registry, indent=1).encode(),
+                                                   ContentType='application/json', **condition)
+                return result
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+        raise RegistryError("Registry is being updated concurrently, try again")
+
+    def list(self):
+        return self._read()[0]
+
+    def get(self, version, registry=None):
+        registry = registry or self.list()
+        for entry in registry['versions']:
+            if entry['version'] == version:
+                return entry
+        raise RegistryError(f"Unknown model version {version}")
+
+    def production(self):
+        """Returns the entry to serve, or None while nothing has been registered."""
+        registry = self.list()
+        return self.get(registry['production'], registry) if registry['production'] else None
+
+    def _ensure_base(self, registry):
+        # The original model becomes version 1, so it can be rolled back to
+        if not registry['versions']:
+            registry['versions'].append({"version": 1, "key": self.base_model_key, "label_encoder_key": None,
+                                         "metrics": None, "source": "base", "created_at": time.time()})
+            registry['production'] = 1
+
+    def register(self, local_model_path, metrics=None, source=None, label_encoder_path=None, training=None):
+        """Uploads a new version's artifacts and records it (without promoting it). Returns its entry.
+
+        `training` describes what the version was trained on, e.g. the highest
+        image id it has seen, so the next fine-tune knows which rows are new.
+        """
+        # Reserve the version number first so concurrent registrations never share a key
+        def reserve(registry):
+            self._ensure_base(registry)
+            version = max(entry['version'] for entry in registry['versions']) + 1
+            entry = {"version": version, "key": f"{self.prefix}/versions/v{version}/model.keras",
+                     "label_encoder_key": f"{self.prefix}/versions/v{version}/label_encoder.pkl" if label_encoder_path else None,
+                     "metrics": metrics, "source": source, "training": training, "created_at": time.time(),
+                     "status": "uploading"}
+            registry['versions'].append(entry)
+            return entry
+
+        entry = self._update(reserve)
+        storage.upload_artifact(local_model_path, self.bucket_name, entry['key'])
+        if label_encoder_path:
+            storage.upload_artifact(label_encoder_path, self.bucket_name, entry['label_encoder_key'])
+
+        def mark_ready(registry):
+            stored = self.get(entry['version'], registry)
+            stored.pop('status', None)
+            return stored
+        return self._update(mark_ready)
+
+    def record_evaluation(self, version, result):
+        """Stores a held-out evaluation of `version`, keyed by its split name. Returns the entry."""
+        def apply(registry):
+            self._ensure_base(registry)
+            entry = self.get(version, registry)
+            entry.setdefault('evaluations', {})[result['split']] = result
+            return entry
+        return self._update(apply)
+
+    def attach_artifact(self, version, name, local_path=None, info=None):
+        """Uploads an extra artifact for `version` (e.g. a quantized export) and records it under `artifacts[name]`.
+
+        With no `local_path` only `info` is recorded, e.g. for an export that was rejected.
+        """
+        key = f"{self.prefix}/versions/v{version}/{os.path.basename(local_path)}" if local_path else None
+        if local_path:
+            storage.upload_artifact(local_path, self.bucket_name, key)
+
+        def apply(registry):
+            self._ensure_base(registry)
+            entry = self.get(version, registry)
+            entry.setdefault('artifacts', {})[name] = dict(info or {}, key=key)
+            return entry
+        return self._update(apply)
+
+    def promote(self, version):
+        """Makes `version` the production model. Returns its entry."""
+        def apply(registry):
+            self._ensure_base(registry)
+            entry = self.get(version, registry)
+            if entry.get('status') == 'uploading':
+                raise RegistryError(f"Model version {version} is still uploading")
+            if registry['production'] != version:
+                registry['history'].append(registry['production'])
+                registry['production'] = version
+            return entry
+        return self._update(apply)
+
+    def rollback(self):
+        """Returns to the version that was in production before the current one. Returns its entry."""
+        def apply(registry):
+            if not registry['history']:
+                raise RegistryError("No earlier version to roll back to")
+            registry['production'] = registry['history'].pop()
+            return self.get(registry['production'], registry)
+        return self._update(apply)
+
+    def local_path(self, entry, key=None):
+        """Where a version's artifact (the model, or `key`) is cached on this host."""
+        return os.path.join(MODEL_CACHE_DIR, f"v{entry['version']}", os.path.basename(key or entry['key']))
+
+class _Lease:
+    __slots__ = ("model", "version", "refs", "retired")
+
+    def __init__(self, model, version):
+        self.model = model
+        self.version = version
+        self.refs = 0
+        self.retired = False
+
+class ModelSlot:
+    """Holds the serving model and swaps it atomically.
+
+    Callers borrow the current model with `acquire()`; a swapped-out model stays
+    usable until its last borrower returns it, then `on_release(version)` runs.
+    """
+
+    def __init__(self, on_release=None):
+        self.on_release = on_release
+        self.swaps = 0
+        self._current = None
+        self._draining = []
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        current = self._current
+        return current.version if current else None
+
+    @contextmanager
+    def acquire(self):
+        """Yields (model, version) and keeps that model alive until the block exits."""
+        with self._lock:
+            lease = self._current
+            if lease is None:
+                raise RuntimeError("No model is being served")
+            lease.refs += 1
+        try:
+            yield lease.model, lease.version
+        finally:
+            with self._lock:
+                lease.refs -= 1
+                released = lease.retired and lease.refs == 0
+                if released:
+                    self._draining.remove(lease)
+            if released:
+                self._release(lease)
+
+    def swap(self, model, version):
+        """Makes `model` current; calls already holding the old one finish on it."""
+        with self._lock:
+            old = self._current
+            self._current = _Lease(model, version)
+            self.swaps += 1
+            released = False
+            if old is not None:
+                old.retired = True
+                if old.refs == 0:
+                    released = True
+                else:
+                    self._draining.append(old)
+        if released:
+            self._release(old)
+
+    def _release(self, lease):
+        version = lease.version
+        lease.model = None
+        if self.on_release is not None and version != self.version:
+            self.on_release(version)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "version": self._current.version if self._current else None,
+                "in_flight": self._current.refs if self._current else 0,
+                "draining": [{"version": lease.version, "in_flight": lease.refs} for lease in self._draining],
+                "swaps": self.swaps,
+            }
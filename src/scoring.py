@@ -0,0 +1,166 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from . import preprocessing
+import database
+
+class ScoringStats:
+    """Running counters for a scoring run."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.images = 0
+        self.errors = 0
+        self.labelled = 0
+        self.correct = 0
+
+    def record(self, result):
+        self.images += 1
+        if "error" in result:
+            self.errors += 1
+        elif result.get("label") is not None:
+            self.labelled += 1
+            self.correct += int(result["label"] == result["prediction"])
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        summary = {
+            "images": self.images,
+            "errors": self.errors,
+            "seconds": round(elapsed, 3),
+            "images_per_sec": round(self.images / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+        if self.labelled:
+            summary["accuracy"] = round(self.correct / self.labelled, 4)
+        return summary
+
+def iter_csv_records(csv_path, images_dir=None):
+    """Yields (filename, image_path, label) for an annotations CSV split."""
+    import pandas as pd
+    images_dir = images_dir or os.path.join(os.path.dirname(csv_path), 'images')
+    df = pd.read_csv(csv_path, usecols=['filename', 'class'])
+    for filename, label in zip(df['filename'], df['class']):
+        yield filename, os.path.join(images_dir, filename), label
+
+def iter_db_records(database_file, data_type=None, chunk_size=256):
+    """Yields (image_id, image_bytes, label) from the images table in cursor chunks."""
+    with database.connection(database_file) as conn:
+        if data_type is None:
+            cur = conn.execute("SELECT id, image_data, content_hash, label FROM images ORDER BY id;")
+        else:
+            cur = conn.execute("SELECT id, image_data, content_hash, label FROM images WHERE data_type = ? ORDER BY id;", (data_type,))
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for image_id, image_data, content_hash, label in rows:
+                yield image_id, bytes(database.resolve_image_data(image_data, content_hash)), label
+
+def _score_chunk(chunk, predict_fn, label_map):
+    found = [source is not None for _, source, _ in chunk]
+    images, loaded = preprocessing.preprocess_batch([source for _, source, _ in chunk if source is not None], return_mask=True)
+    predictions = predict_fn(images) if len(images) else []
+    if predictions is None:
+        for key, _, label in chunk:
+            yield {"id": key, "label": label, "error": "Prediction failed"}
+        return
+
+    predictions = iter(predictions)
+    loaded = iter(loaded)
+    for (key, _, label), exists in zip(chunk, found):
+        result = {"id": key, "label": label}
+        if not exists:
+            result["error"] = "Image not found"
+        elif next(loaded):
+            result["prediction"] = label_map.get(int(next(predictions)), "Unknown")
+        else:
+            result["error"] = "Could not decode image"
+        yield result
+
+def score_records(records, predict_fn, chunk_size=64, label_map=preprocessing.LABEL_MAP):
+    """Scores (key, image_source, label) records in chunks, yielding one result per record.
+
+    A record whose source is None is reported as not found.
+
+    `predict_fn` takes a float32 batch and returns class indices, e.g.
+    `lambda images: model.make_predictions(loaded_model, images)`.
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield from _score_chunk(chunk, predict_fn, label_map)
+            chunk = []
+    if chunk:
+        yield from _score_chunk(chunk, predict_fn, label_map)
+
+def format_results(results, fmt="ndjson", stats=None):
+    """Yields results as NDJSON lines (ending with a summary line) or CSV rows."""
+    stats = stats or ScoringStats()
+    if fmt == "csv":
+        yield "id,label,prediction,error\n"
+    for result in results:
+        stats.record(result)
+        if fmt == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow([result["id"], result.get("label") or "", result.get("prediction", ""), result.get("error", "")])
+            yield buffer.getvalue()
+        else:
+            yield json.dumps(result) + "\n"
+    if fmt != "csv":
+        yield json.dumps({"summary": stats.summary()}) + "\n"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a dataset split or the images table in batches.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--csv", help="Path to a dataset/*/_annotations.csv split")
+    source.add_argument("--db", help="Path to the SQLite database")
+    parser.add_argument("--images-dir", help="Images folder for --csv (default: images/ next to the CSV)")
+    parser.add_argument("--data-type", help="Only score rows with this data_type (with --db)")
+    parser.add_argument("--model-path", help="Local .keras file (default: download from S3)")
+    parser.add_argument("--bucket", default="theosummative")
+    parser.add_argument("--s3-model-file", default="models/second_model.keras")
+    parser.add_argument("--chunk-size", type=int, default=64)
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--output", help="Write results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    import tensorflow as tf
+    from . import model
+
+    # Results go to stdout (or --output); keep progress prints out of the data stream
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.model_path:
+                keras_model = tf.keras.models.load_model(args.model_path)
+            else:
+                keras_model = model.load_model_from_s3(args.bucket, args.s3_model_file, os.path.join(tempfile.gettempdir(), "model.keras"))
+            if keras_model is None:
+                print("Could not load model")
+                return 1
+            serving_model = model.prepare_for_serving(keras_model)
+
+            if args.csv:
+                records = iter_csv_records(args.csv, args.images_dir)
+            else:
+                records = iter_db_records(args.db, args.data_type)
+
+            results = score_records(records, lambda images: model.make_predictions(serving_model, images), args.chunk_size)
+            stats = ScoringStats()
+            for line in format_results(results, args.format, stats):
+                out.write(line)
+            print(json.dumps(stats.summary()))
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Point at a local S3 stand-in (MinIO, moto server, ...) for development and tests
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """Returns the process-wide boto3 S3 client, creating it on first use."""
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                's3',
+                aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                region_name=os.environ.get('AWS_DEFAULT_REGION'),
+                endpoint_url=S3_ENDPOINT_URL,
+            )
+        return _s3_client
+
+def reset_s3_client():
+    """Drops the shared client so a forked child doesn't reuse the parent's connections."""
+    global _s3_client
+    with _s3_client_lock:
+        _s3_client = None
+
+def _is_unreachable(error):
+    """True for errors that mean the object store is down rather than the object being wrong."""
+    if isinstance(error, BotoCoreError):
+        return True
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    return status >= 500
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def download_artifact(bucket_name, s3_file_path, local_file_path):
+    """Downloads an S3 object to `local_file_path` only if the cached copy is stale.
+
+    The cached copy's ETag and size are kept in a `.meta.json` sidecar and
+    compared against a HEAD request. If the object store can't be reached the
+    cached copy is used as-is. Returns the ETag of the file now on disk.
+    """
+    meta_path = local_file_path + ".meta.json"
+    cached = _read_meta(meta_path)
+    if cached and not os.path.exists(local_file_path):
+        cached = None
+
+    client = get_s3_client()
+    try:
+        head = client.head_object(Bucket=bucket_name, Key=s3_file_path)
+        etag = head['ETag'].strip('"')
+        size = head['ContentLength']
+        if cached and cached.get('etag') == etag and os.path.getsize(local_file_path) == size:
+            print(f"Using cached artifact {s3_file_path} ({etag})")
+            return etag
+
+        directory = os.path.dirname(local_file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        partial_path = local_file_path + ".part"
+        client.download_file(bucket_name, s3_file_path, partial_path)
+        os.replace(partial_path, local_file_path)
+        with open(meta_path, "w") as f:
+            json.dump({"bucket": bucket_name, "key": s3_file_path, "etag": etag, "size": size}, f)
+        print(f"Downloaded {s3_file_path} ({etag}) to: {local_file_path}")
+        return etag
+
+    except (BotoCoreError, ClientError) as e:
+        if cached and _is_unreachable(e):
+            print(f"Object store unreachable ({e}), using cached {s3_file_path} ({cached['etag']})")
+            return cached['etag']
+        raise
+
+def cached_etag(local_file_path):
+    """Returns the ETag recorded for a cached artifact, or None."""
+    meta = _read_meta(local_file_path + ".meta.json")
+    return meta.get('etag') if meta else None
+
+def upload_artifact(local_file_path, bucket_name, s3_file_path):
+    """Uploads a file and records its ETag so a later download of the same key is skipped."""
+    client = get_s3_client()
+    client.upload_file(local_file_path, bucket_name, s3_file_path)
+    head = client.head_object(Bucket=bucket_name, Key=s3_file_path)
+    with open(local_file_path + ".meta.json", "w") as f:
+        json.dump({"bucket": bucket_name, "key": s3_file_path, "etag": head['ETag'].strip('"'), "size": head['ContentLength']}, f)
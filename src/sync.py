@@ -0,0 +1,279 @@
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from . import metrics, storage
+import database
+
+# Large snapshots go up and down in parallel parts instead of one long request
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, max_concurrency=4)
+SYNC_MAX_ATTEMPTS = int(os.environ.get('DB_SYNC_MAX_ATTEMPTS', 5))
+# Fold the segments into a fresh base snapshot once there are this many
+SYNC_COMPACT_SEGMENTS = int(os.environ.get('DB_SYNC_COMPACT_SEGMENTS', 20))
+
+sync_seconds = metrics.histogram("s3_sync_seconds", "Time to build and upload one database sync, by what was sent.", ["kind"])
+sync_bytes = metrics.counter("s3_sync_bytes_total", "Bytes of database snapshots and segments uploaded.", ["kind"])
+sync_failures = metrics.counter("s3_sync_failures_total", "Database sync attempts that failed.")
+MANIFEST_ATTEMPTS = 5
+
+class ManifestConflict(Exception):
+    """Raised when another node rewrote the sync manifest between our read and write."""
+
+class DeltaSync:
+    """Ships the images table to S3 as a base snapshot plus append-only segments.
+
+    Layout under the bucket:
+
+        <base_key>.sync/manifest.json         base and segment list, written last
+        <base_key>.sync/base/<uuid>.db        full snapshot
+        <base_key>.sync/segments/<uuid>.db    rows one node hadn't uploaded yet
+        <base_key>                            snapshot from before the manifest existed
+
+    Objects are never overwritten: a new snapshot gets a new key and the
+    manifest is switched to it. Rows are matched across nodes on their random
+    uid, never on their local id, so nodes ingesting at the same time don't
+    collide. Each database records which snapshot and segments it holds
+    (sync_segments). Thumbnails are derived data and aren't synced.
+    """
+
+    def __init__(self, bucket_name, base_key, database_file=None, max_attempts=SYNC_MAX_ATTEMPTS,
+                 compact_segments=SYNC_COMPACT_SEGMENTS, backoff_base=1.0, backoff_max=60.0):
+        self.bucket_name = bucket_name
+        self.base_key = base_key
+        self.prefix = f"{base_key}.sync"
+        self.manifest_key = f"{self.prefix}/manifest.json"
+        self.database_file = database_file
+        self.max_attempts = max_attempts
+        self.compact_segments = compact_segments
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.last_result = None
+        self.last_error = None
+        self._requested = threading.Event()
+        self._sync_lock = threading.Lock()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    # Manifest
+
+    def _read_manifest(self):
+        """Returns (manifest, etag); (None, None) if nothing has been synced this way yet."""
+        try:
+            response = storage.get_s3_client().get_object(Bucket=self.bucket_name, Key=self.manifest_key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None, None
+            raise
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def fetch_manifest(self):
+        """Returns the manifest in S3, or None if nothing has been synced this way yet."""
+        return self._read_manifest()[0]
+
+    def _put_manifest(self, manifest, etag):
+        """Writes the manifest only if it is still the version read as `etag` (None: only if none exists).
+
+        Returns the new ETag; raises ManifestConflict when another node wrote it in between.
+        """
+        manifest['updated_at'] = time.time()
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            response = storage.get_s3_client().put_object(Bucket=self.bucket_name, Key=self.manifest_key,
+                                                          Body=json.dumps(manifest).encode(), ContentType='application/json',
+                                                          **condition)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise ManifestConflict("Sync manifest was updated concurrently") from e
+            raise
+        return response['ETag']
+
+    # Upload
+
+    def _upload(self, local_path, key):
+        storage.get_s3_client().upload_file(local_path, self.bucket_name, key, Config=TRANSFER_CONFIG)
+
+    def _record(self, keys):
+        with database.connection(self.database_file) as conn:
+            database.record_segments(conn, keys)
+
+    def _upload_base(self, manifest, etag):
+        covers = []
+        if manifest is not None:
+            # Fold in what other nodes uploaded, and send our own rows as a segment, so the
+            # snapshot holds nothing beyond the objects it covers: nodes that already have the
+            # old base can catch up from those instead of downloading the whole snapshot
+            self.pull()
+            _, etag = self._upload_segment(manifest, etag)
+            covers = [manifest['base']['key']] + [segment['key'] for segment in manifest['segments']]
+        key = f"{self.prefix}/base/{uuid.uuid4().hex}.db"
+        with tempfile.TemporaryDirectory() as work:
+            path = os.path.join(work, "base.db")
+            max_id = database.snapshot(path, self.database_file)
+            self._upload(path, key)
+            size = os.path.getsize(path)
+        self._put_manifest({"version": 2, "base": {"key": key, "bytes": size, "covers": covers}, "segments": []}, etag)
+        if not covers:
+            database.mark_synced(max_id, self.database_file)
+        # Rows ingested since the segment above stay unsynced and go up in the next segment
+        self._record([key] + covers)
+        print(f"Database snapshot uploaded to S3 ({size} bytes).")
+        return {"uploaded": "base", "bytes": size}
+
+    def sync_once(self):
+        """Uploads whatever S3 doesn't have yet and returns a summary of what was sent."""
+        start = time.perf_counter()
+        result = self._sync_once()
+        kind = result["uploaded"] or "none"
+        sync_seconds.observe(time.perf_counter() - start, kind=kind)
+        sync_bytes.inc(result["bytes"], kind=kind)
+        return result
+
+    def _sync_once(self):
+        with self._sync_lock:
+            for _ in range(MANIFEST_ATTEMPTS):
+                try:
+                    return self._sync_against(*self._read_manifest())
+                except ManifestConflict:
+                    continue  # another node synced first: start over from its manifest
+            raise ManifestConflict("Sync manifest is being updated concurrently, try again")
+
+    def _sync_against(self, manifest, etag):
+        if manifest is None or len(manifest['segments']) >= self.compact_segments:
+            return self._upload_base(manifest, etag)
+        return self._upload_segment(manifest, etag)[0]
+
+    def _upload_segment(self, manifest, etag):
+        """Uploads the rows S3 doesn't have yet as a new segment; returns (summary, manifest ETag)."""
+        up_to_id = database.max_image_id(self.database_file)
+        key = f"{self.prefix}/segments/{uuid.uuid4().hex}.db"
+        with tempfile.TemporaryDirectory() as work:
+            path = os.path.join(work, "segment.db")
+            rows = database.export_unsynced_images(path, up_to_id, self.database_file)
+            if not rows:
+                return {"uploaded": None, "rows": 0, "bytes": 0}, etag
+            self._upload(path, key)
+            size = os.path.getsize(path)
+        # The segment is in place before the manifest points at it
+        manifest['segments'].append({"key": key, "rows": rows, "bytes": size})
+        etag = self._put_manifest(manifest, etag)
+        database.mark_synced(up_to_id, self.database_file)
+        self._record([key])
+        print(f"Database delta uploaded to S3 ({rows} rows, {size} bytes).")
+        return {"uploaded": "segment", "rows": rows, "bytes": size}, etag
+
+    def sync_with_retry(self):
+        """Runs `sync_once`, retrying failures with capped exponential backoff and jitter."""
+        for attempt in range(self.max_attempts):
+            try:
+                self.last_result = self.sync_once()
+                self.last_error = None
+                return self.last_result
+            except (BotoCoreError, ClientError, OSError, sqlite3.Error, ManifestConflict) as e:
+                self.last_error = str(e)
+                sync_failures.inc()
+                if attempt + 1 == self.max_attempts:
+                    break
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"Error syncing database to S3 (attempt {attempt + 1}/{self.max_attempts}): {e}; retrying in {delay:.1f}s")
+                time.sleep(delay)
+        print(f"Giving up syncing database to S3 after {self.max_attempts} attempts: {self.last_error}")
+        return None
+
+    # Background worker
+
+    def _ensure_started(self):
+        """Starts the worker thread on first use (and again in a forked child, where it doesn't survive)."""
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-sync", daemon=True)
+                self._thread.start()
+
+    def request_sync(self):
+        """Schedules a background sync; requests made while one is running are coalesced."""
+        self._ensure_started()
+        self._requested.set()
+
+    def _run(self):
+        while True:
+            self._requested.wait()
+            self._requested.clear()
+            self.sync_with_retry()
+
+    # Restore
+
+    def restore(self, local_path):
+        """Builds a local database from the base snapshot plus every segment.
+
+        Falls back to downloading the plain base file when no manifest exists.
+        """
+        manifest = self.fetch_manifest()
+        client = storage.get_s3_client()
+        partial_path = local_path + ".part"
+        client.download_file(self.bucket_name, manifest['base']['key'] if manifest else self.base_key, partial_path, Config=TRANSFER_CONFIG)
+        segments = manifest['segments'] if manifest else []
+        with tempfile.TemporaryDirectory() as work:
+            conn = sqlite3.connect(partial_path)
+            try:
+                database.apply_schema(conn)
+                for segment in segments:
+                    segment_path = os.path.join(work, os.path.basename(segment['key']))
+                    client.download_file(self.bucket_name, segment['key'], segment_path, Config=TRANSFER_CONFIG)
+                    database.merge_segment(conn, segment_path)
+                    os.remove(segment_path)
+                with conn:
+                    conn.execute("UPDATE images SET synced = 1 WHERE synced IS NULL;")  # all of it came from S3
+                if manifest:
+                    database.record_segments(conn, [manifest['base']['key']] + manifest['base'].get('covers', []) +
+                                             [segment['key'] for segment in segments])
+                if database.IMAGE_STORAGE == 'blob':
+                    # Snapshots and segments carry the bytes inline; keep only metadata locally
+                    database.move_rows_to_blob_store(conn)
+                    conn.execute("VACUUM;")
+            finally:
+                conn.close()
+        os.replace(partial_path, local_path)
+        print(f"Database restored from S3 (base + {len(segments)} segments).")
+
+    def pull(self, local_path=None):
+        """Applies only the snapshot and segments a local database doesn't hold yet.
+
+        Works on `local_path` (default: the synced database) over its own
+        connection, so it can catch up a stale copy before it is pooled.
+        Returns the number of rows added.
+        """
+        manifest = self.fetch_manifest()
+        if manifest is None:
+            return 0
+        conn = sqlite3.connect(local_path or self.database_file or database.DATABASE_PATH, timeout=30)
+        try:
+            database.apply_schema(conn)
+            applied = database.applied_segments(conn)
+            base, pending = manifest['base'], []
+            if base['key'] not in applied:
+                covers = base.get('covers') or []
+                if covers and covers[0] in applied:
+                    # A compaction of a base we hold: the segments it covers are still in S3
+                    pending += [{"key": key} for key in covers[1:] if key not in applied]
+                    database.record_segments(conn, [base['key']])
+                else:
+                    pending.append(base)
+            pending += [segment for segment in manifest['segments'] if segment['key'] not in applied]
+            added = 0
+            with tempfile.TemporaryDirectory() as work:
+                for segment in pending:
+                    segment_path = os.path.join(work, os.path.basename(segment['key']))
+                    storage.get_s3_client().download_file(self.bucket_name, segment['key'], segment_path, Config=TRANSFER_CONFIG)
+                    added += database.merge_segment(conn, segment_path)
+                    database.record_segments(conn, [segment['key']])
+                    os.remove(segment_path)
+        finally:
+            conn.close()
+        if added:
+            print(f"Pulled {added} new images from S3.")
+        return added
@@ -0,0 +1,25 @@
+import os
+import sys
+import boto3
+import pytest
+
+# The app modules import each other from the repository root (`import database`, `from src import ...`)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = "tests"
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    """An empty bucket in moto's in-process S3; yields its name."""
+    from moto import mock_aws
+    from src import storage
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(storage, "S3_ENDPOINT_URL", None)
+    with mock_aws():
+        storage.reset_s3_client()
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket=BUCKET)
+        yield BUCKET
+    storage.reset_s3_client()
@@ -0,0 +1,100 @@
+import threading
+import numpy as np
+import pytest
+from src.batching import MicroBatcher, QueueFullError
+
+def _image(value=0.0):
+    return np.full((2, 2, 3), value, dtype=np.float32)
+
+def _echo(images):
+    """Predicts each image's first pixel, so results can be matched to their requests."""
+    return images[:, 0, 0, :1]
+
+class _BlockingModel:
+    """A predict_fn that holds its batch until released, keeping the batcher busy."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, images):
+        self.started.set()
+        self.release.wait(5)
+        return _echo(images)
+
+@pytest.fixture
+def blocking_model():
+    model = _BlockingModel()
+    yield model
+    model.release.set()
+
+def test_submit_returns_each_requests_prediction():
+    batcher = MicroBatcher(_echo, max_wait_ms=20)
+    try:
+        results = {}
+        threads = [threading.Thread(target=lambda value=value: results.__setitem__(value, batcher.submit(_image(value))))
+                   for value in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert {value: float(result[0]) for value, result in results.items()} == {value: float(value) for value in range(8)}
+    finally:
+        batcher.stop()
+
+def test_full_queue_raises_queue_full(blocking_model):
+    batcher = MicroBatcher(blocking_model, max_batch_size=1, max_queue_size=1, enqueue_timeout=0.05)
+    try:
+        running = batcher.submit_future(_image())
+        assert blocking_model.started.wait(5)
+        batcher.submit_future(_image())  # takes the only queue slot
+        with pytest.raises(QueueFullError):
+            batcher.submit_future(_image())
+        with pytest.raises(QueueFullError):
+            batcher.submit(_image())
+        blocking_model.release.set()
+        assert running.result(5)[0] == 0.0
+    finally:
+        batcher.stop()
+
+def test_submit_times_out_waiting_for_prediction(blocking_model):
+    batcher = MicroBatcher(blocking_model, result_timeout=0.05)
+    try:
+        with pytest.raises(TimeoutError):
+            batcher.submit(_image())
+    finally:
+        batcher.stop()
+
+def test_cancelled_future_is_dropped(blocking_model):
+    calls = []
+
+    def predict(images):
+        calls.append(len(images))
+        return blocking_model(images)
+
+    batcher = MicroBatcher(predict, max_batch_size=1)
+    try:
+        first = batcher.submit_future(_image(1.0))
+        assert blocking_model.started.wait(5)
+        cancelled = batcher.submit_future(_image(2.0))
+        assert cancelled.cancel()
+        last = batcher.submit_future(_image(3.0))
+        blocking_model.release.set()
+        assert first.result(5)[0] == 1.0
+        assert last.result(5)[0] == 3.0
+        assert calls == [1, 1]  # the cancelled request never reached the model
+    finally:
+        batcher.stop()
+
+def test_prediction_error_reaches_caller():
+    def broken(images):
+        raise ValueError("model failed")
+
+    batcher = MicroBatcher(broken)
+    try:
+        with pytest.raises(ValueError):
+            batcher.submit(_image())
+        with pytest.raises(ValueError):
+            batcher.submit_future(_image()).result(5)
+    finally:
+        batcher.stop()
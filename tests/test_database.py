@@ -0,0 +1,67 @@
+import threading
+import pytest
+import database
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = database.ConnectionPool(str(tmp_path / "pool.db"), max_size=2, timeout=0.2)
+    yield pool
+    pool.close()
+
+def test_connections_use_wal_and_are_reused(pool):
+    with pool.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+        first = conn
+    with pool.connection() as conn:
+        assert conn is first
+    assert pool.stats()['idle'] == 1
+
+def test_open_transaction_is_rolled_back_on_return(pool):
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER);")
+        conn.commit()
+        conn.execute("INSERT INTO t VALUES (1);")
+    with pool.connection() as conn:
+        assert not conn.in_transaction
+        assert conn.execute("SELECT COUNT(*) FROM t;").fetchone()[0] == 0
+
+def test_pool_is_bounded_and_times_out(pool):
+    with pool.connection(), pool.connection():
+        with pytest.raises(TimeoutError):
+            with pool.connection():
+                pass
+    assert pool.stats()['idle'] == 2
+
+def test_waiters_get_a_returned_connection(pool):
+    release = threading.Event()
+    holding = [threading.Event(), threading.Event()]
+    pool.timeout = 5.0
+
+    def hold(held):
+        with pool.connection():
+            held.set()
+            release.wait(5)
+
+    holders = [threading.Thread(target=hold, args=(held,)) for held in holding]
+    for holder in holders:
+        holder.start()
+    assert all(held.wait(5) for held in holding)
+    threading.Timer(0.1, release.set).start()
+    with pool.connection() as conn:
+        assert conn.execute("SELECT 1;").fetchone()[0] == 1
+    for holder in holders:
+        holder.join(5)
+    assert pool.stats()['waits'] == 1
+
+def test_dedicated_connection_is_outside_the_pool(pool):
+    with pool.connection(), pool.connection():
+        with pool.dedicated() as conn:
+            assert conn.execute("SELECT 1;").fetchone()[0] == 1
+    assert pool.stats()['idle'] == 2
+
+def test_get_pool_creates_schema_once_per_file(tmp_path):
+    path = str(tmp_path / "images.db")
+    assert not database.pool_is_open(path)
+    assert database.get_pool(path) is database.get_pool(path)
+    assert database.pool_is_open(path)
+    assert database.max_image_id(path) == 0
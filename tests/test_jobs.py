@@ -0,0 +1,75 @@
+import time
+import pytest
+from src import jobs
+
+@pytest.fixture(autouse=True)
+def jobs_database(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_DATABASE_PATH", str(tmp_path / "jobs.db"))
+    # run_job builds a Keras callback; these runners never train
+    monkeypatch.setattr(jobs, "make_progress_callback", lambda job_id, epochs: None)
+
+def test_enqueue_rejects_second_active_job():
+    job = jobs.enqueue("retrain", "model.h5", {"epochs": 1})
+    with pytest.raises(jobs.JobExistsError) as excinfo:
+        jobs.enqueue("retrain", "model.h5", {"epochs": 1})
+    assert excinfo.value.job['id'] == job['id']
+    assert jobs.enqueue("retrain", "other.h5", {})['status'] == 'queued'
+
+def test_cancel_queued_job():
+    job = jobs.enqueue("retrain", "model.h5", {})
+    cancelled = jobs.cancel(job['id'])
+    assert cancelled['status'] == 'cancelled'
+    assert jobs.claim_next("worker") is None
+    assert jobs.enqueue("retrain", "model.h5", {})['status'] == 'queued'
+
+def test_cancel_running_job_is_requested_from_worker():
+    job = jobs.enqueue("retrain", "model.h5", {})
+    claimed = jobs.claim_next("worker")
+    assert claimed['id'] == job['id'] and claimed['status'] == 'running'
+    assert jobs.update_progress(job['id'], progress=10) is False
+
+    cancelling = jobs.cancel(job['id'])
+    assert cancelling['status'] == 'running'
+    assert cancelling['cancel_requested'] is True
+    assert jobs.update_progress(job['id'], progress=20) is True
+
+def test_run_job_records_cancellation(monkeypatch):
+    def runner(job, callback):
+        jobs.cancel(job['id'])
+        if jobs.update_progress(job['id']):
+            raise jobs.JobCancelled()
+        return {}
+
+    monkeypatch.setitem(jobs.JOB_RUNNERS, "retrain", runner)
+    job = jobs.enqueue("retrain", "model.h5", {})
+    jobs.run_job(jobs.claim_next("worker"))
+    assert jobs.get_job(job['id'])['status'] == 'cancelled'
+    assert jobs.active_job("model.h5") is None
+
+def test_run_job_completes_past_the_last_cancel_point(monkeypatch):
+    def runner(job, callback):
+        jobs.cancel(job['id'])  # too late: the model is already promoted
+        return {"version": 2}
+
+    monkeypatch.setitem(jobs.JOB_RUNNERS, "retrain", runner)
+    job = jobs.enqueue("retrain", "model.h5", {})
+    jobs.run_job(jobs.claim_next("worker"))
+    finished = jobs.get_job(job['id'])
+    assert finished['status'] == 'completed'
+    assert finished['result']['version'] == 2
+
+def test_recover_stale_jobs_fails_silent_workers(monkeypatch):
+    stale = jobs.enqueue("retrain", "stale.h5", {})
+    jobs.claim_next("worker-1")
+    alive = jobs.enqueue("retrain", "alive.h5", {})
+    jobs.claim_next("worker-2")
+    with jobs.connection() as conn:
+        with conn:
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?;", (time.time() - 600, stale['id']))
+
+    monkeypatch.setattr(jobs, "JOB_STALE_SECONDS", 60)
+    assert jobs.recover_stale_jobs() == 1
+    assert jobs.get_job(stale['id'])['status'] == 'failed'
+    assert jobs.get_job(alive['id'])['status'] == 'running'
+    # The failed job no longer blocks a new one for its model
+    assert jobs.enqueue("retrain", "stale.h5", {})['status'] == 'queued'
@@ -0,0 +1,88 @@
+import threading
+import pytest
+from src.registry import ModelRegistry, ModelSlot, RegistryError
+
+@pytest.fixture
+def registry(s3_bucket):
+    return ModelRegistry(s3_bucket, "models/base.keras", registry_key="models/registry.json")
+
+@pytest.fixture
+def artifact(tmp_path):
+    path = tmp_path / "model.keras"
+    path.write_bytes(b"weights")
+    return str(path)
+
+def test_register_promote_and_rollback(registry, artifact):
+    entry = registry.register(artifact, metrics={"accuracy": 0.9}, source="retrain")
+    assert entry['version'] == 2 and 'status' not in entry
+    assert registry.production()['version'] == 1  # registering doesn't promote
+
+    registry.promote(2)
+    assert registry.production()['version'] == 2
+    assert registry.rollback()['version'] == 1
+    with pytest.raises(RegistryError):
+        registry.rollback()
+    with pytest.raises(RegistryError):
+        registry.promote(7)
+
+def test_concurrent_registrations_get_distinct_versions(registry, artifact):
+    entries, errors = [], []
+
+    def register():
+        try:
+            entries.append(registry.register(artifact))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=register) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not errors
+    assert sorted(entry['version'] for entry in entries) == [2, 3, 4, 5]
+    assert len({entry['key'] for entry in entries}) == 4
+
+def test_update_retries_when_another_writer_wins(registry, monkeypatch):
+    registry._update(registry._ensure_base)
+    read = registry._read
+    calls = []
+
+    def racing_read():
+        result = read()
+        if not calls:
+            # Someone else writes between our read and our conditional put
+            other = ModelRegistry(registry.bucket_name, registry.base_model_key, registry.registry_key)
+            other._update(lambda stored: stored.setdefault('note', 'other writer'))
+        calls.append(1)
+        return result
+
+    monkeypatch.setattr(registry, "_read", racing_read)
+    registry._update(lambda stored: stored.__setitem__('mine', True))
+    monkeypatch.setattr(registry, "_read", read)
+    stored = registry.list()
+    assert len(calls) == 2
+    assert stored['note'] == 'other writer' and stored['mine'] is True
+
+def test_update_gives_up_after_repeated_conflicts(registry, monkeypatch):
+    registry._update(registry._ensure_base)
+    stale = registry._read()
+    registry._update(lambda stored: stored.__setitem__('moved', True))
+    monkeypatch.setattr(registry, "_read", lambda: stale)
+    with pytest.raises(RegistryError):
+        registry._update(lambda stored: None, attempts=2)
+
+def test_model_slot_keeps_old_model_until_released():
+    released = []
+    slot = ModelSlot(on_release=released.append)
+    slot.swap("model-1", 1)
+    with slot.acquire() as (model, version):
+        slot.swap("model-2", 2)
+        assert (model, version) == ("model-1", 1)
+        assert released == []
+        assert slot.stats()['draining'] == [{"version": 1, "in_flight": 1}]
+        with slot.acquire() as (newer, newer_version):
+            assert (newer, newer_version) == ("model-2", 2)
+    assert released == [1]
+    slot.swap("model-3", 3)
+    assert released == [1, 2]
@@ -0,0 +1,127 @@
+import sqlite3
+import time
+import pytest
+import database
+from conftest import BUCKET
+from src import sync
+
+BASE_KEY = "images.db"
+
+@pytest.fixture(autouse=True)
+def bucket(s3_bucket, monkeypatch):
+    monkeypatch.setattr(database, "IMAGE_STORAGE", "inline")
+    return s3_bucket
+
+def _add_images(database_file, *labels):
+    with database.connection(database_file) as conn:
+        with conn:
+            for label in labels:
+                image_data = f"{label}-{time.time_ns()}".encode()
+                conn.execute(database.INSERT_IMAGE, database.image_values(image_data, label, 'train', time.time(), {'phash': None}))
+
+def _rows(database_file):
+    with database.connection(database_file) as conn:
+        return dict(conn.execute("SELECT uid, label FROM images;").fetchall())
+
+def _node(database_file, **kwargs):
+    return sync.DeltaSync(BUCKET, BASE_KEY, database_file=str(database_file), **kwargs)
+
+def test_first_sync_uploads_base_then_segments(tmp_path):
+    path = str(tmp_path / "a.db")
+    _add_images(path, "cat", "dog")
+    node = _node(path)
+    assert node.sync_once()["uploaded"] == "base"
+    assert node.sync_once()["uploaded"] is None
+    _add_images(path, "bird")
+    result = node.sync_once()
+    assert result["uploaded"] == "segment" and result["rows"] == 1
+    assert [segment["rows"] for segment in node.fetch_manifest()["segments"]] == [1]
+
+def test_stale_manifest_write_conflicts(tmp_path):
+    path = str(tmp_path / "a.db")
+    _add_images(path, "cat")
+    node = _node(path)
+    node.sync_once()
+    manifest, etag = node._read_manifest()
+    with pytest.raises(sync.ManifestConflict):
+        node._put_manifest(dict(manifest), None)  # one already exists
+
+    _add_images(path, "dog")
+    node.sync_once()  # moves the manifest past `etag`
+    with pytest.raises(sync.ManifestConflict):
+        node._put_manifest(manifest, etag)
+    assert len(node.fetch_manifest()["segments"]) == 1
+
+def test_concurrent_nodes_converge_by_uid(tmp_path):
+    path_a, path_b = str(tmp_path / "a.db"), str(tmp_path / "b.db")
+    _add_images(path_a, "cat", "dog")
+    node_a = _node(path_a)
+    node_a.sync_once()
+    node_b = _node(path_b)
+    node_b.restore(path_b)
+
+    # Both nodes ingest a row with the same local id; B read the manifest before A's upload
+    _add_images(path_a, "bird")
+    _add_images(path_b, "fish")
+    manifest, etag = node_b._read_manifest()
+    assert node_a.sync_once()["uploaded"] == "segment"
+    with pytest.raises(sync.ManifestConflict):
+        node_b._sync_against(manifest, etag)
+    assert node_b.sync_once()["uploaded"] == "segment"  # retries against A's manifest
+
+    assert node_a.pull() == 1
+    assert node_b.pull() == 1
+    assert node_a.pull() == node_b.pull() == 0
+    assert _rows(path_a) == _rows(path_b)
+    assert sorted(_rows(path_a).values()) == ["bird", "cat", "dog", "fish"]
+
+    path_c = str(tmp_path / "c.db")
+    node_a.restore(path_c)
+    assert _rows(path_c) == _rows(path_a)
+
+def test_compaction_lets_nodes_catch_up_from_segments(tmp_path):
+    path_a, path_b = str(tmp_path / "a.db"), str(tmp_path / "b.db")
+    _add_images(path_a, "cat")
+    node_a = _node(path_a, compact_segments=2)
+    node_a.sync_once()
+    node_b = _node(path_b)
+    node_b.restore(path_b)
+
+    _add_images(path_b, "fish")
+    node_b.sync_once()
+    _add_images(path_a, "bird")
+    node_a.sync_once()
+    _add_images(path_a, "dog")
+    assert node_a.sync_once()["uploaded"] == "base"
+    manifest = node_a.fetch_manifest()
+    assert manifest["segments"] == [] and len(manifest["base"]["covers"]) == 4
+
+    # B holds the old base, so it only fetches the segments it is missing
+    assert node_b.pull() == 2
+    assert _rows(path_a) == _rows(path_b)
+    assert sorted(_rows(path_b).values()) == ["bird", "cat", "dog", "fish"]
+
+def test_merge_legacy_segment_keeps_duplicate_links(tmp_path):
+    legacy_path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(legacy_path)
+    conn.executescript(
+        "CREATE TABLE images (id INTEGER PRIMARY KEY, image_data BLOB NOT NULL, label TEXT NOT NULL, data_type TEXT, "
+        "created_at REAL, content_hash TEXT, duplicate_of INTEGER);"
+        "INSERT INTO images VALUES (7, x'01', 'cat', 'train', 0, 'hash-cat', NULL);"
+        "INSERT INTO images VALUES (9, x'01', 'cat', 'train', 0, 'hash-cat', 7);"
+    )
+    conn.commit()
+    conn.close()
+
+    path = str(tmp_path / "a.db")
+    _add_images(path, "dog")
+    conn = sqlite3.connect(path)
+    try:
+        assert database.merge_segment(conn, legacy_path) == 2
+        assert database.merge_segment(conn, legacy_path) == 0  # matched on the derived uid
+        rows = {uid: (image_id, duplicate_of) for image_id, uid, duplicate_of in
+                conn.execute("SELECT id, uid, duplicate_of FROM images;")}
+    finally:
+        conn.close()
+    original_id, _ = rows["legacy-7-hash-cat"]
+    assert rows["legacy-9-hash-cat"][1] == original_id